@@ -31,6 +31,7 @@ class Predict : Intention {
                 + " --measure " + measures.minus(against).first() //
                 + " --execution_id " + id
                 + " --cube " + json.toString().replace(" ", "__")
+                + " --cube_name " + cubeSyn.replace(" ", "__")
                 + " --using " + concat(using, sep = ",")
                 + " --accuracy_size " + accuracysize
                 + " --nullify " + nullify)
@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 import unittest
 import math
+import scipy.stats
+import tempfile
 # sys.path.append('src/main/python/')
 # sys.path.append('../../main/python/')
 from assess import *
@@ -72,6 +74,20 @@ class TestAssess(unittest.TestCase):
         self.assertTrue(pd.DataFrame(X).equals(res), X)
         self.assertTrue(key == "difference_3", X)
 
+    def test_labeling(self):
+        a = pd.Series([0.4, np.nan, 0.9, 1.0, 1.05, 1.1, 2.0, 3.0, np.inf])
+        bins = pd.IntervalIndex.from_tuples([(-float("inf"), 0.5), (0.5, 0.9), (0.9, 1.1), (1.1, 2), (2, float("inf"))])
+        d = dict(zip(bins, ["1-quite lower", "2-lower", "3-same", "4-higher", "5-quite higher"]))
+        pd.testing.assert_series_equal(pd.cut(a, bins).map(d), fixedratio5(a))
+        a = pd.Series([5.0, 1.0, 3.0, 3.0, 2.0, 8.0, 13.0], index=[6, 5, 4, 3, 2, 1, 0], name="comparison")
+        pd.testing.assert_series_equal(pd.cut(a, bins=5, labels=["1-*", "2-**", "3-***", "4-****", "5-*****"]), likert5(a))
+        pd.testing.assert_series_equal(pd.cut(a, bins=6, labels=[str(x + 1) for x in range(6)]), cut_values(a))
+
+    def test_percentile(self):
+        a = pd.Series([3.0, 1.0, 3.0, np.nan, 2.0, 3.0, 0.0, 7.0, 1.0])
+        pd.testing.assert_series_equal(pd.qcut(a.rank(method='first'), q=4, labels=["1Q", "2Q", "3Q", "4Q"]), quartile(a))
+        pd.testing.assert_series_equal(pd.qcut(a.rank(method='first'), q=9, labels=[str(x + 1) + "Q" for x in range(9)]), percentile(a))
+
     path = "../../../src/main/resources/assess/"
     cube_fixed = """{"SC":[],"PROPERTIES":[],"GC":["the_month","country"],"MC":[{"MEA":"unit_sales","AGG":"sum","AS":"unit_sales"}]}"""
     cube_sibling = """{"SC":[{"VAL":["'1997-07'"],"SLICE":true,"TIME":true,"COP":"=","ATTR":"the_month"}],"PROPERTIES":[],"GC":["country","the_month"],"MC":[{"MEA":"unit_sales","AGG":"sum","AS":"unit_sales"}]}"""
@@ -84,6 +100,46 @@ class TestAssess(unittest.TestCase):
         res = assess(self.path, "fixed", "0", """{"params":["unit_sales",0],"fun":"difference"}""", "target", "0", "unit_sales", self.cube_fixed, "(100,130,bad);(130,160,ok);(160,Infinity,good)", "JOININMEMORY")
         self.assertTrue(["bad", "bad", "ok", "bad", "ok", "ok", "good", "bad", "ok", "bad", "good", "good"] == [x for x in res["model_labeling"].values], res)
 
+    def test_stream(self):
+        for fun in ["minmaxnorm", "zscore"]:
+            comparison = """{"params":[{"params":["unit_sales","benchmark.unit_sales"],"fun":"difference"}], "fun":"%s"}""" % fun
+            for labeling_schema in ["quartiles", "(0,0.5,worse);(0.5,Infinity,better)"]:
+                args = ["siblingnaive", "0", comparison, "sibling", "(product_subcategory,=,['Wine'])", "unit_sales", self.cube_sibling, labeling_schema, "JOININMEMORY"]
+                X = assess(self.path, *args).round(decimals=1)
+                with tempfile.TemporaryDirectory() as d:
+                    cardinality = assess_stream(self.path, *args, d + "/enriched.csv", chunksize=5)
+                    S = pd.read_csv(d + "/enriched.csv")
+                self.assertEqual(len(X.index), cardinality)
+                self.assertTrue(list(X.columns) == list(S.columns), S)
+                self.assertTrue(list(X["model_labeling"].astype(object).fillna("")) == list(S["model_labeling"].fillna("")), S)
+                self.assertTrue(np.allclose(X[fun + "_2"], S[fun + "_2"]), S)
+
+    def test_stream_ranks(self):
+        a = pd.Series(np.random.RandomState(0).randint(0, 5, 103).astype(float))
+        a[[3, 50]] = np.nan
+        chunks = [a.iloc[i:i + 10] for i in range(0, len(a.index), 10)]
+        for fun, labels in [("percentile", percentile(a)), ("quartiles", quartile(a))]:
+            chunk_stats, merge, finalize, apply = stream_functions[fun]
+            s = chunk_stats(chunks[0])
+            for X in chunks[1:]:
+                s = merge(s, chunk_stats(X))
+            self.assertEqual(list(s[0]), [0, 1, 2, 3, 4])  # only the distinct values are kept
+            s = finalize(s)
+            for _ in range(2):  # a new pass restarts from the first chunk
+                S = pd.concat([apply(X, s) for X in chunks])
+                self.assertEqual(list(labels.astype(object).fillna("")), list(S.astype(object).fillna("")))
+
+    def test_moments(self):
+        np.random.seed(0)
+        X = pd.DataFrame(np.random.normal(size=(1000, 3)) * [1, 10, 100], columns=["a", "b", "c"])
+        X.loc[[3, 7], "b"] = np.nan
+        s = moments.moments(X, size=64)  # merged chunk by chunk
+        self.assertTrue(np.allclose(moments.mean(s), X.mean()) and np.allclose(moments.std(s), X.std()))
+        self.assertTrue(np.allclose(s["min"], X.min()) and np.allclose(s["max"], X.max()) and list(s["count"]) == [1000, 998, 1000])
+        self.assertTrue(np.isclose(skew(X["a"]), scipy.stats.skew(X["a"])) and skew(X["a"] * 0 + 1) == 0)
+        self.assertTrue(np.allclose(zscore(X["c"]), scipy.stats.zscore(X["c"])))
+        self.assertTrue(np.allclose(minmaxnorm(X["c"]), (X["c"] - X["c"].min()) / (X["c"].max() - X["c"].min())))
+
     # def test_paper1(self):
     #     cube = self.cube_fixed
     #     session_step = "0"
@@ -1,5 +1,10 @@
+import argparse
+import glob
 import pandas as pd
+import sqlite3
+import tempfile
 import unittest
+import assess_ext
 from assess_ext import *
 
 
@@ -15,6 +20,9 @@ class TestAssess(unittest.TestCase):
         X.columns = ["category", "quantity", "RUSSIA", "RUSSIA_population", "FRANCE", "FRANCE_population"]
         res = compute_auto_benchmarks(X, k, measure, byclause)
         self.assertTrue(len(res) == 2)
+        for Z, sibling in res:
+            self.assertTrue(list(Z.columns) == ["category", "quantity", "bc_quantity", "bc_quantity_population", "comparison"], Z)
+            self.assertTrue(Z["comparison"].equals(X[measure] - X[sibling]), Z)
 
         res = compute_auto_using(res[0][0], k, measure, byclause)
         self.assertTrue(len(res) == 3)
@@ -22,6 +30,120 @@ class TestAssess(unittest.TestCase):
         res = compute_auto_labels(res[0][0], k, measure, byclause, using)
         self.assertTrue(len(res) == 2)
 
+    def test_kendall_tau(self):
+        def kendall_tau_naive(values1, values2):
+            n = len(values1)
+            i, j = np.meshgrid(np.arange(n), np.arange(n))
+            a = np.argsort(values1)
+            b = np.argsort(values2)
+            return np.logical_or(np.logical_and(a[i] < a[j], b[i] > b[j]), np.logical_and(a[i] > a[j], b[i] < b[j])).sum()
+
+        np.random.seed(0)
+        X = np.random.randint(0, 4, size=(4, 37))
+        D = kendall_tau_matrix(X)
+        for i in range(len(X)):
+            for j in range(len(X)):
+                self.assertEqual(kendall_tau_naive(X[i], X[j]), D[i, j])
+        self.assertEqual(3, count_inversions(np.array([2, 0, 3, 1])))
+
+    def test_diversify(self):
+        X = np.array([[x] for x in range(11)])
+        self.assertTrue(farthest_points(X, 3) == [5, 0, 10])
+        Y = pd.DataFrame(np.random.RandomState(0).normal(size=(100, 4)), columns=["A", "B", "C", "D"])
+        S = sketch(Y, ["A", "B", "C", "D"], size=8, chunksize=30)
+        self.assertTrue(S.shape == (4, 8))
+        self.assertTrue(np.array_equal(S, sketch(Y, ["A", "B", "C", "D"], size=8, chunksize=30)))
+        size = assess_ext.sketch_size
+        assess_ext.sketch_size = 4  # the settings are read at call time
+        try:
+            self.assertTrue(sketch(Y, ["A", "B"]).shape == (2, 4))
+        finally:
+            assess_ext.sketch_size = size
+
+    def test_read_sql(self):
+        connection = database.connect({"backend": "sqlite", "path": ":memory:"})
+        connection.execute("create table cube (country text, quantity integer, price real, discount integer)")
+        connection.executemany("insert into cube values (?, ?, ?, ?)", [(None if i % 7 == 0 else "c" + str(i % 5), i, i / 3, None if i % 3 == 0 else i) for i in range(250)])
+        sql = "select * from cube"
+        pd.testing.assert_frame_equal(pd.read_sql(sql, connection).round(5).fillna(0), database.read_sql(sql, connection, decimals=5, fill=0, size=16))
+        pd.testing.assert_frame_equal(pd.read_sql(sql, connection), database.read_sql(sql, connection, size=16))
+        with database.connection({"backend": "sqlite", "path": ":memory:"}) as c:
+            self.assertTrue(c is connection)
+        self.assertTrue(len(database.read_sql(sql, connection).index) == 250)  # shared connections are kept open
+        c = sqlite3.connect(":memory:")
+        database.release(c)  # the others are closed
+        self.assertRaises(sqlite3.ProgrammingError, c.execute, "select 1")
+
+    def test_store(self):
+        X = pd.DataFrame({"category": ["a", "b", "c"], "quantity": [1.5, 2.0, 3.25], "count": [1, 2, 3]})
+        X["label"] = compute_label(X.assign(comparison=X["quantity"]), "quartile")["label"]
+        with tempfile.TemporaryDirectory() as folder:
+            file = store.path(folder, "0", "select * from cube")
+            self.assertTrue(store.get(file) is None)
+            store.write(X, file)
+            self.assertTrue(file == store.path(folder, "0", "select * from cube") != store.path(folder, "1", "select * from cube"))
+            pd.testing.assert_frame_equal(X, store.get(file))
+            # descriptors point to the stored cube, older descriptors embed the records
+            with open(os.path.join(folder, "new.json"), "w") as f:
+                json.dump({"data": os.path.basename(file)}, f)
+            pd.testing.assert_frame_equal(X, read_descriptor(os.path.join(folder, "new.json")))
+            with open(os.path.join(folder, "old.json"), "w") as f:
+                json.dump({"raw": json.loads(X.drop(columns=["label"]).to_json(orient="records"))}, f)
+            pd.testing.assert_frame_equal(X.drop(columns=["label"]), read_descriptor(os.path.join(folder, "old.json")))
+
+    def test_sessions(self):
+        with tempfile.TemporaryDirectory() as folder:
+            credentials = {"backend": "sqlite", "path": os.path.join(folder, "cube.db")}
+            self.addCleanup(database.pools.pop, ("sqlite", credentials["path"]))
+            with database.connection(credentials) as connection:
+                connection.execute("create table cube (category text, quantity real)")
+                connection.execute("insert into cube values ('a', 1.5)")
+            self.addCleanup(setattr, assess_ext, "credentials", getattr(assess_ext, "credentials", None))
+            self.addCleanup(setattr, assess_ext, "args", getattr(assess_ext, "args", None))
+            assess_ext.credentials = credentials
+            files = []
+            for curid in range(store.max_stages + 2):  # each session stores its own cube
+                assess_ext.args = argparse.Namespace(path=os.path.join(folder, "out.json"), curid=curid)
+                self.assertTrue(len(assess_ext.read_sql("select * from cube").index) == 1)
+                files.append(store.path(folder, curid, "select * from cube"))
+                os.utime(files[-1], (curid, curid))  # in order of use
+            # only the cubes of the max_stages most recent sessions are kept
+            self.assertTrue([os.path.isfile(file) for file in files] == [False] * 2 + [True] * store.max_stages)
+            self.assertTrue(len(glob.glob(os.path.join(folder, "cube_*"))) == store.max_stages)
+
+    def test_memoize(self):
+        X = pd.DataFrame([["a", 1, 2, 3], ["b", 11, 12, 14], ["c", 21, 22, 20], ["d", 5, 1, 9]])
+        X.columns = ["category", "quantity", "bc_quantity", "bc_quantity_population"]
+        calls = []
+
+        def compute_auto_using_counted(Y, k, measure, byclause):
+            calls.append(k)
+            return compute_auto_using(Y, k, measure, byclause)
+
+        with tempfile.TemporaryDirectory() as folder:
+            expected = store.memoize(folder, compute_auto_using_counted, X, 2, "quantity", ["category"])
+            actual = store.memoize(folder, compute_auto_using_counted, X.copy(), 2, "quantity", ["category"])
+            self.assertTrue(calls == [2])  # the second run reuses the memoised stage
+            self.assertTrue([name for _, name in expected] == [name for _, name in actual])
+            for (Z, _), (W, _) in zip(expected, actual):
+                pd.testing.assert_frame_equal(Z, W)
+            store.memoize(folder, compute_auto_using_counted, X.assign(quantity=X["quantity"] + 1), 2, "quantity", ["category"])
+            store.memoize(folder, compute_auto_using_counted, X, 3, "quantity", ["category"])
+            self.assertTrue(calls == [2, 2, 3])  # a different cube or different parameters are recomputed
+            Z = store.memoize(folder, compute_label, expected[0][0], "quartile")
+            pd.testing.assert_frame_equal(Z, store.memoize(folder, compute_label, expected[0][0], "quartile"))
+            store.memoize(folder, compute_auto_using_counted, X, 2, "quantity", ["category"], settings={"seed": 1})
+            self.assertTrue(calls == [2, 2, 3, 2])  # as well as different settings
+            for version in ["1", "1", "2"]:  # and a different code of the modules the stage depends on
+                with open(os.path.join(folder, "stage" + version + ".py"), "w") as f:
+                    f.write("version = " + version)
+                store.memoize(folder, compute_auto_using_counted, X, 2, "quantity", ["category"], sources=[os.path.join(folder, "stage" + version + ".py")])
+            self.assertTrue(calls == [2, 2, 3, 2, 2, 2])
+            os.utime(glob.glob(os.path.join(folder, "stage_compute_label_*.json"))[0], (0, 0))  # the least recently used
+            store.evict(folder, keep=5)
+            self.assertTrue(len(glob.glob(os.path.join(folder, "stage_*.json"))) == 5)
+            self.assertTrue(glob.glob(os.path.join(folder, "stage_compute_label_*")) == [])
+
 
 if __name__ == '__main__':
     unittest.main()
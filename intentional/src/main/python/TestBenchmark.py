@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import unittest
+
+import benchmark as engine
+import describe
+import profiling
+import pstats
+import tracing
+from gen_cube import *
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_powers(self):
+        df = powers(1000, seed=0)
+        self.assertEqual(list(df.columns), ["A"] + ["p({})".format(i) for i in range(1, 10)])
+        self.assertTrue(np.allclose(df["p(3)"], df["A"].apply(lambda x: x ** (1.0 / 3))))
+
+    def test_cube(self):
+        X = cube(10000, members=4, granularity="week", correlation=0.9, measures=3)
+        self.assertEqual(list(X.columns), ["member", "week", "m0", "m1", "m2"])
+        self.assertEqual(len(X.index), 10000)
+        self.assertEqual(X["member"].nunique(), 4)
+        self.assertFalse(X.duplicated(["member", "week"]).any())
+        # the measures share the common factor
+        C = X[["m0", "m1", "m2"]].corr().to_numpy()
+        self.assertTrue(np.allclose(C[np.triu_indices(3, 1)], 0.81, atol=0.05), C)
+        # week values are parsed back by the operators
+        self.assertEqual(pd.to_datetime(X["week"] + '-1', format='%Y-%W-%w').nunique(), 2500)
+        X = cube(10000, members=4, sparsity=0.3, correlation=0)
+        self.assertTrue(6500 < len(X.index) < 7500)
+        self.assertTrue(pd.to_datetime(X["date"], format='%Y-%m-%d').notnull().all())
+        self.assertTrue(cube(100, members=12)["member"].str.len().eq(3).all())  # M00, ..., M11
+
+    def test_benchmark(self):
+        report = engine.benchmark([500, 1000], ["assess", "assess_ext", "explain", "describe"])
+        self.assertEqual(len(report["runs"]), 8)
+        for run in report["runs"]:
+            self.assertIsNone(run["error"], run)
+            self.assertTrue(run["wall"] >= 0 and len(run["stages"]) > 0, run)
+            self.assertTrue(run["peak_rss"] is None or run["peak_rss"] > 0)
+        res = engine.compare(report, report)
+        self.assertEqual(len(res.index), 8)
+        self.assertTrue((res["wall_ratio"].dropna() == 1).all())
+
+    def test_tracing(self):
+        tracing.reset()
+        with tracing.span("off"):  # not kept unless tracing is enabled
+            pass
+        self.assertEqual(tracing.spans, [])
+        self.addCleanup(setattr, tracing, "enabled", tracing.enabled)
+        tracing.enabled = True
+
+        @tracing.span("inner")
+        def inner(n):
+            return np.ones(n).sum()
+
+        tracemalloc.start()
+        try:
+            with tracing.span("outer", rows=10) as s:
+                a = np.ones(10 ** 6)
+                inner(4 * 10 ** 6)
+                del a
+        finally:
+            tracemalloc.stop()
+        self.assertEqual([r["name"] for r in tracing.spans], ["inner", "outer"])
+        inner, outer = tracing.spans
+        self.assertEqual((inner["parent"], inner["depth"], outer["parent"], outer["depth"], outer["rows"]), ("outer", 1, None, 0, 10))
+        self.assertTrue(outer["wall"] >= inner["wall"] >= 0 and outer["cpu"] >= 0)
+        # the peak of the outer span includes the peak of the inner one, on top of its own array
+        self.assertTrue(32e6 <= inner["memory"] < 33e6, inner)
+        self.assertTrue(40e6 <= outer["memory"] < 41e6, outer)
+        with tempfile.TemporaryDirectory() as folder:
+            tracing.write(os.path.join(folder, "trace.json"))
+            with open(os.path.join(folder, "trace.json")) as f:
+                events = json.load(f)["traceEvents"]
+            self.assertEqual([(e["name"], e["ph"]) for e in events], [("inner", "X"), ("outer", "X")])
+            self.assertTrue(events[1]["ts"] <= events[0]["ts"] and events[0]["dur"] <= events[1]["dur"])
+            tracing.write(os.path.join(folder, "trace.jsonl"))
+            with open(os.path.join(folder, "trace.jsonl")) as f:
+                self.assertEqual([json.loads(l)["name"] for l in f], ["inner", "outer"])
+        # the operators trace their stages, and report the times of the spans
+        tracing.reset()
+        X = cube(1000, measures=2)
+        _, _, stats = describe.describe(X, ["m0", "m1"], ["skyline", "top-k"], k=3)
+        self.assertEqual([(r["name"], r["depth"]) for r in tracing.spans], [("zscore", 1), ("skyline", 1), ("top-k", 1), ("describe", 0)])
+        self.assertEqual([x[3] for x in stats], [round(r["wall"]) for r in tracing.spans[1:3]])
+        tracing.reset()
+
+    def test_profiling(self):
+        X = cube(1000, measures=2)
+        with tempfile.TemporaryDirectory() as folder:
+            prefix = profiling.prefix(folder + os.sep, "cube", 1, "e1")
+            profiling.start(memory=True)
+            describe.describe(X, ["m0", "m1"], ["skyline", "top-k"], k=3)
+            files = profiling.stop(prefix)
+            self.assertEqual(files, [prefix + x for x in [".prof", "_prof.txt", "_alloc.txt"]])
+            self.assertEqual(os.path.basename(prefix), "cube_1_e1")
+            functions = [f for _, _, f in pstats.Stats(files[0]).stats.keys()]
+            self.assertIn("describe", functions)
+            self.assertIn("skyline", functions)
+            with open(files[2]) as f:
+                stages = [l.split(" ")[1] for l in f if l.startswith("###")]
+            self.assertEqual(stages, ["zscore", "skyline", "top-k", "describe", "end"])
+            # without memory, only the profile is written and nothing is left installed
+            profiling.start()
+            describe.describe(X, ["m0", "m1"], ["top-k"], k=3)
+            self.assertEqual(len(profiling.stop(prefix)), 2)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(tracing.listeners, [])
+        self.assertIsNone(profiling.profiler)
+        tracing.reset()
+
+
+if __name__ == '__main__':
+    unittest.main()
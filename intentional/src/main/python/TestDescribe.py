@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import scipy.stats
+import unittest
+
+import describe as engine
+from clustering import *
+from describe import *
+from skyline import *
+
+
+class TestDescribe(unittest.TestCase):
+
+    def test_skyline(self):
+        rng = np.random.default_rng(0)
+        for n in [1, 2, 10, 100, 500]:
+            for d in [1, 2, 3, 4]:
+                X = rng.integers(0, 5, size=(n, d)).astype(float)  # many ties
+                self.assertTrue((skyline(X) == is_pareto_efficient_simple(X)).all(), X)
+                X[0, 0] = np.nan
+                self.assertTrue((skyline(X) == is_pareto_efficient_simple(X)).all(), X)
+        for distribution in ["independent", "correlated", "anticorrelated"]:
+            X = generate(distribution, 2000, 3)
+            self.assertTrue((skyline(X) == is_pareto_efficient_simple(X)).all(), distribution)
+            self.assertTrue((sort_filter(X, block=7) == is_pareto_efficient_simple(X)).all(), distribution)
+
+    def test_select_k(self):
+        self.assertTrue(kneedle([2, 3, 4, 5], [100, 20, 15, 12]) == 3)
+        self.assertTrue(kneedle([2, 3, 4, 5], [10, 10, 10, 10]) is None)
+        rng = np.random.default_rng(0)
+        centers = np.array([[0, 0], [10, 10], [0, 10], [10, 0]])
+        X = np.concatenate([c + rng.normal(scale=0.5, size=(500, 2)) for c in centers])
+        k, model, clusters = select_k(X, [2, 3, 4, 5, 6, 7], sample=400)  # fitted on a sample, applied to all the cells
+        self.assertTrue(k == 4 and model.n_clusters == 4)
+        self.assertTrue(len(clusters) == len(X) and len(set(clusters[:500])) == 1 and len(set(clusters)) == 4)
+
+    def test_describe(self):
+        measures = ["m0", "m1", "m2"]
+        X = synthetic_cube(200, measures)
+        Y, P, stats = describe(X, measures, ["top-k", "skyline", "clustering", "outliers"], k=3, compute_property=True)
+        self.assertTrue(list(Y.columns) == list(X.columns) + ["zscore_" + m for m in measures] + ["model_clustering", "model_outliers", "model_skyline"] + ["model_top_" + m for m in measures])
+        self.assertTrue([x[1] for x in stats] == ["clustering", "outliers", "skyline", "top-k"])  # models are applied in a fixed order
+        self.assertTrue(len(set(Y["model_clustering"])) == 3 and 0 < Y["model_outliers"].sum() <= 3)
+        self.assertTrue((Y["model_skyline"] == skyline(X[measures].to_numpy())).all())
+        for m in measures:
+            self.assertTrue(Y["model_top_" + m].sum() == 3 and Y[Y["model_top_" + m]][m].min() >= Y[~Y["model_top_" + m]][m].max())
+        self.assertTrue(list(P.columns) == ["model", "component", "property", "value"])
+        self.assertTrue(P[P["model"] == "model_top_m0"]["component"].tolist() == ["True", "False"])
+        self.assertTrue("zscore_m0" not in X.columns)  # the input cube is not modified
+        self.assertRaises(ValueError, describe, X.head(0), measures, ["top-k"])
+        X.loc[5, "m1"] = np.nan  # the z-scores of a measure with missing values are zero, as with stats.zscore
+        Y, _, _ = describe(X, measures, [])
+        for m in measures:
+            self.assertTrue(Y["zscore_" + m].tolist() == np.around(np.nan_to_num(scipy.stats.zscore(X[m]), 0), decimals=3).tolist())
+        self.assertTrue((Y["zscore_m1"] == 0).all() and (Y["zscore_m0"] != 0).any())
+
+    def test_top_k(self):
+        X = pd.DataFrame({"m": [1, 3, 3, 3, 2, np.nan], "n": [5, 4, 3, 2, 1, 0]})
+        Y, P, _ = describe(X, ["m", "n"], ["top-k", "bottom-k"], k=2, compute_property=True)
+        # exactly k cells, ties are broken by position
+        self.assertTrue(Y["model_top_m"].tolist() == [False, True, True, False, False, False])
+        self.assertTrue(Y["model_bottom_m"].tolist() == [True, False, False, False, True, False])
+        self.assertTrue(Y["model_top_n"].tolist() == [True, True, False, False, False, False])
+        selected = P[(P["model"] == "model_top_n") & (P["component"] == "True")]["value"].iloc[0]
+        self.assertTrue(selected == round(Y[Y["model_top_n"]]["zscore_n"].mean(), 2))
+        Y, _, _ = describe(X, ["m"], ["top-k"], k=6)
+        self.assertTrue(Y["model_top_m"].all())  # missing values come last, as in nlargest
+
+    def test_outliers(self):
+        X = synthetic_cube(1000, ["m0", "m1"])
+        X.loc[[10, 500], ["m0", "m1"]] = [[50, 50], [-40, 60]]
+        self.addCleanup(setattr, engine, "outliers_sample", engine.outliers_sample)
+        self.addCleanup(setattr, engine, "outliers_chunksize", engine.outliers_chunksize)
+        for sample, chunksize in [(100000, 100000), (300, 128)]:  # trained on a subsample and scored in chunks
+            engine.outliers_sample, engine.outliers_chunksize = sample, chunksize
+            Y, P, _ = describe(X, ["m0", "m1"], ["outliers"], k=2, compute_property=True)
+            self.assertTrue(Y.index[Y["model_outliers"]].tolist() == [10, 500])
+            self.assertTrue(P["property"].tolist() == ["outlierness", "outlierness"] and P["value"].iloc[0] < 0 < P["value"].iloc[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
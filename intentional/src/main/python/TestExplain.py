@@ -1,4 +1,7 @@
+import numpy as np
+import os
 import pandas as pd
+import tempfile
 import unittest
 
 from explain import *
@@ -165,7 +168,15 @@ class TestExplain(unittest.TestCase):
 
     time_series_df = pd.DataFrame(time_series, columns=["t0","t1","t2","t3","t4","rnd","lin"])
  
+    def in_temporary_folder(self):
+        """ Run the test in a temporary folder, so the plots saved by fit_all stay out of the source tree """
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(folder.name)
+
     def test1(self): 
+        self.in_temporary_folder()
         foodmart_df = pd.DataFrame(self.foodmart_data, columns=["Type", "Cost", "Quantity", "Revenue"]) 
         X, P, ax, fig, axe, fige = fit_all(foodmart_df, "Revenue", ["Quantity", "Cost"], plt_all=True) 
         # fig.savefig('example.pdf') 
@@ -177,6 +188,7 @@ class TestExplain(unittest.TestCase):
         self.assertTrue(P[(P["component"] == 'Cost') & (P["property"] == "degree")]["value"].iloc[0] == 2)
 
     def test2(self):
+        self.in_temporary_folder()
         full_foodmart_df = pd.DataFrame(self.full_foodmart, columns=["Type", "Revenue", "Quantity", "Cost"])
         X, P, ax, fig, axe, fige = fit_all(full_foodmart_df, "Revenue", ["Quantity", "Cost"], plt_all=True)
         self.assertTrue(full_foodmart_df.equals(X), X)
@@ -233,5 +245,42 @@ class TestExplain(unittest.TestCase):
         _, P, _, _, _, _ = time_series_fit(pd.read_csv('trend_by_species_clean.csv'), "#Adults", ["#SmallInstars", "#LargeInstars"])
         self.assertTrue(P["model"].nunique() == 1)
 
+    def test11(self):
+        np.random.seed(0)
+        y = np.random.normal(size=500).cumsum()
+        df = pd.DataFrame({"y": y, "x": np.roll(y, -30), "z": np.roll(y, 20)})
+        _, P, _, _, _, _ = time_series_fit(df, "y", ["x", "z"])
+        self.assertTrue(P[P["property"] == "lag"]["value"].tolist() == [30, -20], P)
+        self.assertTrue(P[P["property"] == "r2"]["value"].min() > 0.99, P)
+        _, P, _, _, _, _ = time_series_fit(df, "y", ["x", "z"], max_lag=10)  # lags are searched within max_lag
+        self.assertTrue(P[P["property"] == "lag"]["value"].abs().max() <= 10, P)
+
+    def test12(self):
+        np.random.seed(0)
+        x = np.random.normal(size=200) * 100 + 1000
+        y = 3 * x ** 2 - x + np.random.normal(size=200) * 1000
+        for i, z in enumerate(polyfits(x, y, 6)):  # all the degrees from a single factorization
+            self.assertTrue(np.allclose(z, np.polyfit(x, y, i), rtol=1e-6), (i, z))
+        for i, z in enumerate(polyfits([1, 1, 2], [1, 2, 3], 4)):  # rank deficient
+            self.assertTrue(np.allclose(z, np.polyfit([1, 1, 2], [1, 2, 3], i)), (i, z))
+
+    def test13(self):
+        measures = ["Quantity", "Cost"]
+        using = ["Polyfit", "CrossCorrelation", "Multireg"]
+        P, stats = run(self.full_foodmart_df, "Revenue", measures, using)
+        Q, pstats = run(self.full_foodmart_df, "Revenue", measures, using, n_jobs=2)  # (model, measure) tasks on a process pool
+        self.assertTrue(P.astype(str).equals(Q.astype(str)), Q)
+        self.assertTrue([x[1] for x in stats] == [x[1] for x in pstats] == using)
+        self.assertRaises(ValueError, run, self.full_foodmart_df, "Revenue", measures, ["Foo"], -1, 2)
+
+    def test14(self):
+        np.random.seed(0)
+        X = pd.DataFrame(np.random.normal(size=(300, 6)), columns=["a", "b", "c", "d", "e", "f"])
+        X["y"] = 3 * X["a"] - 2 * X["d"] + np.random.normal(size=300)
+        _, P, _, _, _, _ = multiple_regression_fit(X, "y", ["a", "b", "c", "d", "e", "f"], strategy="gram")
+        _, Q, _, _, _, _ = multiple_regression_fit(X, "y", ["a", "b", "c", "d", "e", "f"], strategy="rfecv")
+        self.assertTrue(P.astype(str).equals(Q.astype(str)), (P, Q))
+        self.assertTrue(np.array_equal(gram_rfecv(X[["a", "b", "c"]], X["y"]), RFECV(LinearRegression(), step=1, cv=3).fit(X[["a", "b", "c"]], X["y"]).support_))
+
 if __name__ == '__main__':
     unittest.main()
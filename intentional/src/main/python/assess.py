@@ -6,9 +6,12 @@ import numpy as np
 import pandas as pd
 import time
 from datetime import datetime
-from scipy.stats import zscore
 from sklearn.linear_model import LinearRegression
 import sys
+import labeling
+import moments
+import profiling
+import tracing
 
 ###############################################################################
 # FUNCTIONS
@@ -29,27 +32,36 @@ def reldifference(a, b):
     return (a - b) / (b + 1)
 
 
+def per_column(a, values):
+    """ Statistic of the Series a (or of each column of the DataFrame a) """
+    return values[0] if a.ndim == 1 else pd.Series(values, index=a.columns)
+
+
+def like(a, values):
+    """ Wrap the values into a Series (or DataFrame) aligned with a """
+    if a.ndim == 1:
+        return pd.Series(values, index=a.index, name=a.name)
+    return pd.DataFrame(values, index=a.index, columns=a.columns)
+
+
 def skew(a):
-    from scipy.stats import skew
-    return np.nan_to_num(skew(a), 0)
+    return np.nan_to_num(per_column(a, moments.skew(moments.moments(a))), 0)
 
 
 def avg(a):
-    return a.mean()
+    return per_column(a, moments.mean(moments.moments(a)))
 
 
 def std(a):
-    return np.nan_to_num(a.std(), 0)
+    return np.nan_to_num(per_column(a, moments.std(moments.moments(a))), 0)
 
 
 def minmaxnorm(a):
-    minv = a.min()
-    maxv = a.max()
-    return (a - minv) / (maxv - minv)
+    return like(a, moments.minmaxnorm(a, moments.moments(a)))
 
 
 def zscore(a):
-    return a.apply(zscore)
+    return like(a, moments.zscore(a, moments.moments(a)))
 
 
 # def likert(a):
@@ -57,18 +69,16 @@ def zscore(a):
 
 
 def likert3(a):
-    q = 3  # min(len(a.unique()), 3)
-    return pd.cut(a, bins=q, labels=["1-*", "2-**", "3-***"])
+    return labeling.equal_width(a, 3, labeling.likert[3])
 
 
 def likert5(a):
-    q = 5  # min(len(a.unique()), 5)
-    return pd.cut(a, bins=q, labels=["1-*", "2-**", "3-***", "4-****", "5-*****"])
+    return labeling.equal_width(a, 5, labeling.likert[5])
 
 
 def cut_values(a, q=10):
-    q = min(len(a.unique()), q)
-    return pd.cut(a, bins=q, labels=[str(x + 1) for x in range(q)])
+    q = min(a.nunique(dropna=False), q)
+    return labeling.equal_width(a, q, labeling.ordinal_dtype(q))
 
 
 def quartile(a):
@@ -77,63 +87,39 @@ def quartile(a):
 
 def percentile(a, q=100):
     q = min(len(a.index), q)
-    return pd.qcut(a.rank(method='first'), q=q, labels=[str(x + 1) + "Q" for x in range(q)])
+    return labeling.rank_quantiles(a, q, labeling.ordinal_dtype(q, "Q"))
 
 
 def fixedratio2(a):
-    bins = pd.IntervalIndex.from_tuples([(-float("inf"), 1), (1, float("inf"))])
-    d = dict(zip(bins, ["1-lower", "2-higher"]))
-    x = pd.cut(a, bins).map(d)
-    return x
+    return labeling.cut(a, labeling.fixed["fixedratio2"])
 
 
 def fixedratio3(a):
-    bins = pd.IntervalIndex.from_tuples([(-float("inf"), 0.9), (0.9, 1.1), (1.1, float("inf"))])
-    d = dict(zip(bins, ["1-lower", "2-same", "3-higher"]))
-    x = pd.cut(a, bins).map(d)
-    return x
+    return labeling.cut(a, labeling.fixed["fixedratio3"])
 
 
 def fixedratio5(a):
-    bins = pd.IntervalIndex.from_tuples([(-float("inf"), 0.5), (0.5, 0.9), (0.9, 1.1), (1.1, 2), (2, float("inf"))])
-    d = dict(zip(bins, ["1-quite lower", "2-lower", "3-same", "4-higher", "5-quite higher"]))
-    x = pd.cut(a, bins).map(d)
-    return x
+    return labeling.cut(a, labeling.fixed["fixedratio5"])
 
 
 def fixeddiff2(a):
-    bins = pd.IntervalIndex.from_tuples([(-float("inf"), 0), (0, float("inf"))])
-    d = dict(zip(bins, ["1-lower", "2-higher"]))
-    x = pd.cut(a, bins).map(d)
-    return x
+    return labeling.cut(a, labeling.fixed["fixeddiff2"])
 
 
 def fixedrel3(a):
-    bins = pd.IntervalIndex.from_tuples([(-float("inf"), -0.1), (-0.1, 0.1), (0.1, float("inf"))])
-    d = dict(zip(bins, ["1-lower", "2-same", "3-higher"]))
-    x = pd.cut(a, bins).map(d)
-    return x
+    return labeling.cut(a, labeling.fixed["fixedrel3"])
 
 
 def fixedrel5(a):
-    bins = pd.IntervalIndex.from_tuples([(-float("inf"), -0.5), (-0.5, -0.1), (-0.1, 0.1), (0.1, 0.5), (0.5, float("inf"))])
-    d = dict(zip(bins, ["1-quite lower", "2-lower", "3-same", "4-higher", "5-quite higher"]))
-    x = pd.cut(a, bins).map(d)
-    return x
+    return labeling.cut(a, labeling.fixed["fixedrel5"])
 
 
 def fixeddiff3(a):
-    bins = pd.IntervalIndex.from_tuples([(-float("inf"), -5000), (-5000, 5000), (5000, float("inf"))])
-    d = dict(zip(bins, ["1-lower", "2-same", "3-higher"]))
-    x = pd.cut(a, bins).map(d)
-    return x
+    return labeling.cut(a, labeling.fixed["fixeddiff3"])
 
 
 def fixeddiff5(a):
-    bins = pd.IntervalIndex.from_tuples([(-float("inf"), -50000), (-50000, -5000), (-5000, 5000), (5000, 50000), (50000, float("inf"))])
-    d = dict(zip(bins, ["1-quite lower", "2-lower", "3-same", "4-higher", "5-quite higher"]))
-    x = pd.cut(a, bins).map(d)
-    return x
+    return labeling.cut(a, labeling.fixed["fixeddiff5"])
 
 # lookup table for the implemented functions, new functions MUST be added here
 functions = {
@@ -186,26 +172,29 @@ toprint = {
 }
 
 def compute_benchmark_pivot(path, file, session_step, measure, benchmark_type, benchmark):
-    Y = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+    with tracing.span("read") as s:
+        Y = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+        s.rows = len(Y.index)
     Y.columns = [x.lower().replace("bc_", "benchmark.") for x in Y.columns]
     toprint["cardinality_benchmark"] = len(Y.index)
     if benchmark_type == "past":
-        start_time = datetime.now()
-        gc = sorted([x for x in Y.columns if "benchmark." in x])
-        def regression(X):
-            model = LinearRegression()
-            model.fit([[int(x.replace("benchmark.", ""))] for x in gc if not math.isnan(X[x])], [X[x] for x in gc if not math.isnan(X[x])])
-            return model.predict([[int(benchmark) + 1]])[0] # put the dates of which you want to predict kwh here
-        Y["benchmark." + measure] = Y.apply(lambda x: regression(x), axis=1)
-        Y = Y.drop(columns=[x for x in Y.columns if "level_" in x])
-        elapsed = datetime.now() - start_time
-        toprint["time_transform"] = elapsed.seconds * 1000 + int(elapsed.microseconds / 1000)
+        with tracing.span("transform", rows=len(Y.index)) as s:
+            gc = sorted([x for x in Y.columns if "benchmark." in x])
+            def regression(X):
+                model = LinearRegression()
+                model.fit([[int(x.replace("benchmark.", ""))] for x in gc if not math.isnan(X[x])], [X[x] for x in gc if not math.isnan(X[x])])
+                return model.predict([[int(benchmark) + 1]])[0] # put the dates of which you want to predict kwh here
+            Y["benchmark." + measure] = Y.apply(lambda x: regression(x), axis=1)
+            Y = Y.drop(columns=[x for x in Y.columns if "level_" in x])
+        toprint["time_transform"] = int(s.wall)
     if Y.empty:
         raise Exception('Empty benchmark cube')
     return Y
 
 def compute_benchmark_joinindbms(path, file, session_step, measure, benchmark_type, cube):
-    Y = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+    with tracing.span("read") as s:
+        Y = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+        s.rows = len(Y.index)
     Y.columns = [x.lower().replace("bc_", "benchmark.") for x in Y.columns]
     if benchmark_type == "past":
         sc = [x for x in cube["SC"] if x["SLICE"] and x["SLICE"]][0]
@@ -216,71 +205,72 @@ def compute_benchmark_joinindbms(path, file, session_step, measure, benchmark_ty
         slice = datetime.strptime(val, date_format)
         # cast all dates to datetime format
         Y["benchmark." + attr] = Y["benchmark." + attr].apply(lambda x: time.mktime(datetime.strptime(x, date_format).timetuple()))
-        start_time = datetime.now()
-        def regression(X):
-            model = LinearRegression()
-            model.fit(X["benchmark." + attr].values.reshape(-1, 1), X["benchmark." + measure].values)
-            return pd.DataFrame(model.predict([[time.mktime(slice.timetuple())]]), columns=["benchmark." + measure]) # put the dates of which you want to predict kwh here
-        gc = [x for x in Y.columns if "benchmark." not in x]
-        group_dff = Y.groupby(gc if len(gc) > 0 else lambda x: True)
-        Y = group_dff.apply(lambda X: regression(X)).reset_index()
-        Y = Y.drop(columns=[x for x in Y.columns if "level_" in x])
-        elapsed = datetime.now() - start_time
-        toprint["time_transform"] = elapsed.seconds * 1000 + int(elapsed.microseconds / 1000)
+        with tracing.span("transform", rows=len(Y.index)) as s:
+            def regression(X):
+                model = LinearRegression()
+                model.fit(X["benchmark." + attr].values.reshape(-1, 1), X["benchmark." + measure].values)
+                return pd.DataFrame(model.predict([[time.mktime(slice.timetuple())]]), columns=["benchmark." + measure]) # put the dates of which you want to predict kwh here
+            gc = [x for x in Y.columns if "benchmark." not in x]
+            group_dff = Y.groupby(gc if len(gc) > 0 else lambda x: True)
+            Y = group_dff.apply(lambda X: regression(X)).reset_index()
+            Y = Y.drop(columns=[x for x in Y.columns if "level_" in x])
+        toprint["time_transform"] = int(s.wall)
     return Y
 
 def compute_benchmark_joininmemory(path, file, session_step, X, measure, benchmark_type, benchmark, cube):
-    Y = pd.read_csv(path + file + "_bc_" + str(session_step) + ".csv", encoding="utf-8")
+    with tracing.span("read") as s:
+        Y = pd.read_csv(path + file + "_bc_" + str(session_step) + ".csv", encoding="utf-8")
+        s.rows = len(Y.index)
     Y.columns = ["benchmark." + x.lower() for x in Y.columns]
     if Y.empty:
         raise Exception('Empty benchmark cube')
     toprint["cardinality_benchmark"] = len(Y.index)
     join = []
 
-    start_time = datetime.now()
-    if benchmark_type == "target":
-        return X
-    elif benchmark_type == "sibling":
-        attr, op, val = benchmark[1:-1].split(",") # remove ( ) wrapping the triple (product,=,'FANTA')
-        # join all the attributes that are not measure and that are not the sibling
-        join = [x for x in cube["GC"] if x != attr]
-    elif benchmark_type == "past":
-        # get the temporal slice
-        sc = [x for x in cube["SC"] if x["SLICE"] and x["SLICE"]][0]
-        attr, val = sc["ATTR"], sc["VAL"][0].replace("'", "")
-        # set the date format
-        date_format = "%Y-%m" if "month" in attr else "%Y" if "year" in attr else "%Y-%m-%d"
-        # cast the slice value to datetime
-        slice = datetime.strptime(val, date_format)
-        # cast all dates to datetime format
-        Y["benchmark." + attr] = Y["benchmark." + attr].apply(lambda x: time.mktime(datetime.strptime(x, date_format).timetuple()))
-        # group cells by all attributes but the temporal one
-        gc = ["benchmark." + x for x in cube["GC"] if attr not in x]
-        group_dff = Y.groupby(gc if len(gc) > 0 else lambda x: True)
-        def regression(X):
-            model = LinearRegression()
-            model.fit(X["benchmark." + attr].values.reshape(-1, 1), X["benchmark." + measure].values)
-            return pd.DataFrame(model.predict([[time.mktime(slice.timetuple())]]), columns=["benchmark." + measure]) # put the dates of which you want to predict kwh here
-        Y = group_dff.apply(lambda X: regression(X)).reset_index()
-        Y["benchmark." + attr] = val
-        Y = Y.drop(columns=[x for x in Y.columns if "level_" in x])
-        join = cube["GC"]
-    elapsed = datetime.now() - start_time
-    toprint["time_transform"] = elapsed.seconds * 1000 + int(elapsed.microseconds / 1000)
-
-    start_time = datetime.now()
-    if len(join) > 0:
-        X = pd.merge(X, Y, left_on=join, right_on=["benchmark." + x for x in join])
-    else: # cartesian product
-        X["fake_key"] = "key"
-        Y["fake_key"] = "key"
-        X = pd.merge(X, Y, on=["fake_key"])
-        X = X[[x for x in X.columns if "fake_key" not in x]]
-    elapsed = datetime.now() - start_time
-    toprint["time_join"] = elapsed.seconds * 1000 + int(elapsed.microseconds / 1000)
+    with tracing.span("transform", rows=len(Y.index)) as s:
+        if benchmark_type == "target":
+            return X
+        elif benchmark_type == "sibling":
+            attr, op, val = benchmark[1:-1].split(",") # remove ( ) wrapping the triple (product,=,'FANTA')
+            # join all the attributes that are not measure and that are not the sibling
+            join = [x for x in cube["GC"] if x != attr]
+        elif benchmark_type == "past":
+            # get the temporal slice
+            sc = [x for x in cube["SC"] if x["SLICE"] and x["SLICE"]][0]
+            attr, val = sc["ATTR"], sc["VAL"][0].replace("'", "")
+            # set the date format
+            date_format = "%Y-%m" if "month" in attr else "%Y" if "year" in attr else "%Y-%m-%d"
+            # cast the slice value to datetime
+            slice = datetime.strptime(val, date_format)
+            # cast all dates to datetime format
+            Y["benchmark." + attr] = Y["benchmark." + attr].apply(lambda x: time.mktime(datetime.strptime(x, date_format).timetuple()))
+            # group cells by all attributes but the temporal one
+            gc = ["benchmark." + x for x in cube["GC"] if attr not in x]
+            group_dff = Y.groupby(gc if len(gc) > 0 else lambda x: True)
+            def regression(X):
+                model = LinearRegression()
+                model.fit(X["benchmark." + attr].values.reshape(-1, 1), X["benchmark." + measure].values)
+                return pd.DataFrame(model.predict([[time.mktime(slice.timetuple())]]), columns=["benchmark." + measure]) # put the dates of which you want to predict kwh here
+            Y = group_dff.apply(lambda X: regression(X)).reset_index()
+            Y["benchmark." + attr] = val
+            Y = Y.drop(columns=[x for x in Y.columns if "level_" in x])
+            join = cube["GC"]
+    toprint["time_transform"] = int(s.wall)
+
+    with tracing.span("join", rows=len(X.index)) as s:
+        if len(join) > 0:
+            X = pd.merge(X, Y, left_on=join, right_on=["benchmark." + x for x in join])
+        else: # cartesian product
+            X["fake_key"] = "key"
+            Y["fake_key"] = "key"
+            X = pd.merge(X, Y, on=["fake_key"])
+            X = X[[x for x in X.columns if "fake_key" not in x]]
+        s.rows = len(X.index)
+    toprint["time_join"] = int(s.wall)
 
     return X
 
+@tracing.span("assess")
 def assess(path, file, session_step, distance_function, benchmark_type, benchmark, measure, cube, labeling_schema, execution_plan):
     global toprint
     toprint["cardinality_benchmark"] = 0
@@ -292,14 +282,18 @@ def assess(path, file, session_step, distance_function, benchmark_type, benchmar
     # COMPUTE BENCHMARK
     ###############################################################################
     if benchmark_type.lower() == "target":
-        X = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+        with tracing.span("read") as s:
+            X = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+            s.rows = len(X.index)
         X.columns = [x.lower() for x in X.columns]
         toprint["cardinality"] = len(X.index)
     else:
         if execution_plan.upper() == "PIVOT" or execution_plan.upper() == "PIVOTMV":
             X = compute_benchmark_pivot(path, file, session_step, measure, benchmark_type, benchmark)
         elif execution_plan.upper() == "JOININMEMORY":
-            X = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+            with tracing.span("read") as s:
+                X = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+                s.rows = len(X.index)
             X.columns = [x.lower() for x in X.columns]
             toprint["cardinality"] = len(X.index)
             X = compute_benchmark_joininmemory(path, file, session_step, X, measure, benchmark_type, benchmark, json.loads(cube))
@@ -316,29 +310,24 @@ def assess(path, file, session_step, distance_function, benchmark_type, benchmar
     ###############################################################################
     # DISTANCE
     ###############################################################################
-    start_time = datetime.now()
-    if distance_function == "" or distance_function == "{}":
-        outer_key = measure
-    else:
-        using = json.loads(distance_function)
-        outer_key = evaluate(X, using["fun"], using["params"])
-        X = X[[x for x in X.columns if "benchmark." not in x]]
-    elapsed = datetime.now() - start_time
-    toprint["time_comparison"] = elapsed.seconds * 1000 + int(elapsed.microseconds / 1000)
+    with tracing.span("comparison", rows=cardinality_join) as s:
+        if distance_function == "" or distance_function == "{}":
+            outer_key = measure
+        else:
+            using = json.loads(distance_function)
+            outer_key = evaluate(X, using["fun"], using["params"])
+            X = X[[x for x in X.columns if "benchmark." not in x]]
+    toprint["time_comparison"] = int(s.wall)
 
     ###############################################################################
     # LABELING
     ###############################################################################
-    start_time = datetime.now()
-    if labeling_schema in functions:
-        X["model_labeling"] = functions[labeling_schema](X[outer_key])
-    else:
-        labels = [y[2] for y in [x[1:-1].split(",") for x in labeling_schema.split(";")]]
-        bins = [float(y[0]) for y in [x[1:-1].split(",") for x in labeling_schema.split(";")]]
-        bins.append(float(labeling_schema.split(";")[-1].split(",")[1]))
-        X["model_labeling"] = pd.cut(X[outer_key], bins=bins, labels=labels)
-    elapsed = datetime.now() - start_time
-    toprint["time_labeling"] = elapsed.seconds * 1000 + int(elapsed.microseconds / 1000)
+    with tracing.span("label", rows=cardinality_join) as s:
+        if labeling_schema in functions:
+            X["model_labeling"] = functions[labeling_schema](X[outer_key])
+        else:
+            X["model_labeling"] = labeling.cut(X[outer_key], labeling.parse_schema(labeling_schema))
+    toprint["time_labeling"] = int(s.wall)
 
     # orig_columns = X.columns
     # P = X["model_labeling"].value_counts().rename_axis('interval').reset_index(name='counts').sort_values(by=['interval'])
@@ -353,6 +342,233 @@ def assess(path, file, session_step, distance_function, benchmark_type, benchmar
         raise ValueError("Cardinality does not match, before: " + str(cardinality_join) + ", after: " + str(len(X.index)))
     return X
 
+###############################################################################
+# STREAMING ASSESS
+###############################################################################
+def value_counts(a):
+    """ Sorted distinct values of a chunk (NaN excluded) with their counts, and the number of rows of the chunk """
+    x = np.asarray(a, dtype=np.float64)
+    values, counts = np.unique(x[~np.isnan(x)], return_counts=True)
+    return values, counts, len(x)
+
+
+def merge_counts(s, t):
+    values, inverse = np.unique(np.concatenate([s[0], t[0]]), return_inverse=True)
+    return values, np.bincount(inverse, weights=np.concatenate([s[1], t[1]])).astype(np.int64), s[2] + t[2]
+
+
+def rank_stats(s, q):
+    """
+        s: distinct values of the column, their counts and the number of rows (see value_counts)
+        q: number of quantiles, as in percentile
+        return the global statistics of rank_chunk: the rank edges of the quantiles and the cells before each value
+    """
+    values, counts, rows = s
+    q = min(rows, q)
+    edges = np.quantile(np.arange(1, counts.sum() + 1, dtype=np.float64), np.linspace(0, 1, q + 1))
+    if len(np.unique(edges)) < len(edges) and len(edges) != 2:
+        raise ValueError("Bin edges must be unique: " + repr(edges))
+    return {"values": values, "before": np.cumsum(counts) - counts, "seen": np.zeros(len(values), dtype=np.int64),
+            "edges": edges, "dtype": labeling.ordinal_dtype(q, "Q")}
+
+
+def rank_chunk(a, s):
+    """
+        Label a chunk as percentile (rank_quantiles) labels the whole column. Ties are ranked by position, so the chunks
+        must come in order; s counts the cells of each value seen so far, and a pass restarts from the chunk at position 0
+    """
+    x = np.asarray(a, dtype=np.float64)
+    if len(x) > 0 and a.index[0] == 0:
+        s["seen"][:] = 0
+    valid = np.flatnonzero(~np.isnan(x))
+    ids = np.searchsorted(s["values"], x[valid])
+    order = np.argsort(ids, kind="stable")
+    occurrence = np.empty(len(ids), dtype=np.int64)  # previous cells of the same value within the chunk
+    occurrence[order] = np.arange(len(ids)) - np.searchsorted(ids[order], ids[order], side="left")
+    ranks = s["before"][ids] + s["seen"][ids] + occurrence + 1
+    s["seen"] += np.bincount(ids, minlength=len(s["values"]))
+    codes = np.full(len(x), -1, dtype=np.int64)
+    codes[valid] = labeling.bin_codes(ranks.astype(np.float64), s["edges"], include_lowest=True)
+    return labeling.to_series(codes, s["dtype"], a)
+
+
+# Whole-column functions need global statistics when the extended cube is
+# processed in chunks: (statistics of a chunk, merge two statistics,
+# finalize the merged statistics, apply the global statistics to a chunk)
+stream_functions = {
+    "minmaxnorm": (
+        moments.moments,
+        moments.merge,
+        lambda s: s,
+        lambda a, s: like(a, moments.minmaxnorm(a, s))),
+    "zscore": (
+        moments.moments,
+        moments.merge,
+        lambda s: s,
+        lambda a, s: like(a, moments.zscore(a, s))),
+    "percentile": (
+        value_counts,
+        merge_counts,
+        lambda s: rank_stats(s, 100),
+        rank_chunk),
+    "quartiles": (
+        value_counts,
+        merge_counts,
+        lambda s: rank_stats(s, 4),
+        rank_chunk),
+}
+
+
+def evaluate_chunk(X, fun, params, stats, partial):
+    """
+        X: chunk of the extended cube
+        fun: function id
+        params: list of parameters
+        stats: global statistics of the whole-column functions (by key)
+        partial: statistics of the whole-column functions gathered in the current pass (by key)
+        return the key of the last function, or None if it still misses some global statistics
+    """
+    par_n = 0 # id of the nested function, as in evaluate
+    def evaluate_1(fun, params):
+        nonlocal par_n
+        par_n += 1 # increase the id of the nested function
+        args = []
+        for p in params: # evaluate all the parameters to keep the ids aligned with evaluate
+            if isinstance(p, dict) and "fun" in p:
+                k = evaluate_1(p["fun"], p["params"])
+                args.append(None if k is None else X[k])
+            else: # if the parameter is a float or a string
+                try:
+                    X[str(p)] = float(p) # if its a float, I need to create a new column
+                    args.append(X[str(p)])
+                except (ValueError, TypeError): # otherwise, refer to an existing column using the function name
+                    args.append(X[p])
+        if any(x is None for x in args):
+            return None
+        return apply_chunk(X, fun + "_" + str(par_n), fun, args, stats, partial)
+    return evaluate_1(fun, params) # return the last key
+
+
+def apply_chunk(X, key, fun, args, stats, partial):
+    """ Apply fun to the chunk X and store the result in X[key]. Whole-column functions only gather their statistics until the global ones are known """
+    if fun in stream_functions:
+        chunk_stats, merge, _, apply = stream_functions[fun]
+        if key not in stats:
+            s = chunk_stats(*args)
+            partial[key] = (fun, s if key not in partial else merge(partial[key][1], s))
+            return None
+        X[key] = apply(*args, stats[key])
+    else:
+        X[key] = functions[fun](*args)
+    return key
+
+
+def compute_benchmark_hash(path, file, session_step, benchmark_type, benchmark, cube):
+    """ Load the benchmark cube and index it by the join attributes, so that the chunks of the target cube can probe it """
+    if benchmark_type == "target":
+        return None, None, []
+    Y = pd.read_csv(path + file + "_bc_" + str(session_step) + ".csv", encoding="utf-8")
+    Y.columns = ["benchmark." + x.lower() for x in Y.columns]
+    if Y.empty:
+        raise Exception('Empty benchmark cube')
+    toprint["cardinality_benchmark"] = len(Y.index)
+    attr, op, val = benchmark[1:-1].split(",") # remove ( ) wrapping the triple (product,=,'FANTA')
+    # join all the attributes that are not measure and that are not the sibling
+    join = [x for x in cube["GC"] if x != attr]
+    if len(join) == 0:
+        return Y, None, join
+    index = pd.MultiIndex.from_frame(Y[["benchmark." + x for x in join]])
+    if not index.is_unique:
+        raise ValueError("Duplicated keys in the benchmark cube: " + str(join))
+    return Y, index, join
+
+
+def probe(X, Y, index, join):
+    """ Join the chunk X with the benchmark cube Y, as pd.merge(X, Y) in compute_benchmark_joininmemory """
+    if Y is None:
+        return X
+    if len(join) == 0: # cartesian product
+        return pd.merge(X, Y, how="cross")
+    ids = index.get_indexer(pd.MultiIndex.from_frame(X[join]))
+    found = ids >= 0
+    X = X[found]
+    B = Y.iloc[ids[found]]
+    B.index = X.index
+    return pd.concat([X, B], axis=1)
+
+
+@tracing.span("assess")
+def assess_stream(path, file, session_step, distance_function, benchmark_type, benchmark, measure, cube, labeling_schema, execution_plan, output, chunksize=100000):
+    """
+        Chunked version of assess for extended cubes that do not fit in memory. The target cube is read in chunks
+        that probe the benchmark cube (kept in memory), are labeled and appended to output. Whole-column functions
+        (minmaxnorm, percentile, quartiles) first gather their global statistics, with one more pass on the target
+        cube for each level of nesting. Rows are written in the order of the target cube.
+        output: path of the enriched cube
+        return the cardinality of the extended cube
+    """
+    global toprint
+    toprint["cardinality_benchmark"] = 0
+    toprint["benchmark_type"] = benchmark_type
+    toprint["benchmark"] = benchmark.replace(",", ";")
+    if benchmark_type != "target" and not (benchmark_type == "sibling" and execution_plan.upper() == "JOININMEMORY"):
+        raise ValueError("Streaming is only supported for the target and the sibling (JOININMEMORY) plans")
+    for x in ["time_transform", "time_join", "time_comparison", "time_labeling", "cardinality_extcube"]:
+        toprint[x] = 0
+
+    with tracing.span("transform") as s:
+        Y, index, join = compute_benchmark_hash(path, file, session_step, benchmark_type, benchmark, json.loads(cube))
+    toprint["time_transform"] = int(s.wall)
+    using = None if distance_function == "" or distance_function == "{}" else json.loads(distance_function)
+    if labeling_schema not in functions:
+        schema = labeling.parse_schema(labeling_schema)
+
+    def chunks():
+        cardinality, offset = 0, 0
+        for X in pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8", chunksize=chunksize):
+            X.columns = [x.lower() for x in X.columns]
+            cardinality += len(X.index)
+            with tracing.span("join", rows=len(X.index)) as s:
+                X = probe(X, Y, index, join)
+                X.index = pd.RangeIndex(offset, offset + len(X.index)) # position in the extended cube
+                offset += len(X.index)
+            toprint["time_join"] += int(s.wall)
+            if len(X.index) > 0:
+                yield X
+        toprint["cardinality"] = cardinality
+        toprint["cardinality_extcube"] = offset
+
+    stats = {}
+    done = False
+    if os.path.exists(output):
+        os.remove(output)
+    while not done: # one pass for each level of whole-column functions
+        partial = {}
+        for X in chunks():
+            with tracing.span("comparison", rows=len(X.index)) as s:
+                outer_key = measure if using is None else evaluate_chunk(X, using["fun"], using["params"], stats, partial)
+            toprint["time_comparison"] += int(s.wall)
+            if outer_key is None:
+                continue
+            with tracing.span("label", rows=len(X.index)) as s:
+                if using is not None:
+                    X = X.drop(columns=[x for x in X.columns if "benchmark." in x])
+                if labeling_schema in functions:
+                    outer_key = apply_chunk(X, "model_labeling", labeling_schema, [X[outer_key]], stats, partial)
+                else:
+                    X["model_labeling"] = labeling.cut(X[outer_key], schema)
+            toprint["time_labeling"] += int(s.wall)
+            if outer_key is None:
+                continue
+            with tracing.span("write", rows=len(X.index)):
+                X.round(decimals=1).replace([np.inf], "Infinity").to_csv(output, index=False, mode='a', header=not done)
+            done = True
+        for key, (fun, s) in partial.items():
+            stats[key] = stream_functions[fun][2](s)
+        if toprint["cardinality_extcube"] == 0:
+            raise ValueError("Extended cube is empty")
+    return toprint["cardinality_extcube"]
+
 if __name__ == '__main__':
     ###############################################################################
     # PARAMETERS SETUP
@@ -374,6 +590,10 @@ if __name__ == '__main__':
     parser.add_argument("--dbms",              help="used dbms", type=str)
     parser.add_argument("--indexes",           help="used dbms", type=str)
     parser.add_argument("--save",              help="used dbms", type=str)
+    parser.add_argument("--chunksize",         help="process the target cube in chunks of this size", type=int)
+    parser.add_argument("--trace",             help="write the spans of the stages to this file (.json: Chrome trace, otherwise JSON lines)", type=str)
+    parser.add_argument("--profile",           help="profile the operator (cProfile), the reports are written next to the outputs", action="store_true")
+    parser.add_argument("--profile_memory",    help="with --profile, also report the allocations of the main stages (tracemalloc)", action="store_true")
     args  = parser.parse_args()
     # print(args)
     path = args.path
@@ -387,12 +607,21 @@ if __name__ == '__main__':
     labeling_schema = args.labeling_schema
     execution_plan = args.plan
     path = path.replace("\"", "")
-    df = assess(path, file, session_step, distance_function, benchmark_type, benchmark, measure, cube, labeling_schema, execution_plan)
-    if not args.save is None:
-        df \
-            .round(decimals=1)\
-            .replace([np.inf], "Infinity")\
-            .sort_values(by=sorted(list(df.columns)), axis=0).to_csv(path + file + "_" + session_step + "_enriched.csv", index=False)
+    tracing.enabled = args.trace is not None  # otherwise the spans are not kept
+    if args.profile:
+        profiling.start(args.profile_memory)
+    if args.chunksize is not None: # the extended cube is streamed, so the enriched cube is always written
+        assess_stream(path, file, session_step, distance_function, benchmark_type, benchmark, measure, cube, labeling_schema, execution_plan, path + file + "_" + session_step + "_enriched.csv", args.chunksize)
+    else:
+        df = assess(path, file, session_step, distance_function, benchmark_type, benchmark, measure, cube, labeling_schema, execution_plan)
+        if not args.save is None:
+            with tracing.span("write", rows=len(df.index)):
+                df \
+                    .round(decimals=1)\
+                    .replace([np.inf], "Infinity")\
+                    .sort_values(by=sorted(list(df.columns)), axis=0).to_csv(path + file + "_" + session_step + "_enriched.csv", index=False)
+    if args.profile:
+        profiling.stop(profiling.prefix(path, file, session_step, args.id))
     exists = os.path.exists('resources/assess/time.csv')
     with open("resources/assess/time.csv", 'a+') as o:
         toprint["time_cube"] = args.time_cube if args.time_cube > 0 else 1
@@ -408,4 +637,6 @@ if __name__ == '__main__':
             values.append(str(value))
         if not exists:
             o.write(','.join(header) + "\n")
-        o.write(','.join(values) + "\n")
\ No newline at end of file
+        o.write(','.join(values) + "\n")
+    if args.trace is not None:
+        tracing.write(args.trace)
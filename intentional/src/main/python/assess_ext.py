@@ -1,6 +1,10 @@
 from assess import *
 from sklearn_extra.cluster import KMedoids
-import cx_Oracle
+import database
+import moments
+import profiling
+import store
+import tracing
 import json
 import platform
 import numpy as np
@@ -18,21 +22,62 @@ labels = {
     "difference":    [quartile, likert3, likert5, fixeddiff2,  fixeddiff3,  fixeddiff5],  # ok for relative difference
     "reldifference": [quartile, likert3, likert5, fixeddiff2,  fixedrel3,   fixedrel5]  # ok for relative difference
 }
-features = [avg, std, skew]
+features = [avg, std, skew]  # features of the candidates used by the diversification
+# Diversification
+seed = 0
+max_kmedoids = 1000  # above this number of candidates, KMedoids is replaced by the greedy farthest-point selection
+max_sketch_cells = 10 ** 7  # above this number of cells (candidates x cube cells), candidates are sketched
+sketch_size = 256  # number of features of the sketched candidates
+sketch_chunksize = 100000  # rows of the cube projected at once
+# settings the memoised stages depend on, new settings MUST be added here
+stage_settings = ["seed", "max_kmedoids", "max_sketch_cells", "sketch_size", "sketch_chunksize", "usings", "labels", "features"]
+# modules whose code the memoised stages depend on, new dependencies MUST be added here
+stage_modules = ["assess_ext", "assess", "labeling", "moments", "store"]
 
-def clean_sql_df(df):
+def read_sql(sql):
     # if len(df[byclause].drop_duplicates().index) != len(df.index):
     #     print("Duplicates in the cube")
     #     sys.exit(1)
-    return df.round(5).fillna(0)
+    # the result is stored once per session, the following refinement steps (using, label) do not query the database again
+    file = store.path(os.path.dirname(os.path.abspath(args.path)), args.curid, sql)
+    with tracing.span("read") as s:
+        df = store.get(file)
+        if df is None:
+            # round and fill the missing values while fetching, as df.round(5).fillna(0)
+            with database.connection(credentials) as connection:
+                df = database.read_sql(sql, connection, decimals=5, fill=0)
+            store.write(df, file)
+            store.evict(os.path.dirname(file))
+        s.rows = len(df.index)
+    return df
+
+
+def read_descriptor(path):
+    """
+        path: json descriptor written by write_to_file
+        return the enhanced cube it points to
+    """
+    with open(path) as f:
+        enhcube = json.load(f)
+    if "raw" in enhcube:  # descriptors written by older versions embed the records
+        return pd.DataFrame.from_records(enhcube["raw"])
+    return store.read(os.path.join(os.path.dirname(os.path.abspath(path)), enhcube["data"]))
 
 
 def compute_auto_benchmark_sql(sql, k, measure, byclause):
-    df = clean_sql_df(pd.read_sql(sql, con=connection))
+    df = read_sql(sql)
     if len(df.index) == 0:
         print("Empty dataframe, did you choose a proper selection predicate?")
         sys.exit(1)
-    return compute_auto_benchmarks(df, k, measure, byclause)
+    return stage(compute_auto_benchmarks, df, k, measure, byclause)
+
+
+def stage(fun, Y, *params):
+    """ Run the pipeline stage fun(Y, *params), reusing its result if the same cube and parameters have been seen """
+    with tracing.span(fun.__name__, rows=len(Y.index)):
+        settings = {name: globals()[name] for name in stage_settings}
+        sources = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py") for name in stage_modules]
+        return store.memoize(os.path.dirname(os.path.abspath(args.path)), fun, Y, *params, settings=settings, sources=sources)
 
 
 def splitAttr(benchmark):
@@ -40,11 +85,49 @@ def splitAttr(benchmark):
     return attr, op, val
 
 
+def sketch(Y, columns, size=None, seed=None, chunksize=None):
+    """
+        Gaussian random projection of the columns of Y to size features (pairwise distances are approximately preserved).
+        The cube is projected in chunks of rows, so the candidates are never materialized as a dense matrix.
+        size, seed, chunksize: default to the module settings sketch_size, seed and sketch_chunksize
+        return a (len(columns), size) array
+    """
+    size = sketch_size if size is None else size
+    seed = globals()["seed"] if seed is None else seed
+    chunksize = sketch_chunksize if chunksize is None else chunksize
+    rng = np.random.default_rng(seed)
+    X = np.zeros((len(columns), size))
+    for start in range(0, len(Y.index), chunksize):
+        C = Y.iloc[start:start + chunksize][columns].to_numpy(dtype=float)
+        X += C.T @ rng.standard_normal((len(C), size))
+    return X / np.sqrt(size)
+
+
+def farthest_points(X, k):
+    """
+        Greedy max-min selection: start from the candidate closest to the centroid and iteratively pick the candidate
+        that is farthest from the selected ones. O(len(X) * k)
+        return the indices of the selected candidates
+    """
+    dist = np.linalg.norm(X - X.mean(axis=0), axis=1)
+    selected = [int(np.argmin(dist))]
+    dist = np.linalg.norm(X - X[selected[0]], axis=1)
+    while len(selected) < k:
+        selected.append(int(np.argmax(dist)))
+        dist = np.minimum(dist, np.linalg.norm(X - X[selected[-1]], axis=1))
+    return selected
+
+
 def diversify(X, benchmarks, k):
-    # apply diversification with clustering
-    kmedoids = KMedoids(n_clusters=min(k, len(benchmarks)), random_state=0, init='k-medoids++').fit(X) # , max_iter=300
+    k = min(k, len(benchmarks))
+    if len(benchmarks) <= max_kmedoids:
+        # apply diversification with clustering
+        medoids = KMedoids(n_clusters=k, random_state=seed, init='k-medoids++').fit(X).medoid_indices_ # , max_iter=300
+    else:
+        # too many candidates for the pairwise distance matrix
+        medoids = farthest_points(np.asarray(X, dtype=float), k)
     # get the names of the diversified columns
-    return [benchmarks[x] for x in kmedoids.medoid_indices_]
+    return [benchmarks[x] for x in medoids]
 
 
 def compute_auto_benchmarks(Y, k, measure, byclause):
@@ -53,30 +136,22 @@ def compute_auto_benchmarks(Y, k, measure, byclause):
     fun_name = str(using.__name__)
     # get all the siblings and parents (which are not normalized by property)
     # E.g., pick RUSSIA but not RUSSIA_population
-    for slice in [x for x in Y.columns if x not in byclause and x != measure and "_" not in x]:
-        # SOL1: apply the default comparison function
-        # Y[fun_name + "_" + slice] = Y.apply(lambda x: using(x[measure], x[slice]), axis=1)
-        # SOL2: do not apply any comparison here
-        Y[fun_name + "_" + slice] = Y[slice]
+    slices = [x for x in Y.columns if x not in byclause and x != measure and "_" not in x]
     # select the column names on which diversification will be applied
-    benchmarks = [x for x in Y.columns if fun_name in x]
-    # transform such columns into numpy arrays
-    X = np.array([Y[x].to_numpy() for x in benchmarks])
+    benchmarks = [fun_name + "_" + x for x in slices]
+    # transform such columns into numpy arrays (do not apply any comparison here), sketching them on large cubes
+    X = sketch(Y, slices) if len(slices) * len(Y.index) > max_sketch_cells else Y[slices].to_numpy().T
     # apply diversification
     benchmarks = diversify(X, benchmarks, k)
     Ys = []
     # iterate over the diversified columns
     for benchmark in benchmarks:
-        # # get the function name
-        # using = benchmark.split("_")[0]
         # get the name of the column
         l = benchmark.split("_")[1]
-        # generate the new data frame
-        Z = Y[[c for c in byclause + [measure] + [x for x in Y.columns if l in x]]].copy(deep=True)
-        # SOL2: compute the comparison here!
-        Z[fun_name + "_" + l] = Y.apply(lambda x: using(x[measure], x[slice]), axis=1)
-        # fix the column names
-        Z.columns = [x.replace(benchmark, "comparison").replace(l, "bc_" + measure) for x in Z.columns]
+        # generate the new data frame as a view over the columns of Y, fixing the column names
+        Z = pd.DataFrame({c.replace(l, "bc_" + measure): Y[c] for c in byclause + [measure] + [x for x in Y.columns if l in x]}, copy=False)
+        # compute the comparison on the whole columns
+        Z["comparison"] = using(Y[measure], Y[l])
         # append it to the diversified enhanced cubes
         Ys.append((Z, l))
     return Ys
@@ -96,6 +171,13 @@ def compute_using(Y, measure, using, compute_property=False):
     return Z
 
 
+def feature_vectors(Y, columns):
+    """ Features of each column, as [[fun(Y[x]) for fun in features] for x in columns], from a single pass over the columns """
+    s = moments.moments(Y[columns])
+    values = {avg: moments.mean(s), std: np.nan_to_num(moments.std(s), 0), skew: np.nan_to_num(moments.skew(s), 0)}
+    return np.array([values[fun] for fun in features]).T
+
+
 def compute_auto_using(Y, k, measure, byclause):
     # iterate over the existing comparison functions
     for using in usings:
@@ -104,7 +186,7 @@ def compute_auto_using(Y, k, measure, byclause):
     # select the column names on which diversification will be applied
     benchmarks = [x for x in Y.columns if "comparison_" in x]
     # transform such columns into numpy arrays
-    X = np.array([[fun(Y[x]) for fun in features] for x in benchmarks])
+    X = feature_vectors(Y, benchmarks)
     # apply diversification
     benchmarks = diversify(X, benchmarks, k)
     Ys = []
@@ -128,24 +210,62 @@ def compute_label(Y, label):
     Z["label"] = label(Z["comparison"])
     return Z
 
-def compute_auto_labels(Y, k, measure, byclause, using):
-    def kendall_tau_distance(values1, values2):
-        """Compute the Kendall tau distance."""
-        n = len(values1)
-        assert len(values2) == n, "Both lists have to be of equal length"
-        i, j = np.meshgrid(np.arange(n), np.arange(n))
-        a = np.argsort(values1)
-        b = np.argsort(values2)
-        ndisordered = np.logical_or(np.logical_and(a[i] < a[j], b[i] > b[j]), np.logical_and(a[i] > a[j], b[i] < b[j])).sum()
-        return ndisordered  # / (n * (n - 1))
+def count_inversions(p):
+    """
+        Number of pairs i < j with p[i] > p[j], p is a permutation of 0..n-1. Bottom-up merge sort where each of the
+        log n levels is a stable sort of n keys, so O(n log^2 n) in the worst case
+    """
+    n = len(p)
+    idx = np.arange(n)
+    s = np.asarray(p, dtype=np.int64)
+    inversions = 0
+    w = 1
+    while w < n:  # merge the adjacent sorted blocks of size w
+        pid = idx // (2 * w)  # id of the pair of blocks
+        keys = pid * n + s  # blocks of different pairs do not mix
+        order = np.argsort(keys, kind='stable')  # the keys are sorted runs, which the stable sort (timsort) merges
+        pos = np.empty(n, dtype=np.int64)
+        pos[order] = idx
+        right = (idx // w) % 2 == 1
+        # each element of the right block moves before the left elements that are greater than it
+        inversions += int(np.sum(idx[right] - pos[right]))
+        s = keys[order] - pid * n
+        w *= 2
+    return inversions
+
+
+def kendall_tau_distance(values1, values2):
+    """Compute the Kendall tau distance (number of discordant ordered pairs of the argsort permutations)."""
+    n = len(values1)
+    assert len(values2) == n, "Both lists have to be of equal length"
+    return kendall_tau_sorted(np.argsort(values1), np.argsort(values2))
+
+
+def kendall_tau_sorted(a, b):
+    """ Kendall tau distance between the argsort permutations a and b """
+    inv_a = np.empty(len(a), dtype=np.int64)
+    inv_a[a] = np.arange(len(a))
+    return 2 * count_inversions(b[inv_a])  # each discordant pair is counted in both directions
+
+
+def kendall_tau_matrix(X):
+    """ Pairwise Kendall tau distances between the rows of X """
+    a = [np.argsort(x) for x in X]  # sort each row once
+    D = np.zeros((len(a), len(a)))
+    for i in range(len(a)):
+        for j in range(i + 1, len(a)):
+            D[i, j] = D[j, i] = kendall_tau_sorted(a[i], a[j])
+    return D
 
+
+def compute_auto_labels(Y, k, measure, byclause, using):
     for l in labels[json.loads(using)["fun"] if isinstance(using, str) and "{" in using else using.split("_")[0]]:
         Y = compute_label(Y, l)
         Y = Y.rename(columns={"label": "label_" + l.__name__})
     benchmarks = [x for x in Y.columns if "label_" in x]
-    dictionary = {ni: indi for indi, ni in enumerate(sorted(set([item for sublist in [Y[x] for x in benchmarks] for item in sublist])))}
+    dictionary = {ni: indi for indi, ni in enumerate(sorted(set(pd.concat([Y[x].astype(object) for x in benchmarks]).unique())))}
     X = np.array([Y[x].map(dictionary).to_numpy() for x in benchmarks])
-    kmedoids = KMedoids(n_clusters=min(k, len(benchmarks)), init='k-medoids++', random_state=0, metric=kendall_tau_distance).fit(X)
+    kmedoids = KMedoids(n_clusters=min(k, len(benchmarks)), init='k-medoids++', random_state=0, metric='precomputed').fit(kendall_tau_matrix(X))
     benchmarks = list(set([benchmarks[x] for x in kmedoids.medoid_indices_]))
     Ys = []
     for benchmark in benchmarks:
@@ -155,6 +275,7 @@ def compute_auto_labels(Y, k, measure, byclause, using):
         Ys.append((Z, l))
     return Ys
 
+@tracing.span("write")
 def write_to_file(i, byclause, forclause, measure, df, sibling, using, label):
     if using is None:
         df = compute_using(df, measure, using if using is not None else difference)
@@ -166,12 +287,13 @@ def write_to_file(i, byclause, forclause, measure, df, sibling, using, label):
 
     # print(args.path + "_" + str(i) + ".csv")
     X = df.copy(True)
-    X["zscore_" + measure + "_bc"] = (X[measure] - X[measure].mean()) / X[measure].std()
+    X["zscore_" + measure + "_bc"] = moments.zscore(X[measure], moments.moments(X[measure]), ddof=1)
     X.columns = [x.lower() for x in X.columns]
     X.sort_values([x.lower() for x in byclause if x.lower() in X.columns]).to_csv(args.path + "_" + str(i) + "_enhanced.csv", index=False)
     # sys.exit(1)
+    store.write(df, args.path + "_" + str(i) + store.extension)
     enhcube = {
-        "raw": json.loads(df.to_json(orient="records", double_precision=5)),
+        "data": os.path.basename(args.path + "_" + str(i) + store.extension),
         "dimensions": byclause,
         "measures": ["comparison"],
         "against": "'" + sibling + "'",
@@ -204,6 +326,9 @@ if __name__ == '__main__':
     parser.add_argument("--labels", help="labels", type=str)
     parser.add_argument("--k", help="number of diverse clauses", type=int)
     parser.add_argument("--path", help="output path", type=str)
+    parser.add_argument("--trace", help="write the spans of the stages to this file (.json: Chrome trace, otherwise JSON lines)", type=str)
+    parser.add_argument("--profile", help="profile the operator (cProfile), the reports are written next to the outputs (prefixed by --path)", action="store_true")
+    parser.add_argument("--profile_memory", help="with --profile, also report the allocations of the main stages (tracemalloc)", action="store_true")
     args = parser.parse_args()
     # print(args)
     credentials = json.loads(args.credentials)
@@ -235,64 +360,66 @@ if __name__ == '__main__':
     toprint["label"] = 0 if label is None else 1
     toprint["sql"] = '"' + sql.replace('"', '""') + '"'
 
-    cx_Oracle.init_oracle_client(lib_dir=credentials["oracleclient"])
-    dsn_tns = cx_Oracle.makedsn(credentials["ip"], credentials["port"], credentials["metadata"])
-    connection = cx_Oracle.connect(credentials["user"], credentials["pwd"], dsn_tns)
-
+    tracing.enabled = args.trace is not None  # otherwise the spans are not kept
+    if args.profile:
+        profiling.start(args.profile_memory)
     sibling = ""
-    start_time = time.time()
-    if benchmark is not None and "(" in benchmark:  # check whether this is a sibling
-        attr, op, sibling = splitAttr(benchmark)
-    else:
-        sibling = benchmark  # else is a parent
-    bc = 0  # number of benchmarks
-    cm = 0  # number of comparisons
-    if benchmark is None:  # if no benchmark has been specified
-        i = 0  # file id
-        dfs = compute_auto_benchmark_sql(sql, k, measure, byclause)  # compute the most diverse benchmarks
-        for df in dfs:  # and write them to file
-            toprint["card"] = len(df[0].index)
-            write_to_file(i, byclause, forclause, measure, df[0], df[1], None, None)
-            i += 1
-            bc += 1
-    else:  # if the benchmark has been already specified
-        if os.path.isfile(args.path):  # if the file exists, then the benchmark has already been created
-            data = json.load(open(args.path))['raw']  # I simply need to read it
-            df = pd.DataFrame.from_records(data)  # and to get the dataframe
-        else:  # the benchmark has not been created yet
-            df = clean_sql_df(pd.read_sql(sql, con=connection))  # I need to run the SQL query
-        toprint["card"] = len(df.index)
-    toprint["benchmark_time"] = time.time() - start_time
-    start_time = time.time()
-    if bc <= 1:  # if no or a single refinement has been done
-        if using is None:  # if no comparison has been specified
-            if bc == 1:  # if refinement
-                sibling = dfs[0][1]  # get the benchmark from the previous refinement
-                df = dfs[0][0]  # take it
-            i = 0
-            dfs = compute_auto_using(df, k, measure, byclause)  # compute the comparisons , benchmark=sibling
-            for df in dfs:
-                write_to_file(i, byclause, forclause, measure, df[0], sibling, df[1], None)
-                i += 1
-                cm += 1
-        elif "comparison" not in df.columns:  # if the comparison has been specified but has not been already computed
-            df = compute_using(df, measure, using)  # , comp=sibling
-    toprint["comparison_time"] = time.time() - start_time
-    start_time = time.time()
-    if bc <= 1 and cm <= 1:   # if no or a single refinement has been done
-        i = 0
-        if label is None:  # if no benchmark has been specified
-            if cm == 1:  # if the benchmark comes from the previous refinement
-                using = dfs[0][1]  # if refinement
-                df = dfs[0][0]  # take it
-            dfs = compute_auto_labels(df, k, measure, byclause, using)
-            for df in dfs:
-                write_to_file(i, byclause, forclause, measure, df[0], sibling, using, df[1])
+    with tracing.span("benchmark") as s:
+        if benchmark is not None and "(" in benchmark:  # check whether this is a sibling
+            attr, op, sibling = splitAttr(benchmark)
+        else:
+            sibling = benchmark  # else is a parent
+        bc = 0  # number of benchmarks
+        cm = 0  # number of comparisons
+        if benchmark is None:  # if no benchmark has been specified
+            i = 0  # file id
+            dfs = compute_auto_benchmark_sql(sql, k, measure, byclause)  # compute the most diverse benchmarks
+            for df in dfs:  # and write them to file
+                toprint["card"] = len(df[0].index)
+                write_to_file(i, byclause, forclause, measure, df[0], df[1], None, None)
                 i += 1
-        elif "label" not in df.columns:   # if the label has been specified but has not been already computed
-            df = compute_label(df, label)
-            write_to_file(i, byclause, forclause, measure, df, sibling, using, label)
-    toprint["label_time"] = time.time() - start_time
+                bc += 1
+        else:  # if the benchmark has been already specified
+            if os.path.isfile(args.path):  # if the file exists, then the benchmark has already been created
+                df = read_descriptor(args.path)  # I simply need to read it
+            else:  # the benchmark has not been created yet
+                df = read_sql(sql)  # I need to run the SQL query (unless it has already been run in this session)
+            toprint["card"] = len(df.index)
+    toprint["benchmark_time"] = s.wall / 1000
+    with tracing.span("comparison") as s:
+        if bc <= 1:  # if no or a single refinement has been done
+            if using is None:  # if no comparison has been specified
+                if bc == 1:  # if refinement
+                    sibling = dfs[0][1]  # get the benchmark from the previous refinement
+                    df = dfs[0][0]  # take it
+                i = 0
+                dfs = stage(compute_auto_using, df, k, measure, byclause)  # compute the comparisons , benchmark=sibling
+                for df in dfs:
+                    write_to_file(i, byclause, forclause, measure, df[0], sibling, df[1], None)
+                    i += 1
+                    cm += 1
+            elif "comparison" not in df.columns:  # if the comparison has been specified but has not been already computed
+                df = stage(compute_using, df, measure, using)  # , comp=sibling
+    toprint["comparison_time"] = s.wall / 1000
+    with tracing.span("label") as s:
+        if bc <= 1 and cm <= 1:   # if no or a single refinement has been done
+            i = 0
+            if label is None:  # if no benchmark has been specified
+                if cm == 1:  # if the benchmark comes from the previous refinement
+                    using = dfs[0][1]  # if refinement
+                    df = dfs[0][0]  # take it
+                dfs = stage(compute_auto_labels, df, k, measure, byclause, using)
+                for df in dfs:
+                    write_to_file(i, byclause, forclause, measure, df[0], sibling, using, df[1])
+                    i += 1
+            elif "label" not in df.columns:   # if the label has been specified but has not been already computed
+                df = stage(compute_label, df, label)
+                write_to_file(i, byclause, forclause, measure, df, sibling, using, label)
+    toprint["label_time"] = s.wall / 1000
+    if args.profile:
+        profiling.stop(args.path)
+    if args.trace is not None:
+        tracing.write(args.trace)
 
     # exists = os.path.exists('resources/intention/time.csv')
     # with open("resources/intention/time.csv", 'a+') as o:
@@ -0,0 +1,198 @@
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import gen_cube
+import predict as predict_engine
+import assess as assess_engine
+import assess_ext as assess_ext_engine
+import explain as explain_engine
+import describe as describe_engine
+import tracing
+from tracing import peak_rss
+
+###############################################################################
+# Benchmark suite. The operators are run on synthetic cubes (see gen_cube) of
+# increasing size; each run happens in a fresh (forked) process, so that its
+# peak memory is not hidden by the previous runs. The report (a JSON file)
+# holds the wall time, the peak RSS and the time of each stage of every run,
+# and two reports (e.g., of two commits) can be compared.
+###############################################################################
+sizes = [1000, 10000, 100000]  # numbers of cells of the cubes
+predict_models = predict_engine.models  # models run by predict
+nullify = 0.1  # fraction of the last time points whose target measure is predicted
+k = 3  # size k of assess_ext and describe
+
+
+def run_predict(X, folder, config):
+    """ Predict the target measure m0 on the last time points """
+    time_attr = config["granularity"]
+    X = X.copy()
+    last = X[time_attr].drop_duplicates().sort_values().tail(max(1, int(X[time_attr].nunique() * nullify)))
+    X.loc[X[time_attr].isin(last), "m0"] = np.nan
+    predict_engine.my_path, predict_engine.file, predict_engine.session_step = folder + os.sep, "bench", "0"
+    _, stats = predict_engine.predict(X, ["member", time_attr], "m0", using=predict_models)
+    return {model: t for _, model, t in stats}
+
+
+def run_assess(X, folder, config):
+    """ Assess m0 against the sibling member M0 (in-memory join), with a difference and quartiles """
+    time_attr = config["granularity"]
+    X.to_csv(os.path.join(folder, "bench_0.csv"), index=False)
+    sibling = X["member"].iloc[0]
+    X[X["member"] == sibling].to_csv(os.path.join(folder, "bench_bc_0.csv"), index=False)
+    cube = json.dumps({"GC": ["member", time_attr], "SC": [], "MC": [{"MEA": "m0"}]})
+    assess_engine.assess(folder + os.sep, "bench", 0, '{"fun": "difference", "params": ["m0", "benchmark.m0"]}',
+                         "sibling", "(member,=,'" + sibling + "')", "m0", cube, "quartiles", "JOININMEMORY")
+    return {x: assess_engine.toprint[x] for x in ["time_transform", "time_join", "time_comparison", "time_labeling"]}
+
+
+def run_assess_ext(X, folder, config):
+    """ Diversify the benchmarks, the comparisons and the labels of m0 of the first member against the other members """
+    time_attr = config["granularity"]
+    # cube of the sibling query: the target measure and one column for each sibling, by time
+    W = X.pivot_table(index=time_attr, columns="member", values="m0", dropna=False).fillna(0)
+    W.columns = ["m0" if i == 0 else c for i, c in enumerate(W.columns)]
+    W = W.reset_index()
+    byclause = [time_attr]
+    stats = {}
+    with tracing.span("benchmarks", rows=len(W.index)) as s:
+        Z, sibling = assess_ext_engine.compute_auto_benchmarks(W, k, "m0", byclause)[0]
+    stats["benchmarks"] = round(s.wall)
+    with tracing.span("using", rows=len(Z.index)) as s:
+        Z, using = assess_ext_engine.compute_auto_using(Z, k, "m0", byclause)[0]
+    stats["using"] = round(s.wall)
+    with tracing.span("labels", rows=len(Z.index)) as s:
+        assess_ext_engine.compute_auto_labels(Z, k, "m0", byclause, using)
+    stats["labels"] = round(s.wall)
+    return stats
+
+
+def run_explain(X, folder, config):
+    """ Explain m0 with the other measures """
+    measures = ["m" + str(j) for j in range(config["measures"])]
+    _, stats = explain_engine.run(X, measures[0], measures[1:], ["Polyfit", "CrossCorrelation", "Multireg"])
+    return {model: t for _, model, t in stats}
+
+
+def run_describe(X, folder, config):
+    """ Apply all the mining models to the measures """
+    measures = ["m" + str(j) for j in range(config["measures"])]
+    _, _, stats = describe_engine.describe(X, measures, list(describe_engine.mining_models.keys()), k, compute_property=True)
+    return {model: t for _, model, _, t in stats}
+
+
+# lookup table for the benchmarked operators, new operators MUST be added here
+operators = {
+    "predict": run_predict,
+    "assess": run_assess,
+    "assess_ext": run_assess_ext,
+    "explain": run_explain,
+    "describe": run_describe
+}
+
+
+def measure(operator, config):
+    """
+        operator: benchmarked operator (see operators)
+        config: parameters of gen_cube.cube
+        return the result of the run: configuration, rows of the cube, wall time (ms), peak RSS (MB) and time of each stage (ms)
+    """
+    X = gen_cube.cube(**config)
+    with tempfile.TemporaryDirectory() as folder:
+        with tracing.span(operator, rows=len(X.index)) as s:
+            try:
+                stages, error = operators[operator](X, folder, config), None
+            except Exception as e:
+                stages, error = {}, repr(e)
+    return {"operator": operator, **config, "rows": len(X.index), "wall": round(s.wall), "peak_rss": peak_rss(), "stages": stages, "error": error}
+
+
+def isolated(operator, config):
+    """ Run measure in a fresh process (if processes can be forked) """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return measure(operator, config)
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        return pool.apply(measure, (operator, config))
+
+
+def commit():
+    """ Current git commit, None outside a repository """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(sizes=sizes, using=list(operators.keys()), members=10, granularity="date", sparsity=0.0, correlation=0.5, measures=3, repeat=1, seed=0):
+    """
+        sizes: numbers of cells of the cubes
+        using: operators to run (see operators)
+        members, granularity, sparsity, correlation, measures, seed: parameters of the cubes (see gen_cube.cube)
+        repeat: repetitions of each run
+        return the report of the runs
+    """
+    runs = []
+    for cells in sizes:
+        config = {"cells": cells, "members": members, "granularity": granularity, "sparsity": sparsity, "correlation": correlation, "measures": measures, "seed": seed}
+        for operator in using:
+            for _ in range(repeat):
+                runs.append(isolated(operator, config))
+                print(json.dumps(runs[-1]))
+    return {"commit": commit(), "date": datetime.now().isoformat(timespec="seconds"), "runs": runs}
+
+
+def summary(report):
+    """ Median wall time and peak RSS of each operator on each cube """
+    df = pd.DataFrame(report["runs"])
+    return df[df["error"].isnull()].groupby(["operator", "cells"])[["wall", "peak_rss"]].median()
+
+
+def compare(old, new):
+    """
+        old, new: reports
+        return the median wall time and peak RSS of each operator on each cube, and their ratio (new / old)
+    """
+    res = summary(old).join(summary(new), lsuffix="_old", rsuffix="_new", how="outer")
+    for x in ["wall", "peak_rss"]:
+        res[x + "_ratio"] = (res[x + "_new"] / res[x + "_old"]).round(2)
+    return res
+
+
+if __name__ == '__main__':
+    ###############################################################################
+    # PARAMETERS SETUP
+    ###############################################################################
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs='*', help="numbers of cells of the cubes", type=int, default=sizes)
+    parser.add_argument("--operators", nargs='*', help="operators to run", choices=list(operators.keys()), default=list(operators.keys()))
+    parser.add_argument("--members", help="members of the dimension", type=int, default=10)
+    parser.add_argument("--granularity", help="time granularity", choices=list(gen_cube.granularities.keys()), default="date")
+    parser.add_argument("--sparsity", help="fraction of removed cells", type=float, default=0.0)
+    parser.add_argument("--correlation", help="correlation of the measures", type=float, default=0.5)
+    parser.add_argument("--measures", help="number of measures", type=int, default=3)
+    parser.add_argument("--repeat", help="repetitions of each run", type=int, default=1)
+    parser.add_argument("--seed", help="seed of the cubes", type=int, default=0)
+    parser.add_argument("--predict_models", nargs='*', help="models run by predict", choices=predict_engine.models)
+    parser.add_argument("--output", help="report file (default: benchmark_<commit>.json)", type=str)
+    parser.add_argument("--compare", nargs=2, help="compare two reports instead of running the benchmark", metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+    if args.compare is not None:
+        reports = []
+        for file in args.compare:
+            with open(file) as f:
+                reports.append(json.load(f))
+        print(compare(*reports).to_string())
+        exit(0)
+    if args.predict_models:
+        predict_models = args.predict_models
+    report = benchmark(args.sizes, args.operators, args.members, args.granularity, args.sparsity, args.correlation, args.measures, args.repeat, args.seed)
+    output = args.output if args.output is not None else "benchmark_" + str(report["commit"]) + ".json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(summary(report).to_string())
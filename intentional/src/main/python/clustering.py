@@ -0,0 +1,58 @@
+import numpy as np
+from scipy.signal import argrelextrema
+from sklearn.cluster import MiniBatchKMeans
+
+###############################################################################
+# Choice of the number of clusters with the elbow method. Each candidate k is
+# fitted once with MiniBatchKMeans on a sample of the cells, the elbow of the
+# distortion curve is located with the kneedle algorithm (as yellowbrick's
+# KElbowVisualizer does) and the model fitted for the chosen k is reused.
+###############################################################################
+max_sample = 100000  # largest number of cells used to fit the candidate models
+seed = 0
+
+
+def normalize(a):
+    """ Rescale a to [0, 1] """
+    a = np.asarray(a, dtype=np.float64)
+    return (a - a.min()) / (a.max() - a.min())
+
+
+def kneedle(x, y, sensitivity=1.0):
+    """
+        x: increasing values (e.g., the number of clusters)
+        y: convex and decreasing curve (e.g., the distortion of the clustering)
+        return the x at the elbow of the curve, None if there is no elbow
+    """
+    if len(x) < 3 or np.ptp(y) == 0:
+        return None
+    x_normalized = normalize(x)
+    y_difference = (1 - normalize(y)) - x_normalized  # flip the curve, the elbow is the maximum of the difference
+    maxima = argrelextrema(y_difference, np.greater_equal)[0]
+    minima = argrelextrema(y_difference, np.less_equal)[0]
+    thresholds = y_difference[maxima] - sensitivity * np.abs(np.diff(x_normalized).mean())
+    threshold, threshold_index = None, None
+    for i in range(maxima[0], len(x) - 1):
+        if i in maxima:
+            threshold, threshold_index = thresholds[list(maxima).index(i)], i
+        if i in minima:
+            threshold = 0.0
+        if y_difference[i + 1] < threshold:  # the difference curve drops after a local maximum
+            return x[threshold_index]
+    return None
+
+
+def select_k(X, ks, sample=max_sample):
+    """
+        X: (n_cells, n_measures) array
+        ks: candidate numbers of clusters
+        sample: largest number of cells used to fit the candidate models
+        return the elbow k, the model fitted for it and the cluster of each cell (None, None, None if there is no elbow)
+    """
+    S = X[np.random.default_rng(seed).choice(len(X), sample, replace=False)] if len(X) > sample else X
+    models = [MiniBatchKMeans(n_clusters=k, random_state=seed, n_init=3).fit(S) for k in ks]
+    k = kneedle(ks, [model.inertia_ for model in models])
+    if k is None:
+        return None, None, None
+    model = models[list(ks).index(k)]
+    return k, model, model.predict(X)
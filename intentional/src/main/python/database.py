@@ -0,0 +1,134 @@
+import contextlib
+import decimal
+import numbers
+import numpy as np
+import pandas as pd
+
+###############################################################################
+# DB-API access layer. Connections come from a pool that lives as long as the
+# process, and query results are fetched in batches straight into typed NumPy
+# buffers (rounding and filling the missing values on the fly). Each operator
+# call is a new process, so the pool only pays off for in-process callers that
+# run several queries (e.g., the benchmarks and the tests).
+###############################################################################
+arraysize = 10000  # rows fetched at each round trip
+pools = {}  # session pools (or connections), by backend and database
+
+
+def oracle(credentials):
+    import cx_Oracle
+    key = ("oracle", credentials["ip"], credentials["port"], credentials["metadata"], credentials["user"])
+    if key not in pools:
+        if not any(k[0] == "oracle" for k in pools):  # the client library can be initialized only once
+            cx_Oracle.init_oracle_client(lib_dir=credentials["oracleclient"])
+        dsn_tns = cx_Oracle.makedsn(credentials["ip"], credentials["port"], credentials["metadata"])
+        pools[key] = cx_Oracle.SessionPool(user=credentials["user"], password=credentials["pwd"], dsn=dsn_tns, min=1, max=4, increment=1)
+    return pools[key].acquire()
+
+
+def sqlite(credentials):
+    import sqlite3
+    key = ("sqlite", credentials["path"])
+    if key not in pools:
+        pools[key] = sqlite3.connect(credentials["path"])
+    return pools[key]
+
+
+# lookup table for the DB-API backends, new backends MUST be added here
+backends = {
+    "oracle": oracle,
+    "sqlite": sqlite
+}
+
+
+def connect(credentials):
+    """
+        credentials: connection parameters, "backend" picks the DB-API backend (default: oracle)
+        return a connection from the pool of the backend, to be released with release
+    """
+    return backends[credentials.get("backend", "oracle")](credentials)
+
+
+def release(connection):
+    """ Give back a connection from connect: pooled sessions are closed (i.e., returned to their pool), shared connections are kept """
+    if not any(connection is c for c in pools.values()):
+        connection.close()
+
+
+@contextlib.contextmanager
+def connection(credentials):
+    """ A connection from connect, released on exit """
+    c = connect(credentials)
+    try:
+        yield c
+    finally:
+        release(c)
+
+
+def column_kind(values):
+    """ Kind of a batch of values: 'i' (integers), 'f' (real numbers or missing values), 'O' (anything else) """
+    kind = "i"
+    for v in values:
+        if v is None or isinstance(v, (float, decimal.Decimal)):
+            kind = "f"
+        elif isinstance(v, bool) or not isinstance(v, numbers.Integral):
+            return "O"
+    return kind
+
+
+def append(buffer, n, values):
+    """ Append values to the first n slots of buffer, growing it geometrically; return the (possibly new) buffer """
+    if n + len(values) > len(buffer):
+        grown = np.empty(max(2 * len(buffer), n + len(values)), dtype=buffer.dtype)
+        grown[:n] = buffer[:n]
+        buffer = grown
+    buffer[n:n + len(values)] = values
+    return buffer
+
+
+def read_sql(sql, connection, decimals=None, fill=None, size=arraysize):
+    """
+        sql: query to execute
+        connection: DB-API connection
+        decimals: if not None, round the numeric columns as DataFrame.round(decimals)
+        fill: if not None, replace the missing values as DataFrame.fillna(fill)
+        size: number of rows fetched at each round trip
+        return the result as a DataFrame, as pd.read_sql(sql, connection).round(decimals).fillna(fill)
+    """
+    cursor = connection.cursor()
+    try:
+        return fetch(cursor, sql, decimals, fill, size)
+    finally:
+        cursor.close()
+
+
+def fetch(cursor, sql, decimals, fill, size):
+    cursor.arraysize = size
+    if hasattr(cursor, "prefetchrows"):
+        cursor.prefetchrows = size + 1
+    cursor.execute(sql)
+    names = [x[0] for x in cursor.description]
+    kinds = ["i"] * len(names)
+    buffers = [np.empty(0, dtype=np.int64) for _ in names]
+    n = 0
+    rows = cursor.fetchmany(size)
+    while len(rows) > 0:
+        for j, values in enumerate(zip(*rows)):
+            kind = column_kind(values)
+            if "ifO".index(kind) > "ifO".index(kinds[j]):  # widen the buffer
+                kinds[j] = kind
+                buffers[j] = buffers[j][:n].astype(np.float64 if kind == "f" else object)
+            if kinds[j] == "O":
+                values = np.array(values, dtype=object)
+                if fill is not None:
+                    values[pd.isna(values)] = fill
+            else:
+                values = np.array(values, dtype=np.float64 if kinds[j] == "f" else np.int64)
+                if decimals is not None and kinds[j] == "f":
+                    values = np.round(values, decimals)
+                if fill is not None and kinds[j] == "f":
+                    values[np.isnan(values)] = fill
+            buffers[j] = append(buffers[j], n, values)
+        n += len(rows)
+        rows = cursor.fetchmany(size)
+    return pd.DataFrame({name: buffer[:n] for name, buffer in zip(names, buffers)}, columns=names, copy=False)
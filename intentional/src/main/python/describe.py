@@ -2,128 +2,251 @@ import argparse
 import json
 import numpy as np
 import pandas as pd
-from scipy import stats
 from sklearn.cluster import KMeans
+from joblib import Parallel, delayed
 from sklearn.ensemble import IsolationForest
-from yellowbrick.cluster import KElbowVisualizer
-
-###############################################################################
-# PARAMETERS SETUP
-###############################################################################
-parser = argparse.ArgumentParser()
-parser.add_argument("--path", help="where to put the output", type=str)
-parser.add_argument("--file", help="the file name", type=str)
-parser.add_argument("--session_step", help="the session step", type=int)
-parser.add_argument("--k", help="size k", type=int)
-parser.add_argument("--models", nargs='*', help="mining models to apply")
-parser.add_argument("--cube", help="cube")
-parser.add_argument("--computeproperty", help="whether to compute properties")
-args = parser.parse_args()
-path = args.path.replace("\"", "")
-file = args.file
-session_step = args.session_step
-cube = args.cube.replace("__", " ")
-compute_property = bool(args.computeproperty)
-k = args.k
-cube = json.loads(cube)
-models = args.models
-
-###############################################################################
-# APPLY MODELS
-###############################################################################
-try:
-    X = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding='cp1252')
-except Error:
-    X = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
-
-X.columns = [x.lower() for x in X.columns]
-cells = len(X.index)
-measures = [x["MEA"].lower() for x in cube["MC"]]
-P = pd.DataFrame(columns=["model", "component", "property", "value"])
-
-if cells > 0:
-    prop = []
+import moments
+import profiling
+import tracing
+from clustering import select_k
+from skyline import skyline
 
-    for m in measures:
-        X["zscore_" + m] = np.around(np.nan_to_num(stats.zscore(X[m]), 0), decimals=3)
+n_jobs = None  # cores used by the models (None: one, -1: all)
+outliers_sample = 100000  # largest number of cells used to fit the outlier model
+outliers_chunksize = 100000  # cells scored at once by the outlier model
 
-    if "clustering" in models and (k is None or k > 1):
-        def_k = k
-        if cells > 10:
-            if def_k is None:
-                model = KMeans()
-                visualizer = KElbowVisualizer(model, k=(2, min(6, cells)))
-                visualizer.fit(X[measures].astype(float))  # Fit the data to the visualizer
-                def_k = visualizer.elbow_value_
-            if def_k is None:
-                def_k = 3
-            if def_k < cells:
-                kmeans = KMeans(n_clusters=def_k, random_state=0).fit(X[measures])
-                X["model_clustering"] = kmeans.labels_
-                # print(kmeans.inertia_)
-                for idx, c in enumerate(kmeans.cluster_centers_):
-                    prop.append(["model_clustering", idx, "centroid", round(c[0], 2)])
 
-    if "outliers" in models:
-        def_k = k
-        if def_k is None:
-            def_k = int(cells / 4)
-        outliers = IsolationForest(random_state=0).fit(X[measures])
-        X["outlierness"] = outliers.predict(X[measures])
-        X["model_outliers"] = X["outlierness"].isin(X[X["outlierness"] < 0]["outlierness"].nsmallest(def_k, keep='first'))
-        if compute_property and len(X[X["model_outliers"] == True].index) > 0:
-            prop.append(["model_outliers", "True", "outlierness", round(X[X["model_outliers"] == True]["outlierness"].mean(), 2)])
-        if compute_property and len(X[X["model_outliers"] == False].index) > 0:
-            prop.append(["model_outliers", "False", "outlierness", round(X[X["model_outliers"] == False]["outlierness"].mean(), 2)])
-        X = X.drop("outlierness", axis=1)
-
-    if "skyline" in models and len(measures) > 1:
-        # #########################################################################
-        # https://stackoverflow.com/questions/32791911/fast-calculation-of-pareto-front-in-python
-        # #########################################################################
-        def is_pareto_efficient_simple(costs):
-            """
-            Find the pareto-efficient points
-            :param costs: An (n_points, n_costs) array
-            :return: A (n_points, ) boolean array, indicating whether each point is Pareto efficient
-            """
-            is_efficient = np.ones(costs.shape[0], dtype=bool)
-            for i, c in enumerate(costs):
-                if is_efficient[i]:
-                    is_efficient[is_efficient] = np.any(costs[is_efficient] >= c, axis=1)  # Keep any point with a lower cost
-                    is_efficient[i] = True  # And keep self
-            return is_efficient
-        X["model_skyline"] = is_pareto_efficient_simple(X[measures].to_numpy())
-        if compute_property and len(X[X["model_skyline"] == True].index) > 0:
-            prop.append(["model_skyline", "True", "avgZscore", round(X[X["model_skyline"] == True]["zscore_" + measures[0]].mean(), 2)])
-        if compute_property and len(X[X["model_skyline"] == False].index) > 0:
-            prop.append(["model_skyline", "False", "avgZscore", round(X[X["model_skyline"] == False]["zscore_" + measures[0]].mean(), 2)])
-
-    if "top-k" in models:
-        def_k = k
-        if def_k is None:
-            def_k = int(cells / 4)
-        for m in measures:
-            X["model_top_" + m] = X[m].isin(X[m].nlargest(def_k, keep='first'))
-            if compute_property and len(X[X["model_top_" + m] == True].index) > 0:
-                prop.append(["model_top_" + m, "True", "avgZscore", round(X[X["model_top_" + m] == True]["zscore_" + m].mean(), 2)])
-            if compute_property and len(X[X["model_top_" + m] == False].index) > 0:
-                prop.append(["model_top_" + m, "False", "avgZscore", round(X[X["model_top_" + m] == False]["zscore_" + m].mean(), 2)])
-
-    if "bottom-k" in models:
+def default_k(k, cells):
+    """ Number of cells selected by a model, a quarter of the cells if k is not given """
+    return int(cells / 4) if k is None else k
+
+
+def append_split(prop, X, model, property, column, compute_property):
+    """ Append the average of column over the cells selected (and not selected) by the boolean model """
+    for component in [True, False]:
+        if compute_property and len(X[X[model] == component].index) > 0:
+            prop.append([model, str(component), property, round(X[X[model] == component][column].mean(), 2)])
+
+
+def select_extremes(V, k, largest=True):
+    """
+        V: (n_cells, n_measures) array
+        k: number of cells to select for each measure
+        largest: whether to select the largest or the smallest values
+        return a (n_cells, n_measures) boolean array marking the k largest (smallest) values of each measure, ties are
+        broken by position and missing values come last, as Series.nlargest(k, keep='first')
+    """
+    n = len(V)
+    k = max(0, min(k, n))
+    if k == 0:
+        return np.zeros(V.shape, dtype=bool)
+    valid = ~np.isnan(V)
+    W = np.where(valid, V if largest else -V, -np.inf)  # select the largest values of W
+    t = np.partition(W, n - k, axis=0)[n - k]  # k-th largest value of each measure
+    selected = W > t
+    # fill up to k cells with the first cells equal to the threshold, then (if any) with the first missing values
+    for tie in [valid & (W == t), ~valid & (t == -np.inf)]:
+        selected |= tie & (np.cumsum(tie, axis=0) <= k - selected.sum(axis=0))
+    return selected
+
+
+def clustering(X, measures, k, prop, compute_property):
+    """ Cluster the cells with KMeans, choosing k with the elbow method if it is not given """
+    cells = len(X.index)
+    if (k is None or k > 1) and cells > 10:
         def_k = k
+        kmeans = None
+        if def_k is None:  # elbow method, the model fitted for the chosen k is reused
+            def_k, kmeans, clusters = select_k(X[measures].to_numpy(dtype=float), list(range(2, min(6, cells))))
         if def_k is None:
-            def_k = int(cells / 4)
-        for m in measures:
-            X["model_bottom_" + m] = X[m].isin(X[m].nsmallest(def_k, keep='first'))
-            if compute_property and len(X[X["model_bottom_" + m] == True].index) > 0:
-                prop.append(["model_bottom_" + m, "True", "avgZscore", round(X[X["model_bottom_" + m] == True]["zscore_" + m].mean(), 2)])
-            if compute_property and len(X[X["model_bottom_" + m] == False].index) > 0:
-                prop.append(["model_bottom_" + m, "False", "avgZscore", round(X[X["model_bottom_" + m] == False]["zscore_" + m].mean(), 2)])
-
-    X.to_csv(path + file + "_" + str(session_step) + "_ext.csv", index=False)
+            def_k = 3
+        if def_k < cells:
+            if kmeans is None:
+                kmeans = KMeans(n_clusters=def_k, random_state=0).fit(X[measures])
+                clusters = kmeans.labels_
+            X["model_clustering"] = clusters
+            # print(kmeans.inertia_)
+            for idx, c in enumerate(kmeans.cluster_centers_):
+                prop.append(["model_clustering", idx, "centroid", round(c[0], 2)])
+    return X
+
+
+def outliers(X, measures, k, prop, compute_property):
+    """ Mark the (at most) k cells with the lowest anomaly scores among the ones an IsolationForest finds anomalous """
+    cells = len(X.index)
+    V = X[measures].to_numpy(dtype=float)
+    S = V[np.random.default_rng(0).choice(cells, outliers_sample, replace=False)] if cells > outliers_sample else V
+    model = IsolationForest(random_state=0, n_jobs=n_jobs).fit(S)
+    # anomaly scores (negative for the anomalous cells), computed in chunks
+    outlierness = np.concatenate(Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(model.decision_function)(V[start:start + outliers_chunksize]) for start in range(0, cells, outliers_chunksize)))
+    anomalous = outlierness < 0
+    selected = select_extremes(np.where(anomalous, outlierness, np.nan)[:, None], default_k(k, cells), largest=False)[:, 0] & anomalous
+    X["model_outliers"] = selected
+    if compute_property and selected.any():
+        prop.append(["model_outliers", "True", "outlierness", round(outlierness[selected].mean(), 2)])
+    if compute_property and not selected.all():
+        prop.append(["model_outliers", "False", "outlierness", round(outlierness[~selected].mean(), 2)])
+    return X
+
+
+def skyline_model(X, measures, k, prop, compute_property):
+    """ Mark the cells in the skyline of the measures """
+    if len(measures) > 1:
+        X["model_skyline"] = skyline(X[measures].to_numpy())
+        append_split(prop, X, "model_skyline", "avgZscore", "zscore_" + measures[0], compute_property)
+    return X
+
+
+def extremes(X, measures, k, prop, compute_property, largest):
+    """ Mark the k cells with the largest (smallest) values of each measure """
+    name = "model_top_" if largest else "model_bottom_"
+    selected = select_extremes(X[measures].to_numpy(dtype=float), default_k(k, len(X.index)), largest)
     if compute_property:
-        P = P.append(pd.DataFrame(prop, columns=["model", "component", "property", "value"]))
-        P.to_csv(path + file + "_" + str(session_step) + "_properties.csv", index=False)
-else:
-    raise ValueError('Empty data')
+        # averages of the z-scores over the selected and the other cells, from the same selection
+        Z = X[["zscore_" + m for m in measures]].to_numpy(dtype=float)
+        count = selected.sum(axis=0)
+        total = Z.sum(axis=0)
+        inside = np.einsum("ij,ij->j", selected, Z)
+    for j, m in enumerate(measures):
+        X[name + m] = selected[:, j]
+        if compute_property and count[j] > 0:
+            prop.append([name + m, "True", "avgZscore", round(inside[j] / count[j], 2)])
+        if compute_property and count[j] < len(X.index):
+            prop.append([name + m, "False", "avgZscore", round((total[j] - inside[j]) / (len(X.index) - count[j]), 2)])
+    return X
+
+
+def top_k(X, measures, k, prop, compute_property):
+    """ Mark the k cells with the largest values of each measure """
+    return extremes(X, measures, k, prop, compute_property, largest=True)
+
+
+def bottom_k(X, measures, k, prop, compute_property):
+    """ Mark the k cells with the smallest values of each measure """
+    return extremes(X, measures, k, prop, compute_property, largest=False)
+
+
+# lookup table for the mining models, in the order they are applied; new models MUST be added here
+mining_models = {
+    "clustering": clustering,
+    "outliers": outliers,
+    "skyline": skyline_model,
+    "top-k": top_k,
+    "bottom-k": bottom_k
+}
+
+
+@tracing.span("describe")
+def describe(X, measures, models, k=None, compute_property=False, execution_id=-1):
+    """
+        X: cube, with lower case column names
+        measures: measures of the cube
+        models: mining models to apply (see mining_models)
+        k: size k of the models, if None it is chosen by each model
+        compute_property: whether to compute the properties of the models
+        execution_id: id of the execution, reported in the stats
+        return the enhanced cube, its properties and the time spent by each model
+    """
+    if len(X.index) == 0:
+        raise ValueError('Empty data')
+    X = X.copy()
+    prop = []
+    stats = []
+    with tracing.span("zscore", rows=len(X.index)):
+        Z = moments.zscore(X[measures], moments.moments(X[measures]))  # all the measures in a single pass
+        Z[:, X[measures].isnull().any().to_numpy()] = np.nan  # as stats.zscore, missing values propagate to the whole measure
+        for j, m in enumerate(measures):
+            X["zscore_" + m] = np.around(np.nan_to_num(Z[:, j], 0), decimals=3)
+    for model, fun in mining_models.items():
+        if model in models:
+            with tracing.span(model, rows=len(X.index)) as s:
+                X = fun(X, measures, k, prop, compute_property)
+            stats.append([execution_id, model, len(X.index), round(s.wall)])  # time is in ms
+    P = pd.DataFrame(prop, columns=["model", "component", "property", "value"])
+    return X, P, stats
+
+
+def synthetic_cube(cells, measures, seed=0):
+    """ Cube with a dimension and normally distributed measures (the first one correlated with the others) """
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.normal(size=(cells, len(measures))), columns=measures)
+    X[measures[0]] = X[measures].sum(axis=1)
+    X.insert(0, "member", np.arange(cells))
+    return X
+
+
+def benchmark(sizes, n_measures=2, models=list(mining_models.keys()), k=None, repeat=1):
+    """
+        sizes: numbers of cells of the synthetic cubes
+        n_measures: number of measures of the synthetic cubes
+        models: mining models to time
+        k: size k of the models
+        repeat: repetitions of each run
+        return the time spent by each model on each cube
+    """
+    measures = ["m" + str(i) for i in range(n_measures)]
+    res = []
+    for cells in sizes:
+        X = synthetic_cube(cells, measures)
+        for _ in range(repeat):
+            _, _, stats = describe(X, measures, models, k, compute_property=True)
+            res += stats
+    return pd.DataFrame(res, columns=["execution_id", "model", "cells", "time"]).groupby(["model", "cells"])["time"].median().unstack()
+
+
+if __name__ == '__main__':
+    ###############################################################################
+    # PARAMETERS SETUP
+    ###############################################################################
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="where to put the output", type=str)
+    parser.add_argument("--file", help="the file name", type=str)
+    parser.add_argument("--session_step", help="the session step", type=int)
+    parser.add_argument("--k", help="size k", type=int)
+    parser.add_argument("--models", nargs='*', help="mining models to apply")
+    parser.add_argument("--cube", help="cube")
+    parser.add_argument("--computeproperty", help="whether to compute properties")
+    parser.add_argument("--n_jobs", help="cores used by the models (-1: all)", type=int)
+    parser.add_argument("--trace", help="write the spans of the stages to this file (.json: Chrome trace, otherwise JSON lines)", type=str)
+    parser.add_argument("--profile", help="profile the operator (cProfile), the reports are written next to the outputs", action="store_true")
+    parser.add_argument("--profile_memory", help="with --profile, also report the allocations of the main stages (tracemalloc)", action="store_true")
+    parser.add_argument("--benchmark", nargs='*', help="time the models on synthetic cubes of the given sizes (no output is written)", type=int)
+    args = parser.parse_args()
+    n_jobs = args.n_jobs
+    if args.benchmark is not None:
+        print(benchmark(args.benchmark if len(args.benchmark) > 0 else [1000, 10000, 100000], k=args.k, models=args.models if args.models else list(mining_models.keys())))
+        exit(0)
+    path = args.path.replace("\"", "")
+    file = args.file
+    session_step = args.session_step
+    cube = args.cube.replace("__", " ")
+    compute_property = bool(args.computeproperty)
+    k = args.k
+    cube = json.loads(cube)
+    models = args.models
+
+    ###############################################################################
+    # APPLY MODELS
+    ###############################################################################
+    tracing.enabled = args.trace is not None  # otherwise the spans are not kept
+    if args.profile:
+        profiling.start(args.profile_memory)
+    with tracing.span("read") as s:
+        try:
+            X = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding='cp1252')
+        except Error:
+            X = pd.read_csv(path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+        s.rows = len(X.index)
+
+    X.columns = [x.lower() for x in X.columns]
+    measures = [x["MEA"].lower() for x in cube["MC"]]
+    X, P, _ = describe(X, measures, models, k, compute_property)
+    with tracing.span("write", rows=len(X.index)):
+        X.to_csv(path + file + "_" + str(session_step) + "_ext.csv", index=False)
+        if compute_property:
+            P.to_csv(path + file + "_" + str(session_step) + "_properties.csv", index=False)
+    if args.profile:
+        profiling.stop(profiling.prefix(path, file, session_step))
+    if args.trace is not None:
+        tracing.write(args.trace)
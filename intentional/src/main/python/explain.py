@@ -1,5 +1,6 @@
 import argparse
 import json
+import multiprocessing
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -8,11 +9,13 @@ import random
 import time
 from os import path
 from sklearn.metrics import r2_score, mean_squared_error
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import KFold, train_test_split
 from sklearn.linear_model import LinearRegression
 from sklearn.feature_selection import RFE
 from sklearn.feature_selection import RFECV
-from scipy import signal
+from scipy import fft, linalg
+import profiling
+import tracing
 
 # SEED all random generators
 seed = 4
@@ -29,6 +32,10 @@ labelsize = 14
 axessize = 12
 legendsize = 11
 markersize = 5
+# ==============================================================================
+# Feature selection of Multireg: "gram" (closed form from the Gram matrix) or "rfecv" (scikit-learn)
+# ==============================================================================
+selection = "gram"
 
 
 def prop_to_df(model, component, property, prop=None):
@@ -41,20 +48,103 @@ def prop_to_df(model, component, property, prop=None):
     return pd.DataFrame(prop, columns=["model", "component", "property", "value"])
 
 
-def multiple_regression_fit(df, y_label='y', x_labels=['x']):
+def gram_stats(X, y):
+    """ Sufficient statistics of a linear regression on the rows of X and y: n, sum(x), sum(y), X^T X, X^T y, y^T y """
+    return len(y), X.sum(axis=0), y.sum(), X.T @ X, X.T @ y, y @ y
+
+
+def centered_gram(st):
+    """ Gram matrix and moment vector of the centered data, from the sufficient statistics """
+    n, sx, sy, xx, xy, _ = st
+    return xx - np.outer(sx, sx) / n, xy - sx * sy / n
+
+
+def is_well_conditioned(C, max_cond=1e10):
+    d = np.sqrt(np.diag(C))
+    return (d > 0).all() and np.linalg.cond(C / np.outer(d, d)) < max_cond
+
+
+def backward_elimination(C, c, n_features=1):
+    """
+        C, c: centered Gram matrix and moment vector
+        n_features: number of features to keep
+        return the selected features after each elimination step (as RFE with LinearRegression and step=1: the
+        feature with the smallest squared coefficient is removed) and their coefficients
+    """
+    S = np.arange(len(c))
+    A = np.linalg.inv(C)
+    steps = []
+    while True:
+        beta = A @ c[S]
+        steps.append((S, beta))
+        if len(S) <= n_features:
+            return steps
+        k = np.argsort(beta ** 2)[0]
+        keep = np.arange(len(S)) != k
+        # rank-one downdate of the inverse, removing the k-th feature
+        A = A[keep][:, keep] - np.outer(A[keep, k], A[k, keep]) / A[k, k]
+        S = S[keep]
+
+
+def holdout_r2(train, test, S, beta):
+    """ R2 on the test rows of the regression fitted on the train rows, from their sufficient statistics """
+    n, sx, sy, xx, xy, yy = test
+    a = train[2] / train[0] - train[1][S] @ beta / train[0]  # intercept
+    sse = yy - 2 * a * sy - 2 * beta @ xy[S] + n * a * a + 2 * a * beta @ sx[S] + beta @ xx[np.ix_(S, S)] @ beta
+    sst = yy - sy * sy / n
+    if sst <= 0:  # as r2_score
+        return 1.0 if sse <= 0 else 0.0
+    return 1 - sse / sst
+
+
+def gram_rfecv(X, y, cv=3):
+    """
+        Feature selection with the same result as RFECV(LinearRegression(), step=1, cv=cv), computed in closed form
+        from the Gram matrix of each fold (X^T X and X^T y are computed once per fold, no regression is refitted).
+        return the boolean support of the selected features, None if the Gram matrix is ill-conditioned
+    """
+    X, y = np.asarray(X, dtype=float), np.asarray(y, dtype=float)
+    X, y = X - X.mean(axis=0), y - y.mean()  # shift the data to reduce cancellations
+    p = X.shape[1]
+    folds = [gram_stats(X[test], y[test]) for _, test in KFold(n_splits=cv).split(X)]
+    total = [sum(st[i] for st in folds) for i in range(6)]
+    scores = np.zeros(p)  # sum of the scores by number of features (index i is for p - i features)
+    for test in folds:
+        train = [t - f for t, f in zip(total, test)]
+        C, c = centered_gram(train)
+        if not is_well_conditioned(C):
+            return None
+        for i, (S, beta) in enumerate(backward_elimination(C, c)):
+            scores[i] += holdout_r2(train, test, S, beta)
+    n_features = np.argmax(scores[::-1]) + 1  # the lowest number of features in case of tie
+    C, c = centered_gram(total)
+    if not is_well_conditioned(C):
+        return None
+    support = np.zeros(p, dtype=bool)
+    support[backward_elimination(C, c, n_features)[-1][0]] = True
+    return support
+
+
+def multiple_regression_fit(df, y_label='y', x_labels=['x'], strategy=None):
     X, y = df[x_labels], df[y_label]
+    strategy = selection if strategy is None else strategy
     model = LinearRegression()
     if len(x_labels) == 1:
         features = x_labels
     else:
         # while len(x_labels) > 1:
         #     RFE(model, n_features_to_select=len(x_labels) - 1, step=1)
-        rfe = RFECV(estimator=model, step=1, cv=3)
-        rfe = rfe.fit(X, y)
-        features = X.columns[rfe.support_]
+        with tracing.span("select", rows=len(X.index)):
+            support = gram_rfecv(X, y) if strategy == "gram" else None
+            if support is None:  # RFECV, or collinear measures
+                rfe = RFECV(estimator=model, step=1, cv=3)
+                rfe = rfe.fit(X, y)
+                support = rfe.support_
+        features = X.columns[support]
         # print(rfe.ranking_)
     model = LinearRegression()
-    model.fit(X[features], y)
+    with tracing.span("fit", rows=len(X.index)):
+        model.fit(X[features], y)
     z = [model.intercept_] + list(model.coef_)
     z = [round(v, 2) for v in z]
     property = {
@@ -82,18 +172,28 @@ def multiple_regression_fit(df, y_label='y', x_labels=['x']):
 
 def time_series_fit(df, y_label, x_labels, max_lag=365):
     prop = []
-    y, l = df[y_label] - df[y_label].mean(), len(df[y_label])
-    var, lags = np.sum(y ** 2), signal.correlation_lags(l, l, mode="full") # the possible lags
-    for component in x_labels:
-        x = df[component] - df[component].mean()
-        cc = signal.correlate(y, x, mode="full", method="auto")
-        norm_cc = cc / np.sqrt(np.sum(x ** 2) * var)
-        abs_cc = np.abs(norm_cc)
-        best_lag = lags[np.argmax(abs_cc)]
+    Y = df[y_label].to_numpy(dtype=float)
+    X = df[x_labels].to_numpy(dtype=float)  # one column for each measure
+    l = len(Y)
+    y, x = Y - Y.mean(), X - X.mean(axis=0)
+    # cross-correlation of the target with all the measures in a single (batched) FFT pass
+    n = fft.next_fast_len(2 * l - 1)
+    with tracing.span("correlate", rows=l):
+        cc = fft.irfft(fft.rfft(y, n)[:, None] * np.conj(fft.rfft(x, n, axis=0, workers=-1)), n, axis=0, workers=-1)
+    lags = np.arange(-min(max_lag, l - 1), min(max_lag, l - 1) + 1)  # the possible lags
+    with np.errstate(invalid="ignore", divide="ignore"):
+        abs_cc = np.abs(cc[lags % n] / np.sqrt(np.sum(x ** 2, axis=0) * np.sum(y ** 2)))
+    best = np.argmax(abs_cc, axis=0)
+    best_lag = lags[best]
+    # r2 of the target against each measure shifted by its best lag
+    shifted = X[(np.arange(l)[:, None] - best_lag) % l, np.arange(len(x_labels))]
+    residual, total = np.sum((Y[:, None] - shifted) ** 2, axis=0), np.sum((Y - Y.mean()) ** 2)
+    r2 = 1 - residual / total if total > 0 else np.where(residual == 0, 1.0, 0.0)  # as r2_score
+    for j, component in enumerate(x_labels):
         property = {
-            "interest": np.max(abs_cc),
-            "lag": best_lag,
-            "r2": r2_score(df[y_label], df[component].reindex(index=np.roll(df.index, best_lag)))
+            "interest": abs_cc[best[j], j],
+            "lag": best_lag[j],
+            "r2": r2[j]
         }
         P = prop_to_df('CrossCorrelation', component, property, prop)
         # Plot the line chart
@@ -114,6 +214,31 @@ def time_series_fit(df, y_label, x_labels, max_lag=365):
     return df, P, None, None, None, None
 
 
+def polyfits(x, y, r):
+    """
+        x: values of the independent variable
+        y: values of the dependent variable
+        r: number of degrees
+        return the coefficients of the least squares polynomials of degree 0, ..., r - 1 (as np.polyfit(x, y, i)),
+        from a single QR factorization of the Vandermonde matrix (the fit of degree i uses its first i + 1 columns)
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    V = np.vander(x, r, increasing=True)
+    scale = np.sqrt((V * V).sum(axis=0))  # scale the columns to improve the condition number, as np.polyfit
+    scale[scale == 0] = 1
+    # R factor of [V | y]: its last column holds Q^T y, so Q is never formed
+    R = np.linalg.qr(np.column_stack([V / scale, y]), mode="r")
+    R, qy = R[:r, :r], R[:r, r]
+    d = np.abs(np.diag(R))
+    zs = []
+    for i in range(r):
+        if i >= len(x) or d[i] <= len(x) * np.finfo(float).eps * d[:i + 1].max():
+            zs.append(np.polyfit(x, y, i))  # rank deficient, let the SVD of np.polyfit handle it
+        else:
+            zs.append((linalg.solve_triangular(R[:i + 1, :i + 1], qy[:i + 1]) / scale[:i + 1])[::-1])
+    return zs
+
+
 def fit(df, r=5, kpi='score', m_size=1, test_size=0.33, x_label='x', y_label='y', plt_all=False):
     def myprint(z, x='x'):
         c = str(round(z[0], 2))
@@ -124,7 +249,7 @@ def fit(df, r=5, kpi='score', m_size=1, test_size=0.33, x_label='x', y_label='y'
     r = np.max([np.min([r, int(len(df) / 10) + 1]), 2]) # apply the one-to-ten rule to choose the maximum degree
     models = {}
     if test_size is not None:
-        train, test = train_test_split(df, test_size=test_size, random_state=seed)
+        train, test = train_test_split(df[[x_label, y_label]], test_size=test_size, random_state=seed)
         train = train.sort_values(by=x_label)
         test = test.sort_values(by=x_label)
     else:
@@ -139,6 +264,14 @@ def fit(df, r=5, kpi='score', m_size=1, test_size=0.33, x_label='x', y_label='y'
     error_x, error_y = [], []
     minscore, minf, mtitle, argmin = float('inf'), None, None, None
     colors = ['red', 'blue', 'green', 'orange']
+    # fit all the degrees at once, and evaluate them on the test set with a single matrix product
+    with tracing.span("fit", rows=len(train.index)):
+        zs = polyfits(train[x_label], train[y_label], r)
+    C = np.zeros((r, r))
+    for i, z in enumerate(zs):
+        C[:i + 1, i] = z[::-1]
+    with tracing.span("predict", rows=len(test.index)):
+        predictions = np.vander(test[x_label].to_numpy(dtype=float), r, increasing=True) @ C
     # iterate over some polynomial degrees
     for i in range(0, r):
         color = colors[i % len(colors)]
@@ -154,7 +287,7 @@ def fit(df, r=5, kpi='score', m_size=1, test_size=0.33, x_label='x', y_label='y'
                 ax1.scatter(train[x_label], train[y_label], s=m_size, c='black', label='Raw')
                 ax2.scatter(test[x_label], test[y_label], s=m_size, c='black', label='Raw')
         # fit the model
-        z = np.polyfit(train[x_label], train[y_label], i)
+        z = zs[i]
         f = np.poly1d(z)
         m = '{}={}'.format(y_label, myprint(list(z), x=x_label))
         if plt_all:
@@ -167,7 +300,7 @@ def fit(df, r=5, kpi='score', m_size=1, test_size=0.33, x_label='x', y_label='y'
             # In statistics, the coefficient of determination, denoted R2 or r2 and
             # pronounced "R squared", is the proportion of the variation in the
             # dependent variable that is predictable from the independent variable.
-        test_values = f(test[x_label])
+        test_values = predictions[:, i]
         interest = r2_score(test[y_label], test_values)
         mse = mean_squared_error(test[y_label], test_values)
         models[m] = {
@@ -215,22 +348,64 @@ def fit_all(X, measure, othermeasures, r=6, kpi='score', plt_all=False):
     return X, P, ax, fig, axe, fige
 
 
-def run(X, measure, measures, using, execution_id=-1):
+def run_model(X, measure, measures, model):
+    """ Apply the explanation model to the measures, return its properties """
+    if model == "Polyfit":
+        _, P, _, _, _, _ = fit_all(X, measure, measures, plt_all=False)
+    elif model == "CrossCorrelation":
+        _, P, _, _, _, _ = time_series_fit(X, measure, measures)
+    elif model == "Multireg":
+        _, P, _, _, _, _ = multiple_regression_fit(X, measure, measures)
+    else:
+        raise ValueError("Unknown model: " + model)
+    return P
+
+
+shared = None  # input of the parallel tasks, inherited by the forked workers without copies
+
+
+def run_task(task):
+    """ Run a (model, measures) task on the shared input, return the model, its properties, the time in ms and its spans """
+    X, measure = shared
+    model, measures = task
+    n = len(tracing.spans)
+    with tracing.span(model, rows=len(X.index)) as s:
+        P = run_model(X, measure, measures, model)
+    return model, P, s.wall, tracing.spans[n:]
+
+
+@tracing.span("explain")
+def run(X, measure, measures, using, execution_id=-1, n_jobs=1):
+    """
+        X: cube
+        measure: measure to explain
+        measures: measures used to explain it
+        using: explanation models
+        execution_id: id of the execution, reported in the stats
+        n_jobs: number of worker processes, Polyfit is split by measure (1: run everything in this process)
+        return the properties of the models and the time spent by each model
+    """
+    global shared
+    parallel = n_jobs != 1 and "fork" in multiprocessing.get_all_start_methods()
+    tasks = []
+    for model in using:  # Polyfit explains each measure independently
+        tasks += [(model, [m]) for m in measures] if parallel and model == "Polyfit" else [(model, measures)]
+    shared = (X, measure)
+    try:
+        if parallel:
+            with multiprocessing.get_context("fork").Pool(n_jobs if n_jobs > 0 else None) as pool:
+                results = pool.map(run_task, tasks)  # results are in the order of the tasks
+            for _, _, _, spans in results:  # spans of the workers
+                tracing.spans.extend(spans)
+        else:
+            results = [run_task(task) for task in tasks]
+    finally:
+        shared = None
     P = pd.DataFrame()
     stats = []
     for model in using:
-        start = time.time()
-        if model == "Polyfit":
-            _, curP, _, _, _, _ = fit_all(X, measure, measures, plt_all=False)
-        elif model == "CrossCorrelation":
-            _, curP, _, _, _, _ = time_series_fit(X, measure, measures)
-        elif model == "Multireg":
-            _, curP, _, _, _, _ = multiple_regression_fit(X, measure, measures)
-        else:
-            raise ValueError("Unknown model: " + model)
-        end_time = round((time.time() - start) * 1000)  # time is in ms
-        P = pd.concat([P, curP], ignore_index=True)
-        stats.append([execution_id, model, end_time])
+        P = pd.concat([P] + [curP for m, curP, _, _ in results if m == model], ignore_index=True)
+        stats.append([execution_id, model, round(sum(t for m, _, t, _ in results if m == model))])  # time is in ms
     return P, stats
 
 
@@ -247,6 +422,11 @@ if __name__ == '__main__':
     parser.add_argument("--execution_id", help="execution id", type=str)
     parser.add_argument("--against", help="measures for comparison", nargs='?', const='', default='', type=str)
     parser.add_argument("--using", help="models for explanation", nargs='?', const='', default='', type=str)
+    parser.add_argument("--selection", help="feature selection of Multireg", choices=["gram", "rfecv"], default=selection, type=str)
+    parser.add_argument("--n_jobs", help="number of worker processes (-1: all the cores)", default=1, type=int)
+    parser.add_argument("--trace", help="write the spans of the stages to this file (.json: Chrome trace, otherwise JSON lines)", type=str)
+    parser.add_argument("--profile", help="profile the operator (cProfile), the reports are written next to the outputs", action="store_true")
+    parser.add_argument("--profile_memory", help="with --profile, also report the allocations of the main stages (tracemalloc)", action="store_true")
     args = parser.parse_args()
     my_path = args.path.replace("\"", "")
     file = args.file
@@ -257,14 +437,20 @@ if __name__ == '__main__':
     cube = json.loads(cube)
     against = "" if args.against == "" else args.against.split(",")
     using = "" if args.using == "" else args.using.split(",")
+    selection = args.selection
 
     ###############################################################################
     # APPLY MODELS
     ###############################################################################
-    try:
-        X = pd.read_csv(my_path + file + "_" + str(session_step) + ".csv", encoding='cp1252')
-    except Error:
-        X = pd.read_csv(my_path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+    tracing.enabled = args.trace is not None  # otherwise the spans are not kept
+    if args.profile:
+        profiling.start(args.profile_memory)
+    with tracing.span("read") as s:
+        try:
+            X = pd.read_csv(my_path + file + "_" + str(session_step) + ".csv", encoding='cp1252')
+        except Error:
+            X = pd.read_csv(my_path + file + "_" + str(session_step) + ".csv", encoding="utf-8")
+        s.rows = len(X.index)
 
     if len(X) == 0:
         raise ValueError('Empty data')
@@ -276,9 +462,14 @@ if __name__ == '__main__':
     if len(measures) < 1:
         raise ValueError("Not enough measures: " + str(measures))
     using = ["Polyfit", "CrossCorrelation", "Multireg"] if len(using) == 0 else using
-    P, stats = run(X, measure, measures, using, execution_id)
-    P.to_csv(my_path + file + "_" + str(session_step) + "_property.csv", index=False)
-    file_path = my_path + "/../explain_time_python.csv"
-    pd \
-        .DataFrame(stats, columns=["execution_id", "model", "time_model_python"]) \
-        .to_csv(file_path, index=False, mode='a', header=not path.exists(file_path))
+    P, stats = run(X, measure, measures, using, execution_id, args.n_jobs)
+    with tracing.span("write", rows=len(P.index)):
+        P.to_csv(my_path + file + "_" + str(session_step) + "_property.csv", index=False)
+        file_path = my_path + "/../explain_time_python.csv"
+        pd \
+            .DataFrame(stats, columns=["execution_id", "model", "time_model_python"]) \
+            .to_csv(file_path, index=False, mode='a', header=not path.exists(file_path))
+    if args.profile:
+        profiling.stop(profiling.prefix(my_path, file, session_step, execution_id))
+    if args.trace is not None:
+        tracing.write(args.trace)
@@ -1,11 +1,67 @@
-import math
+import argparse
 import numpy as np
 import pandas as pd
 
+###############################################################################
+# Synthetic cubes. Cubes are generated column-wise with NumPy: a dimension
+# with a given number of members crossed with a time attribute of a given
+# granularity, measures sharing a common (trend + seasonality) factor with a
+# given correlation, and a fraction of the cells removed to make them sparse.
+###############################################################################
 points = 1000000
+# time granularities: (pandas frequency, format of the values, as expected by the operators)
+granularities = {
+    "hour": ("h", "%Y-%m-%d %H:%M:%S"),
+    "date": ("D", "%Y-%m-%d"),
+    "week": ("W-MON", "%Y-%W"),
+    "month": ("MS", "%Y-%m"),
+    "year": ("YS", "%Y")
+}
 
-df = pd.DataFrame(np.random.randint(0, 100, size=(points, 1)), columns=list('A'))
-for i in range(1, 10):
-    df["p({})".format(i)] = df['A'].apply(lambda x: math.pow(x, 1.0 / i))
 
-df.to_csv('gen_cube_{}.csv'.format(points))
+def powers(points=points, seed=None):
+    """ Cube with an attribute A in [0, 100) and its roots p(i) = A ** (1 / i), for i in 1..9 """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.integers(0, 100, size=(points, 1)), columns=list('A'))
+    A = df["A"].to_numpy(dtype=np.float64)
+    for i in range(1, 10):
+        df["p({})".format(i)] = np.power(A, 1.0 / i)
+    return df
+
+
+def cube(cells, members=10, granularity="date", sparsity=0.0, correlation=0.5, measures=2, seed=0):
+    """
+        cells: number of cells of the dense cube (members x time points)
+        members: number of members of the dimension (named M0, M1, ...)
+        granularity: time granularity (see granularities), also the name of the time attribute; the time points must
+            fall within the range of pandas timestamps (1700 to 2262)
+        sparsity: fraction of the cells that are removed
+        correlation: correlation between each measure and the common factor
+        measures: number of measures (named m0, m1, ...)
+        seed: seed of the generator
+        return a cube with columns member, <granularity>, m0, m1, ... sorted by member and time
+    """
+    rng = np.random.default_rng(seed)
+    times = max(1, cells // members)
+    freq, fmt = granularities[granularity]
+    dates = pd.date_range("1700-01-01", periods=times, freq=freq)
+    t = np.arange(times, dtype=np.float64)
+    # common factor: a level for each member, a trend and a seasonality shared by all the members
+    factor = (rng.normal(size=(members, 1)) + t / times + np.sin(2 * np.pi * t / 12)).ravel()
+    factor = (factor - factor.mean()) / (factor.std() if factor.std() > 0 else 1)
+    noise = rng.normal(size=(members * times, measures))
+    M = 10 + correlation * factor[:, None] + np.sqrt(1 - correlation ** 2) * noise  # positive values
+    names = np.array(["M" + str(i).zfill(len(str(members - 1))) for i in range(members)])  # no member is a prefix of another
+    X = pd.DataFrame({"member": np.repeat(names, times), granularity: np.tile(dates.strftime(fmt).to_numpy(), members)})
+    for j in range(measures):
+        X["m" + str(j)] = M[:, j]
+    if sparsity > 0:
+        X = X[rng.random(len(X.index)) >= sparsity].reset_index(drop=True)
+    return X
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", help="number of points", type=int, default=points)
+    args = parser.parse_args()
+    powers(args.points).to_csv('gen_cube_{}.csv'.format(args.points))
@@ -0,0 +1,170 @@
+import argparse
+import time
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+###############################################################################
+# Labeling primitives. Bin edges and label categories are compiled once per
+# schema and values are assigned to bins with np.searchsorted, producing the
+# categorical codes directly. Results are identical to pd.cut/pd.qcut.
+###############################################################################
+inf = float("inf")
+
+
+def compile_bins(edges, labels):
+    """
+        edges: increasing bin edges, bins are right-closed (a, b]
+        labels: one label for each bin
+        return the compiled schema (edges, categorical dtype)
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    if (np.diff(edges) < 0).any():
+        raise ValueError("bins must increase monotonically.")
+    if len(np.unique(edges)) < len(edges) and len(edges) != 2:
+        raise ValueError("Bin edges must be unique: " + repr(edges))
+    if len(set(labels)) != len(labels):
+        raise ValueError("labels must be unique if ordered=True; pass ordered=False for duplicate labels")
+    if len(labels) != len(edges) - 1:
+        raise ValueError("Bin labels must be one fewer than the number of bin edges")
+    return edges, pd.CategoricalDtype(categories=list(labels), ordered=True)
+
+
+@lru_cache(maxsize=None)
+def ordinal_dtype(q, suffix=""):
+    """ Categorical dtype with labels 1, 2, ..., q (each followed by suffix) """
+    return pd.CategoricalDtype(categories=[str(x + 1) + suffix for x in range(q)], ordered=True)
+
+
+@lru_cache(maxsize=None)
+def parse_schema(labeling_schema):
+    """
+        labeling_schema: custom schema such as "(100,130,bad);(130,160,ok);(160,Infinity,good)"
+        return the compiled schema (edges, categorical dtype)
+    """
+    ranges = [x[1:-1].split(",") for x in labeling_schema.split(";")]
+    edges = [float(x[0]) for x in ranges] + [float(ranges[-1][1])]
+    return compile_bins(edges, [x[2] for x in ranges])
+
+
+# fixed schemas, compiled once at import time
+fixed = {
+    "fixedratio2": compile_bins([-inf, 1, inf], ["1-lower", "2-higher"]),
+    "fixedratio3": compile_bins([-inf, 0.9, 1.1, inf], ["1-lower", "2-same", "3-higher"]),
+    "fixedratio5": compile_bins([-inf, 0.5, 0.9, 1.1, 2, inf], ["1-quite lower", "2-lower", "3-same", "4-higher", "5-quite higher"]),
+    "fixeddiff2": compile_bins([-inf, 0, inf], ["1-lower", "2-higher"]),
+    "fixeddiff3": compile_bins([-inf, -5000, 5000, inf], ["1-lower", "2-same", "3-higher"]),
+    "fixeddiff5": compile_bins([-inf, -50000, -5000, 5000, 50000, inf], ["1-quite lower", "2-lower", "3-same", "4-higher", "5-quite higher"]),
+    "fixedrel3": compile_bins([-inf, -0.1, 0.1, inf], ["1-lower", "2-same", "3-higher"]),
+    "fixedrel5": compile_bins([-inf, -0.5, -0.1, 0.1, 0.5, inf], ["1-quite lower", "2-lower", "3-same", "4-higher", "5-quite higher"]),
+}
+likert = {
+    3: pd.CategoricalDtype(categories=["1-*", "2-**", "3-***"], ordered=True),
+    5: pd.CategoricalDtype(categories=["1-*", "2-**", "3-***", "4-****", "5-*****"], ordered=True),
+}
+
+
+def to_series(codes, dtype, a):
+    """ Wrap the categorical codes into a Series aligned with a """
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), index=a.index, name=a.name)
+
+
+def bin_codes(x, edges, include_lowest=False):
+    """ Codes of the right-closed bins containing x, -1 for values outside the bins or NaN """
+    ids = np.searchsorted(edges, x, side="left")
+    if include_lowest:
+        ids[x == edges[0]] = 1
+    codes = ids - 1
+    codes[(ids == 0) | (ids == len(edges)) | np.isnan(x)] = -1
+    return codes
+
+
+def cut(a, schema):
+    """
+        a: Series of values
+        schema: compiled schema (edges, categorical dtype)
+        return the labels as pd.cut(a, edges, labels)
+    """
+    edges, dtype = schema
+    return to_series(bin_codes(np.asarray(a, dtype=np.float64), edges), dtype, a)
+
+
+def equal_width_edges(x, q):
+    """ Edges of q equal-width bins over the range of x, as pd.cut(x, bins=q) """
+    if q < 1:
+        raise ValueError("`bins` should be a positive integer.")
+    if x.size == 0:
+        raise ValueError("Cannot cut empty array")
+    mn, mx = np.nanmin(x) + 0.0, np.nanmax(x) + 0.0
+    if np.isinf(mn) or np.isinf(mx):
+        raise ValueError("cannot specify integer `bins` when input data contains infinity")
+    elif mn == mx:  # adjust end points before binning
+        mn -= 0.001 * abs(mn) if mn != 0 else 0.001
+        mx += 0.001 * abs(mx) if mx != 0 else 0.001
+        edges = np.linspace(mn, mx, q + 1, endpoint=True)
+    else:  # adjust end points after binning
+        edges = np.linspace(mn, mx, q + 1, endpoint=True)
+        edges[0] -= (mx - mn) * 0.001  # 0.1% of the range
+    return edges
+
+
+def equal_width(a, q, dtype):
+    """
+        a: Series of values
+        q: number of equal-width bins
+        dtype: categorical dtype with q labels
+        return the labels as pd.cut(a, bins=q, labels)
+    """
+    x = np.asarray(a, dtype=np.float64)
+    return to_series(bin_codes(x, equal_width_edges(x, q)), dtype, a)
+
+
+def rank_quantiles(a, q, dtype):
+    """
+        a: Series of values
+        q: number of quantiles
+        dtype: categorical dtype with q labels
+        return the labels as pd.qcut(a.rank(method='first'), q, labels)
+    """
+    x = np.asarray(a, dtype=np.float64)
+    valid = np.flatnonzero(~np.isnan(x))
+    order = valid[np.argsort(x[valid], kind="stable")]  # order[r - 1] is the cell with rank r
+    ranks = np.arange(1, len(order) + 1, dtype=np.float64)
+    edges = np.quantile(ranks, np.linspace(0, 1, q + 1))
+    if len(np.unique(edges)) < len(edges) and len(edges) != 2:
+        raise ValueError("Bin edges must be unique: " + repr(edges))
+    codes = np.full(len(x), -1, dtype=np.int64)
+    codes[order] = bin_codes(ranks, edges, include_lowest=True)
+    return to_series(codes, dtype, a)
+
+
+if __name__ == '__main__':
+    ###############################################################################
+    # MICRO-BENCHMARK: pandas labeling vs compiled labeling
+    ###############################################################################
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cells", help="number of cells", type=int, default=10000000)
+    parser.add_argument("--repeat", help="number of repetitions", type=int, default=3)
+    args = parser.parse_args()
+    np.random.seed(0)
+    a = pd.Series(np.random.normal(loc=1, scale=1, size=args.cells))
+
+    def pandas_fixed(a):
+        bins = pd.IntervalIndex.from_tuples([(-inf, 0.5), (0.5, 0.9), (0.9, 1.1), (1.1, 2), (2, inf)])
+        d = dict(zip(bins, ["1-quite lower", "2-lower", "3-same", "4-higher", "5-quite higher"]))
+        return pd.cut(a, bins).map(d)
+
+    tests = [
+        ("percentile", lambda a: pd.qcut(a.rank(method='first'), q=100, labels=[str(x + 1) + "Q" for x in range(100)]), lambda a: rank_quantiles(a, 100, ordinal_dtype(100, "Q"))),
+        ("likert5", lambda a: pd.cut(a, bins=5, labels=["1-*", "2-**", "3-***", "4-****", "5-*****"]), lambda a: equal_width(a, 5, likert[5])),
+        ("fixedratio5", pandas_fixed, lambda a: cut(a, fixed["fixedratio5"])),
+    ]
+    stats = []
+    for name, baseline, compiled in tests:
+        for impl, fun in [("pandas", baseline), ("compiled", compiled)]:
+            for _ in range(args.repeat):
+                start = time.time()
+                fun(a)
+                stats.append([name, impl, args.cells, round((time.time() - start) * 1000)])  # time is in ms
+        pd.testing.assert_series_equal(baseline(a), compiled(a))
+    print(pd.DataFrame(stats, columns=["labeling", "impl", "cells", "time"]).groupby(["labeling", "impl", "cells"]).median())
@@ -0,0 +1,90 @@
+import numpy as np
+
+###############################################################################
+# Statistics kernel. The statistics of each column (count, mean, second and
+# third central moments, min, max) are computed in a single pass over the
+# rows, chunk by chunk, and merged with the pairwise update formulas of Chan
+# et al. and Pébay. Statistics of different chunks (or of different passes of
+# a stream) can be merged in the same way. Means, standard deviations, skews,
+# z-scores and min-max normalizations all derive from these statistics.
+###############################################################################
+chunksize = 65536  # rows processed at once
+
+
+def empty(d):
+    """ Statistics of d empty columns """
+    return {"count": np.zeros(d), "mean": np.zeros(d), "m2": np.zeros(d), "m3": np.zeros(d),
+            "min": np.full(d, np.nan), "max": np.full(d, np.nan)}
+
+
+def chunk_moments(V):
+    """ Statistics of the columns of the (n_rows, n_columns) array V, missing values are ignored """
+    valid = ~np.isnan(V)
+    count = valid.sum(axis=0).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, V, 0).sum(axis=0) / count
+        d = np.where(valid, V - mean, 0)
+        d2 = d * d
+        return {"count": count, "mean": np.where(count > 0, mean, 0), "m2": d2.sum(axis=0), "m3": (d2 * d).sum(axis=0),
+                "min": np.where(count > 0, np.where(valid, V, np.inf).min(axis=0, initial=np.inf), np.nan),
+                "max": np.where(count > 0, np.where(valid, V, -np.inf).max(axis=0, initial=-np.inf), np.nan)}
+
+
+def merge(a, b):
+    """ Statistics of the union of the rows summarized by a and b """
+    na, nb = a["count"], b["count"]
+    n = na + nb
+    with np.errstate(invalid="ignore", divide="ignore"):
+        delta = b["mean"] - a["mean"]
+        w = np.where(n > 0, na * nb / n, 0)
+        return {"count": n,
+                "mean": np.where(n > 0, a["mean"] + delta * np.where(n > 0, nb / n, 0), 0),
+                "m2": a["m2"] + b["m2"] + delta ** 2 * w,
+                "m3": a["m3"] + b["m3"] + np.where(n > 0, delta ** 3 * w * (na - nb) / n + 3 * delta * (na * b["m2"] - nb * a["m2"]) / n, 0),
+                "min": np.fmin(a["min"], b["min"]),
+                "max": np.fmax(a["max"], b["max"])}
+
+
+def moments(V, size=chunksize):
+    """
+        V: (n_rows,) or (n_rows, n_columns) array (or DataFrame)
+        size: rows processed at once
+        return the statistics of each column (count, mean, m2, m3, min, max), missing values are ignored
+    """
+    V = np.asarray(V, dtype=np.float64)
+    if V.ndim == 1:
+        V = V[:, None]
+    s = empty(V.shape[1])
+    for start in range(0, len(V), size):
+        s = merge(s, chunk_moments(V[start:start + size]))
+    return s
+
+
+def mean(s):
+    return np.where(s["count"] > 0, s["mean"], np.nan)
+
+
+def std(s, ddof=1):
+    """ Standard deviation, NaN if there are not enough values (as Series.std) """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(s["count"] > ddof, np.sqrt(s["m2"] / (s["count"] - ddof)), np.nan)
+
+
+def skew(s):
+    """ Biased skewness, NaN if the values are constant (as scipy.stats.skew) """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        m2 = s["m2"] / s["count"]
+        constant = m2 <= (np.finfo(np.float64).resolution * s["mean"]) ** 2
+        return np.where(constant, np.nan, (s["m3"] / s["count"]) / m2 ** 1.5)
+
+
+def zscore(V, s, ddof=0):
+    """ Z-scores of the columns of V, given their statistics s """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (np.asarray(V, dtype=np.float64) - mean(s)) / std(s, ddof)
+
+
+def minmaxnorm(V, s):
+    """ Min-max normalization of the columns of V, given their statistics s """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (np.asarray(V, dtype=np.float64) - s["min"]) / (s["max"] - s["min"])
@@ -6,7 +6,10 @@ import random
 import warnings
 import time
 import json
-from os import path
+import hashlib
+import pickle
+import re
+from os import path, makedirs
 from itertools import product
 import argparse
 
@@ -18,7 +21,7 @@ from dotenv import dotenv_values
 import cx_Oracle
 
 # Machine Learning imports
-from sklearn.model_selection import train_test_split, GridSearchCV, RandomizedSearchCV
+from sklearn.model_selection import train_test_split, GridSearchCV, RandomizedSearchCV, ParameterSampler
 from sklearn.tree import DecisionTreeRegressor, plot_tree
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_squared_error, r2_score
@@ -34,6 +37,8 @@ from matplotlib.dates import DateFormatter
 
 # Additional libraries
 from minepy import cstats
+import profiling
+import tracing
 
 # Suppress warnings
 warnings.filterwarnings('ignore')
@@ -59,7 +64,18 @@ cv = 5
 my_path = ""
 file = ""
 session_step = ""
-models = ["univariateTS", "multivariateTS", "timeDecisionTree", "timeRandomForest", "decisionTree", "randomForest"]
+models = ["baseline", "univariateTS", "multivariateTS", "timeDecisionTree", "timeRandomForest", "decisionTree", "randomForest"]
+time_budget = None  # seconds available to the models, None for no limit
+baseline_r2 = None  # R2 of a baseline above which the other models skip a slice, None to never skip
+alphas = [0.1, 0.3, 0.5, 0.7, 0.9]  # smoothing factors tried by the exponential smoothing
+# seasonal period of each granularity (first match in the name of the date attribute), new granularities MUST be added here
+periods = {"hour": 24, "timestamp": 24, "week": 52, "date": 7, "day": 7, "month": 12, "year": 1}
+state_path = None  # folder of the fitted models, updated when the series are extended (None: always refit)
+drift = 0.1  # drop of the R2 on the new observations (since the last refit) above which a model is refitted instead of updated
+grow = 2  # trees added to a forest by each update
+cube_name = ""  # name of the cube (--cube_name) and
+cube = {}  # its description (--cube): the fitted models are stored by cube name, selection ("SC"), measure and by clause
+properties = ["model", "component", "interest", "sparsity", "endog", "exog", "component_time", "success", "success_time", "accuracy"]
 
 # Get the query
 def get_data(columns=None, filters=None, file_name=None):
@@ -90,15 +106,23 @@ def compute_mic(data, casualty_var):
     return mic_c
 
 
-def compute_model(df, target_column, model, seed=seed, test_size=test_size, n_iter=n_iter, accuracy_size=accuracy_size):
-    # print(f"compute_model test_size: {test_size}, len(df): {len(df)}")
-    df_enc = df.copy(deep=True)
+def encode(df):
+    # df is not modified, the encoded columns replace its columns in a new dataframe that shares the other ones
+    df_enc = df
     # One-hot encode object columns
     object_columns = list(df.select_dtypes(include=['object']).columns)
     if len(object_columns) > 0: df_enc = pd.get_dummies(df_enc, drop_first=True, dtype=float, prefix_sep=sep)
     # Convert data columns to float
     datetime_columns = list(df_enc.select_dtypes(include=['datetime64']).columns)
-    if len(datetime_columns) > 0: df_enc[datetime_columns] = df_enc[datetime_columns].astype('int64') / 10**9
+    if len(datetime_columns) > 0: df_enc = df_enc.copy(deep=False)
+    for x in datetime_columns: df_enc[x] = df_enc[x].astype('int64') / 10**9
+    return df_enc
+
+
+def compute_model(df, target_column, model, seed=seed, test_size=test_size, n_iter=n_iter, accuracy_size=accuracy_size):
+    # print(f"compute_model test_size: {test_size}, len(df): {len(df)}")
+    with tracing.span("encode", rows=len(df)):
+        df_enc = encode(df)
     # Create a separate dataframe for rows with missing values in the target column
     missing_values_df = df_enc[df_enc[target_column].isnull()]
     if len(missing_values_df) == 0: return df, df[target_column], None, None, None, None, None, None, None, None, None, None
@@ -109,22 +133,119 @@ def compute_model(df, target_column, model, seed=seed, test_size=test_size, n_it
     # Split the data into training and testing sets
     # X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=seed, shuffle=False)
     X_train, y_train, X_test, y_test = X[:-test_size+1], y[:-test_size+1], X[-test_size:], y[-test_size:]
-    model.fit(X_train, y_train)
+    with tracing.span("fit", rows=len(X_train)):
+        model.fit(X_train, y_train)
     # Get the best parameters and the best model
     # best_params = model.best_params_
     # best_model = model.best_estimator_
     # print('Best Hyperparameters:', best_params)
-    y_pred = model.predict(X_test)
-    # print("compute_model", len(y_test), len(y_pred), len(y_test[-accuracy_size:]))
-    value = r2_score(y_test, y_pred)
-    accuracy = r2_score(y_test[-accuracy_size:], y_pred[-accuracy_size:])
-    # Fill in missing values in the original dataframe
-    missing_values_df[target_column] = model.predict(missing_values_df.drop(target_column, axis=1))
-    df.loc[df[target_column].isnull(), target_column] = missing_values_df[target_column]
-    return df, df[target_column], X_train, y_train, X_test, y_test, y_pred, missing_values_df, value, n_iter, -1, accuracy
+    with tracing.span("predict", rows=len(X_test) + len(missing_values_df)):
+        y_pred = model.predict(X_test)
+        # print("compute_model", len(y_test), len(y_pred), len(y_test[-accuracy_size:]))
+        value = r2_score(y_test, y_pred)
+        accuracy = r2_score(y_test[-accuracy_size:], y_pred[-accuracy_size:])
+        # Fill in missing values in the original dataframe
+        missing_values_df[target_column] = model.predict(missing_values_df.drop(target_column, axis=1))
+    imputed = df[target_column].fillna(missing_values_df[target_column])  # df is not modified
+    return df, imputed, X_train, y_train, X_test, y_test, y_pred, missing_values_df, value, n_iter, -1, accuracy
+
+
+def share(deadline, parts):
+    """
+        deadline: time (as in time.time()) by which parts tasks must end, None for no limit
+        parts: tasks sharing the time left
+        return the deadline of the next task
+    """
+    if deadline is None:
+        return None
+    now = time.time()
+    return now + max(0, deadline - now) / max(1, parts)
+
+
+def fits(deadline, cost=0):
+    """ Whether a task taking cost seconds ends before the deadline """
+    return deadline is None or time.time() + cost <= deadline
+
+
+def skipped(model, component, reason):
+    """ Properties of a component that has not been computed """
+    return pd.DataFrame([[model, component, np.nan, -1, -1, -1, 0, 0, 0, np.nan, reason]], columns=properties + ["reason"])
+
+
+class BudgetedSearchCV(RandomizedSearchCV):
+    """
+        RandomizedSearchCV that evaluates the candidates one at a time and stops before the first one that would not end
+        by the deadline (estimated on the average time of the previous ones), keeping the best one so far. The first
+        candidate is always evaluated. Without a deadline, it is the same search as RandomizedSearchCV.
+    """
+
+    def __init__(self, estimator, param_distributions, *, n_iter=10, scoring=None, cv=None, random_state=None, deadline=None):
+        super().__init__(estimator, param_distributions, n_iter=n_iter, scoring=scoring, cv=cv, random_state=random_state)
+        self.deadline = deadline
+
+    def _run_search(self, evaluate_candidates):
+        start = time.time()
+        for i, candidate in enumerate(ParameterSampler(self.param_distributions, self.n_iter, random_state=self.random_state)):
+            if i > 0 and not fits(self.deadline, (time.time() - start) / i):
+                break
+            evaluate_candidates([candidate])
+
+
+def cube_key(target_measure, by):
+    """ Key of the fitted models of the cube (see store): the cube, its selection, the measure and the by clause """
+    selection = hashlib.sha1(json.dumps(cube.get("SC", []), sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return [cube_name, selection, target_measure, ",".join(by)]
+
+
+def state_file(key):
+    return path.join(state_path, re.sub(r"[^\w!.,=-]", "_", "_".join(str(x) for x in key)) + ".pkl")
+
+
+def load(key):
+    """ Fitted state of the model of a series (see store), None if there is none """
+    name = state_file(key)
+    if not path.exists(name):
+        return None
+    with open(name, "rb") as f:
+        return pickle.load(f)
+
+
+def store(key, state):
+    """
+        key: cube, series (measure and slice) and model, None if the models are not updated
+        state: fitted model, with the time points and the values of the series it has seen and its R2 at the last refit
+    """
+    if key is None:
+        return
+    makedirs(state_path, exist_ok=True)
+    with open(state_file(key), "wb") as f:
+        pickle.dump(state, f)
+
+
+def extension(key, dates, values):
+    """
+        key: key of the fitted state (see store)
+        dates, values: observed time points and values of the series
+        return the fitted state and the number of new observations if the series extends the one of the state, (None, 0) otherwise
+    """
+    state = None if key is None else load(key)
+    if state is None:
+        return None, 0
+    dates, values, n = np.asarray(dates), np.asarray(values, dtype=np.float64), len(state["dates"])
+    if len(dates) <= n or not np.array_equal(dates[:n], state["dates"]) or not np.allclose(values[:n], state["values"]):
+        return None, 0
+    return state, len(dates) - n
+
 
+def score(state, y, y_pred, accuracy_size=accuracy_size):
+    """ R2 and accuracy of the forecasts of the new observations (the ones of the last refit, if there are less than two) """
+    if len(y) < 2:
+        return state["r2"], state["accuracy"]
+    return r2_score(y, y_pred), r2_score(y[-accuracy_size:], y_pred[-accuracy_size:])
 
-def dtree(df, target_column, date_attr=None, seed=seed, test_size=test_size, accuracy_size=accuracy_size):
+
+def dtree(df, target_column, date_attr=None, seed=seed, test_size=test_size, accuracy_size=accuracy_size, deadline=None, key=None):
+    # decision trees are cheap, they are always refitted
     # print(f"dtree test_size: {test_size}")
     # Define the hyperparameters you want to search through
     param_grid = {
@@ -133,11 +254,11 @@ def dtree(df, target_column, date_attr=None, seed=seed, test_size=test_size, acc
         'min_samples_leaf': [1, 2, 4],
         'random_state': [seed] 
     }
-    model = RandomizedSearchCV(DecisionTreeRegressor(random_state=seed), param_grid, n_iter=n_iter, cv=cv, scoring='r2', random_state=seed)
+    model = BudgetedSearchCV(DecisionTreeRegressor(random_state=seed), param_grid, n_iter=n_iter, cv=cv, scoring='r2', random_state=seed, deadline=deadline)
     return compute_model(df, target_column, model, test_size=test_size, accuracy_size=accuracy_size)
 
 
-def forest(df, target_column, date_attr=None, seed=seed, test_size=test_size, accuracy_size=accuracy_size):
+def forest(df, target_column, date_attr=None, seed=seed, test_size=test_size, accuracy_size=accuracy_size, deadline=None, key=None):
     # Define hyperparameters to tune and their possible values
     param_grid = {
         'n_estimators': [2, 3, 4, 5],
@@ -146,8 +267,77 @@ def forest(df, target_column, date_attr=None, seed=seed, test_size=test_size, ac
         'min_samples_leaf': [1, 2, 4],
         'random_state': [seed] 
     }
-    model = RandomizedSearchCV(RandomForestRegressor(random_state=seed), param_grid, n_iter=n_iter, cv=cv, scoring='r2', random_state=seed)
-    return compute_model(df, target_column, model, test_size=test_size, accuracy_size=accuracy_size)
+    model = BudgetedSearchCV(RandomForestRegressor(random_state=seed), param_grid, n_iter=n_iter, cv=cv, scoring='r2', random_state=seed, deadline=deadline)
+    state, k = None, 0
+    if key is not None:
+        observed = df.dropna(subset=[target_column])
+        state, k = extension(key, observed[date_attr], observed[target_column])
+    if state is not None:  # the series extends the one of the fitted forest
+        new = encode(observed[-k:])
+        value, _ = score(state, new[target_column], state["model"].predict(new.drop(target_column, axis=1)), accuracy_size)
+        if state["r2"] - value <= drift:  # warm start: add trees fitted on the extended series
+            model = state["model"].set_params(warm_start=True, n_estimators=state["model"].n_estimators + grow)
+    res = compute_model(df, target_column, model, test_size=test_size, accuracy_size=accuracy_size)
+    if isinstance(model, BudgetedSearchCV):
+        state = {"r2": res[8], "accuracy": res[11]}
+        model = model.best_estimator_ if hasattr(model, "best_estimator_") else None
+    if key is not None and model is not None:
+        store(key, dict(state, model=model, dates=np.asarray(observed[date_attr]), values=observed[target_column].to_numpy()))
+    return res
+
+
+def holdout(Y, test_size):
+    """
+        Y: series, one for each column, with missing values
+        test_size: observed values of each series held out
+        return the training and test values, the observed values of each series are aligned to the end (missing values first)
+    """
+    Z = np.take_along_axis(Y, np.argsort(~np.isnan(Y), axis=0, kind="stable"), axis=0)
+    return Z[:-test_size], Z[-test_size:]
+
+
+def seasonal_naive(train, steps, period):
+    """ Repeat the last season of each series (the last value, if the series is shorter than a season) """
+    period = np.where((~np.isnan(train)).sum(axis=0) >= period, period, 1)
+    return np.take_along_axis(train, len(train) - period + np.arange(steps)[:, None] % period, axis=0)
+
+
+def exponential_smoothing(train, steps, period):
+    """ Simple exponential smoothing of each series, with the factor (see alphas) of least squared one-step error """
+    a = np.array(alphas)
+    level, sse = np.full((train.shape[1], len(a)), np.nan), np.zeros((train.shape[1], len(a)))
+    for y in train[:, :, None]:  # all the series and factors at once, one time point at a time
+        err = y - level
+        sse += np.where(np.isnan(err), 0, err ** 2)
+        level = np.where(np.isnan(y), level, np.where(np.isnan(level), y, level + a * err))
+    return np.repeat(level[np.arange(len(level)), sse.argmin(axis=1)][None, :], steps, axis=0)
+
+
+def linear_trend(train, steps, period):
+    """ Least squares line of each series """
+    observed = ~np.isnan(train)
+    n = observed.sum(axis=0)
+    t = np.arange(len(train))[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tmean, ymean = (t * observed).sum(axis=0) / n, np.nansum(train, axis=0) / n
+        dt = np.where(observed, t - tmean, 0)
+        slope = np.nan_to_num((dt * np.nan_to_num(train - ymean)).sum(axis=0) / (dt ** 2).sum(axis=0))
+    return ymean + slope * (len(train) + np.arange(steps)[:, None] - tmean)
+
+
+# lookup table for the baselines, new baselines MUST be added here
+baselines = {
+    "seasonalNaive": seasonal_naive,
+    "exponentialSmoothing": exponential_smoothing,
+    "linearTrend": linear_trend
+}
+
+
+def r2_scores(Y, F):
+    """ R2 score (as r2_score) of the forecasts of each column of Y, nan if Y has missing values """
+    res, tot = ((Y - F) ** 2).sum(axis=0), ((Y - Y.mean(axis=0)) ** 2).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(np.isnan(res + tot), np.nan, np.where(tot > 0, 1 - res / tot, np.where(res == 0, 1.0, 0.0)))
 
 
 def mypivot(df, date_attr, column, exog, target_measure, impute=False):
@@ -157,7 +347,7 @@ def mypivot(df, date_attr, column, exog, target_measure, impute=False):
         df.columns = [f'{col[0]}{sep}{col[1]}' if col[1] else col[0] for col in df.columns]
         df = df.reset_index()
     else:
-        df.columns = [f'{x}{sep}ALL' if x != date_attr else x for x in df.columns]
+        df = df.rename(columns={x: f'{x}{sep}ALL' for x in df.columns if x != date_attr})
     if impute:
         for x in [x for x in df.columns if target_measure not in x and df[x].isnull().any()]:
             df[x] = df[x].fillna(method='ffill').fillna(method='bfill')
@@ -200,7 +390,7 @@ def save(fig, figtitle, target_measure):
     for ext in ["svg", "pdf"]: fig.savefig(f"{my_path}{file}_{session_step}_{figtitle}_{target_measure}.{ext}")
     
 
-def timeseries(df, date_attr, column, target_measure, model, figtitle="dt", test_size=test_size, accuracy_size=accuracy_size):
+def timeseries(df, date_attr, column, target_measure, model, figtitle="dt", test_size=test_size, accuracy_size=accuracy_size, deadline=None, done=(), key=None):
     # print(f"timeseries test_size: {test_size}")
     targets = [x for x in df.columns if sep in x and target_measure in x]
     actual_targets = [c for c in targets if df[c].isnull().any()]
@@ -208,26 +398,34 @@ def timeseries(df, date_attr, column, target_measure, model, figtitle="dt", test
     axs = axs.flatten()  # Flatten the axs array if it's a multi-dimensional array
     i = 0
     P = pd.DataFrame()
-    for c in actual_targets:
-        endo=[x for x in targets if x != c]
+    imputed = df[targets].copy()  # df is shared by the models, the imputed values are written here
+    for j, c in enumerate(actual_targets):
+        if not fits(deadline):  # the slice is not imputed
+            P = pd.concat([P, skipped(figtitle, c.split(sep)[1], "time budget exhausted")], ignore_index=True)
+            continue
+        if c in done:  # a baseline is good enough
+            P = pd.concat([P, skipped(figtitle, c.split(sep)[1], "baseline reached R2 threshold")], ignore_index=True)
+            continue
         exog=[x for x in df.columns if sep in x and c.split(sep)[1] not in x]
-        cdf = df.drop(columns=endo, axis=1)  # drop the wrong target measures
-        cdf = df.drop(columns=exog, axis=1)  # drop the wrong slices
-        start = time.time()
-        cdf, y, X_train, y_train, X_test, y_test, y_pred, missing_values_df, value, success, success_time, accuracy = model(cdf, c, date_attr=date_attr, test_size=test_size, accuracy_size=accuracy_size)  # compute the model
+        cdf = df[[x for x in df.columns if x not in exog]]  # drop the wrong slices (and their target measures)
+        with tracing.span("slice", rows=len(cdf)) as s:
+            cdf, y, X_train, y_train, X_test, y_test, y_pred, missing_values_df, value, success, success_time, accuracy = model(cdf, c, date_attr=date_attr, test_size=test_size, accuracy_size=accuracy_size, deadline=share(deadline, len(actual_targets) - j), key=None if key is None else key + [figtitle, c])  # compute the model
+        imputed[c] = y
         P = pd.concat([P, pd.DataFrame([
-                [figtitle, c.split(sep)[1], value, len(missing_values_df) / len(cdf), 1, len(cdf.columns) - 2, round((time.time() - start) * 1000), success, success_time, accuracy]
-            ], columns=["model", "component", "interest", "sparsity", "endog", "exog", "component_time", "success", "success_time", "accuracy"])], ignore_index=True)
-        plot(fig, axs, cdf, date_attr, c, y, X_train, y_train, X_test, y_test, y_pred, missing_values_df, value, i, figtitle)
-        i += 2
-        save(fig, figtitle, c)
+                [figtitle, c.split(sep)[1], value, len(missing_values_df) / len(cdf), 1, len(cdf.columns) - 2, round(s.wall), success, success_time, accuracy]
+            ], columns=properties)], ignore_index=True)
+        with tracing.span("plot"):
+            plot(fig, axs, cdf, date_attr, c, y, X_train, y_train, X_test, y_test, y_pred, missing_values_df, value, i, figtitle)
+            i += 2
+            save(fig, figtitle, c)
 
-    return melt(df, date_attr, column, target_measure), P
+    return pd.concat([df[[date_attr]], imputed], axis=1), P  # the pivoted target measures (see melt for the cube)
 
 
-def sarimax(df, target_measure, date_attr, test_size=test_size, seed=seed, accuracy_size=accuracy_size):
+def sarimax(df, target_measure, date_attr, test_size=test_size, seed=seed, accuracy_size=accuracy_size, deadline=None, key=None):
     # Create a separate dataframe for rows with missing values in the target column
-    mydf = df
+    mydf = df  # not modified, the imputed values are written to their own series
+    imputed = mydf[target_measure]
     missing_values_df = df[df.isnull().any(axis=1)]
     missing_indices = missing_values_df.index
     df = df.dropna()
@@ -243,9 +441,21 @@ def sarimax(df, target_measure, date_attr, test_size=test_size, seed=seed, accur
         'p7': [0], #[4, 7, 12, 24],
     }
     best_r2, best_hp, best_y_pred, best_acc = float('-inf'), {}, None, None
+    state, k = extension(key, df[date_attr], df[target_measure])
+    updated = None
+    if state is not None:  # the series extends the one of the fitted model
+        y_new, X_new = df[target_measure][-k:], None if df[exog].empty else df[exog][-k:].to_numpy()
+        value, accuracy = score(state, y_new, np.asarray(state["results"].get_forecast(steps=k, exog=X_new).predicted_mean), accuracy_size)
+        if state["r2"] - value <= drift:  # add the new observations to the state of the model, the parameters are kept
+            with tracing.span("update", rows=k):
+                updated = state["results"].append(y_new.to_numpy(), exog=X_new)
+            best_r2, best_acc, best_hp = value, accuracy, state["hp"]
     random.seed(seed)
     success, success_time = 0, 0
-    for _ in range(min(len(list(product(*param_space.values()))), n_iter)):
+    search = time.time()
+    for i in range(0 if updated is not None else min(len(list(product(*param_space.values()))), n_iter)):
+        if i > 0 and not fits(deadline, (time.time() - search) / i):  # keep the best candidate so far
+            break
         try:
             start = time.time()
             # Generate a random set of hyperparameters
@@ -257,7 +467,8 @@ def sarimax(df, target_measure, date_attr, test_size=test_size, seed=seed, accur
             # print("initializing sarimax... order={}, seasonal_order={}".format(order, seasonal_order))
             model = SARIMAX(endog=y_train, exog=None if X_train.empty else X_train, order=order, seasonal_order=seasonal_order)
             # print("fitting...")
-            results = model.fit(iterations=200, disp=False)
+            with tracing.span("fit", rows=len(y_train)):
+                results = model.fit(iterations=200, disp=False)
             # print("forecasting...")
             y_pred = results.get_forecast(steps=test_size, exog=None if X_test.empty else X_test).predicted_mean
             y_pred.index = y_test.index
@@ -276,30 +487,38 @@ def sarimax(df, target_measure, date_attr, test_size=test_size, seed=seed, accur
         except Exception as e:
             print(f"sarimax({c_hp}) - training: {e}")
     
+    c_hp = best_hp  # also when the model is updated, without any trial
     try:
         start = time.time()
-        order = (best_hp["p1"], best_hp["p2"], best_hp["p3"])
-        seasonal_order = (best_hp["p4"], best_hp["p5"], best_hp["p6"], best_hp["p7"])
-        model = SARIMAX(endog=df[target_measure], exog=None if df[exog].empty else df[exog], order=order, seasonal_order=seasonal_order)
-        results = model.fit(iterations=100, disp=False)
+        if updated is None:  # refit
+            order = (best_hp["p1"], best_hp["p2"], best_hp["p3"])
+            seasonal_order = (best_hp["p4"], best_hp["p5"], best_hp["p6"], best_hp["p7"])
+            model = SARIMAX(endog=df[target_measure], exog=None if df[exog].empty else df[exog], order=order, seasonal_order=seasonal_order)
+            with tracing.span("fit", rows=len(df)):
+                results = model.fit(iterations=100, disp=False)
+            state = {"hp": best_hp, "r2": best_r2, "accuracy": best_acc}
+        else:
+            results = updated
+        store(key, dict(state, results=results, dates=np.asarray(df[date_attr]), values=df[target_measure].to_numpy()))
         forecast = results.get_prediction(start=missing_indices[0], end=missing_indices[-1], exog=None if mydf[exog].loc[missing_indices].empty else mydf[exog].loc[missing_indices]).predicted_mean
         forecast.index = mydf.loc[missing_indices[0]:missing_indices[-1]].index
         missing_values_df[target_measure] = forecast
-        mydf.loc[mydf[target_measure].isnull(), target_measure] = missing_values_df[target_measure]
+        imputed = imputed.fillna(missing_values_df[target_measure])
         success += 1
         success_time += round((time.time() - start) * 1000)
     except Exception as e:
         print(f"sarimax({c_hp}) - predicting: {e}")
-    return mydf, mydf[target_measure], X_train, y_train, X_test, y_test, best_y_pred, missing_values_df, best_r2, success, success_time, best_acc
+    return mydf, imputed, X_train, y_train, X_test, y_test, best_y_pred, missing_values_df, best_r2, success, success_time, best_acc
 
 
-def varmax(df, date_attr, target_measure, test_size=test_size, accuracy_size=accuracy_size):
+def varmax(df, date_attr, target_measure, test_size=test_size, accuracy_size=accuracy_size, deadline=None, key=None):
     # Create a separate dataframe for rows with missing values in the target column
     exog = [x for x in df.columns if target_measure.split(sep)[0] not in x and x != date_attr]
     endo = [x for x in df.columns if target_measure in x]
     print(f"Exogeneous: {exog}, Endogeneous: {endo}")
-    mydf = df
+    mydf = df  # not modified, the imputed values are written to their own dataframe
     all_values = df
+    imputed = mydf[endo]
     missing_indices = df[df.isnull().any(axis=1)].index
     df = df.dropna()
     X_train, Y_train, X_test, Y_test = df[exog][:-test_size+1], df[endo][:-test_size+1], df[exog][-test_size:], df[endo][-test_size:]
@@ -308,15 +527,28 @@ def varmax(df, date_attr, target_measure, test_size=test_size, accuracy_size=acc
         'p2': [0, 1, 2] # , 4, 8, 24
     }
     Y_pred, forecast, best_r2, best_hp, best_Y_pred, best_acc = None, None, float('-inf'), {}, None, None
+    state, k = extension(key, df[date_attr], df[endo])
+    updated = None
+    if state is not None:  # the series extend the ones of the fitted model
+        Y_new, X_new = df[endo][-k:], None if df[exog].empty else df[exog][-k:].to_numpy()
+        value, accuracy = score(state, Y_new, np.asarray(state["results"].get_forecast(steps=k, exog=X_new).predicted_mean), accuracy_size)
+        if state["r2"] - value <= drift:  # add the new observations to the state of the model, the parameters are kept
+            with tracing.span("update", rows=k):
+                updated = state["results"].append(Y_new.to_numpy(), exog=X_new)
+            best_r2, best_acc, best_hp = value, accuracy, state["hp"]
     random.seed(seed)
     success, success_time = 0, 0
-    for _ in range(min(len(list(product(*param_space.values()))), n_iter)):
+    search = time.time()
+    for i in range(0 if updated is not None else min(len(list(product(*param_space.values()))), n_iter)):
+        if i > 0 and not fits(deadline, (time.time() - search) / i):  # keep the best candidate so far
+            break
         try:
             start = time.time()
             # Generate a random set of hyperparameters
             c_hp = {hp: random.choice(values) for hp, values in param_space.items()}
             model = VARMAX(endog=Y_train, exog=None if X_train.empty else X_train, order=(c_hp["p1"], c_hp["p2"]))
-            results = model.fit(iterations=100, disp=False)
+            with tracing.span("fit", rows=len(Y_train)):
+                results = model.fit(iterations=100, disp=False)
             fcst = results.get_forecast(steps=test_size, exog=None if X_test.empty else X_test)
             Y_pred = fcst.predicted_mean
             # print("varmax", len(Y_test), len(Y_pred), len(Y_test[-accuracy_size:]))
@@ -336,53 +568,94 @@ def varmax(df, date_attr, target_measure, test_size=test_size, accuracy_size=acc
     try:
         start = time.time()
         c_hp = best_hp
-        model = VARMAX(endog=df[endo], exog=None if df[exog].empty else df[exog], order=(best_hp["p1"], best_hp["p2"]))
-        results = model.fit(iterations=100, disp=False)
+        if updated is None:  # refit
+            model = VARMAX(endog=df[endo], exog=None if df[exog].empty else df[exog], order=(best_hp["p1"], best_hp["p2"]))
+            with tracing.span("fit", rows=len(df)):
+                results = model.fit(iterations=100, disp=False)
+            state = {"hp": best_hp, "r2": best_r2, "accuracy": best_acc}
+        else:
+            results = updated
+        store(key, dict(state, results=results, dates=np.asarray(df[date_attr]), values=df[endo].to_numpy()))
         forecast = results.get_prediction(start=missing_indices[0], end=missing_indices[-1], exog=None if mydf[exog].loc[missing_indices].empty else mydf[exog].loc[missing_indices]).predicted_mean
         forecast.index = all_values.loc[missing_indices[0]:missing_indices[-1]].index
-        all_values[endo] = all_values[endo].fillna(forecast)
+        imputed = imputed.fillna(forecast)
         success += 1
         success_time += round((time.time() - start) * 1000)
     except Exception as e:
         print(f"varmax({c_hp}) - predicting: {e}")
-    return mydf, mydf[endo], X_train, Y_train, X_test, Y_test, best_Y_pred, forecast.loc[missing_indices] if forecast is not None else None, best_r2, success, success_time, best_acc
+    return mydf, imputed, X_train, Y_train, X_test, Y_test, best_Y_pred, forecast.loc[missing_indices] if forecast is not None else None, best_r2, success, success_time, best_acc
 
 
-def multi_timeseries(df, date_attr, column, target_measure, model, figtitle, test_size=test_size, accuracy_size=accuracy_size):
+def multi_timeseries(df, date_attr, column, target_measure, model, figtitle, test_size=test_size, accuracy_size=accuracy_size, deadline=None, key=None):
     targets = [x for x in df.columns if sep in x and target_measure in x]
     fig, axs = plt.subplots(len(targets), 2, figsize=(8, 1 + 3*len(targets)), sharex=False, sharey=False)  # Create a figure and subplots
     axs = axs.flatten()  # Flatten the axs array if it's a multi-dimensional array
     i = 0
-    start = time.time()
-    df, Y, X_train, Y_train, X_test, Y_test, Y_pred, missing_values_df, value, success, success_time, accuracy = model(df, date_attr, target_measure, test_size=test_size, accuracy_size=accuracy_size)
+    with tracing.span("slice", rows=len(df)) as s:
+        df, Y, X_train, Y_train, X_test, Y_test, Y_pred, missing_values_df, value, success, success_time, accuracy = model(df, date_attr, target_measure, test_size=test_size, accuracy_size=accuracy_size, deadline=deadline, key=None if key is None else key + [figtitle, target_measure])
     P = pd.DataFrame([
-            ['multivariateTS', 'ALL', value, (len(missing_values_df) / len(df)) if missing_values_df is not None else -1, len(targets), len(df.columns) - 1 - len(targets), round((time.time() - start) * 1000), success, success_time, accuracy],  # -1 is for the data_attr column
-        ], columns=["model", "component", "interest", "sparsity", "endog", "exog", "component_time", "success", "success_time", "accuracy"])
+            ['multivariateTS', 'ALL', value, (len(missing_values_df) / len(df)) if missing_values_df is not None else -1, len(targets), len(df.columns) - 1 - len(targets), round(s.wall), success, success_time, accuracy],  # -1 is for the data_attr column
+        ], columns=properties)
+
+    with tracing.span("plot"):
+        for c in targets:
+            if missing_values_df is not None:
+                plot(fig, axs, df, date_attr, c, Y[c], X_train, Y_train[c], X_test, Y_test[c], None if Y_pred is None else Y_pred[c], missing_values_df, value, i, figtitle)
+            i += 2
+            save(fig, figtitle, c)
+    return pd.concat([df[[date_attr]], Y], axis=1), P  # the pivoted target measures (see melt for the cube)
 
-    for c in targets:
-        if missing_values_df is not None:
-            plot(fig, axs, df, date_attr, c, Y[c], X_train, Y_train[c], X_test, Y_test[c], Y_pred[c], missing_values_df, value, i, figtitle)
-        i += 2
-        save(fig, figtitle, c)
-    return melt(df, date_attr, column, target_measure), P
+
+def baseline(df, date_attr, target_measure, test_size=test_size, accuracy_size=accuracy_size):
+    """
+        Fit the baselines to all the slices at once, on the same holdout as the other models
+        return the properties of the components, and the best R2 of each slice
+    """
+    targets = [x for x in df.columns if sep in x and target_measure in x and df[x].isnull().any()]
+    if len(targets) == 0 or not 0 < test_size < len(df):
+        return pd.DataFrame(), {}
+    period = next((p for g, p in periods.items() if g in date_attr), 1)
+    train, test = holdout(df[targets].to_numpy(dtype=np.float64), test_size)
+    sparsity = df[targets].isnull().mean().to_numpy()
+    P, best = pd.DataFrame(), np.full(len(targets), -np.inf)
+    for name, forecaster in baselines.items():
+        with tracing.span(name, rows=train.size) as s:
+            F = forecaster(train, test_size, period)
+        value, accuracy = r2_scores(test, F), r2_scores(test[-accuracy_size:], F[-accuracy_size:])
+        best = np.fmax(best, value)
+        P = pd.concat([P, pd.DataFrame([
+                [name, c.split(sep)[1], value[j], sparsity[j], 1, 0, round(s.wall / len(targets)), 1, round(s.wall / len(targets)), accuracy[j]] for j, c in enumerate(targets)
+            ], columns=properties)], ignore_index=True)
+    return P, dict(zip(targets, best))
 
 
-def predict(df, by, target_measure, using=models, nullify_last=None, execution_id=-1, test_size=test_size, accuracy_size=accuracy_size):
+@tracing.span("predict")
+def predict(df, by, target_measure, using=models, nullify_last=None, execution_id=-1, test_size=test_size, accuracy_size=accuracy_size, time_budget=time_budget, baseline_r2=baseline_r2):
+    """
+        time_budget: seconds available to the models, None for no limit. Each model family gets an equal share of the
+            time left (the time not used by a family goes to the next ones) and the hyperparameter searches stop when
+            the share is over, keeping the best candidate so far; the families (and the slices) that start when no
+            time is left are skipped, with the reason in P
+        baseline_r2: R2 of a baseline above which the other models skip a slice (the models that are not fitted on
+            each slice are skipped if every slice reaches it), None to never skip. The baselines run first
+    """
+    deadline = None if time_budget is None else time.time() + time_budget
     date_attr = [x for x in by if "week" in x or "hour" in x or "timestamp" in x or "date" in x or "day" in x or "month" in x or "year" in x]
     if len(date_attr) == 0:
         date_attr = None
     else:
         date_attr = date_attr[0] # keep only one date attribute
-        if "week" in date_attr:
-            df[date_attr] = pd.to_datetime(df[date_attr] + '-1', format='%Y-%W-%w')
-        elif "month" in date_attr:
-            df[date_attr] = pd.to_datetime(df[date_attr] + '-01', format='%Y-%m-%d')
-        elif "year" in date_attr:
-            df[date_attr] = pd.to_datetime(df[date_attr] + '-01-01', format='%Y-%m-%d')
-        elif "hour" in date_attr or "timestamp" in date_attr:
-            df[date_attr] = pd.to_datetime(df[date_attr], format='%Y-%m-%d %H:%M:%S')
-        else:
-            df[date_attr] = pd.to_datetime(df[date_attr], format='%Y-%m-%d')
+        with tracing.span("parse", rows=len(df)):
+            if "week" in date_attr:
+                df[date_attr] = pd.to_datetime(df[date_attr] + '-1', format='%Y-%W-%w')
+            elif "month" in date_attr:
+                df[date_attr] = pd.to_datetime(df[date_attr] + '-01', format='%Y-%m-%d')
+            elif "year" in date_attr:
+                df[date_attr] = pd.to_datetime(df[date_attr] + '-01-01', format='%Y-%m-%d')
+            elif "hour" in date_attr or "timestamp" in date_attr:
+                df[date_attr] = pd.to_datetime(df[date_attr], format='%Y-%m-%d %H:%M:%S')
+            else:
+                df[date_attr] = pd.to_datetime(df[date_attr], format='%Y-%m-%d')
 
     column = [x for x in by if x != date_attr]
     if len(column) == 0:
@@ -395,15 +668,21 @@ def predict(df, by, target_measure, using=models, nullify_last=None, execution_i
 
     P = pd.DataFrame()
     stats = []
+    families = [m for m in using if m in ["univariateTS", "timeRandomForest", "timeDecisionTree"] and date_attr is not None]
+    families += [m for m in using if m == "multivariateTS" and date_attr is not None and column is not None and df[column].nunique() > 1]
+    families += [m for m in using if m in ["decisionTree", "randomForest"]]
+    left = len(families)  # families still to run
+    key = None if state_path is None else cube_key(target_measure, by)  # to update the fitted models
+    done, everywhere = [], False  # slices whose best baseline reaches baseline_r2, and whether they are all of them
 
     # Time aware
     if date_attr is not None:
         # Pivot
-        start = time.time()
-        pdf = mypivot(df.copy(deep=True), date_attr, column, values, target_measure, impute=True)
-        end_time = round((time.time() - start) * 1000)  # time is in ms
-        stats.append([execution_id, "pivot", end_time])
-        pdf.to_csv(my_path + file + "_" + session_step + "_pdf.csv", index=False)
+        with tracing.span("pivot", rows=len(df)) as s:
+            pdf = mypivot(df, date_attr, column, values, target_measure, impute=True)
+        stats.append([execution_id, "pivot", round(s.wall)])  # time is in ms
+        with tracing.span("write", rows=len(pdf)):
+            pdf.to_csv(my_path + file + "_" + session_step + "_pdf.csv", index=False)
         # Add null values in the end, if necessary
         if nullify_last is not None:
             for x in [x for x in pdf.columns if target_measure in x]:
@@ -412,25 +691,42 @@ def predict(df, by, target_measure, using=models, nullify_last=None, execution_i
         test_pivot_size = round(len(pdf) * test_size / 100.0)
         test_accuracy_size = int(min(test_pivot_size, accuracy_size))
         print(f"test_pivot_size: {test_pivot_size}, accuracy_size: {accuracy_size}")
+        if "baseline" in using:
+            with tracing.span("baseline", rows=len(pdf)) as s:
+                Q, best = baseline(pdf, date_attr, target_measure, test_size=test_pivot_size, accuracy_size=test_accuracy_size)
+            P = pd.concat([P, Q], ignore_index=True)
+            stats.append([execution_id, "baseline", round(s.wall)])  # time is in ms
+            done = [c for c, value in best.items() if baseline_r2 is not None and value >= baseline_r2]
+            everywhere = len(done) > 0 and len(done) == len(best)
         for model in using:
             alg = None
-            start = time.time()
             if model == "univariateTS": alg=sarimax
             elif model == "timeRandomForest": alg=forest
             elif model == "timeDecisionTree": alg=dtree
+            if (alg is not None or model == "multivariateTS") and model in families and not fits(deadline):
+                P = pd.concat([P, skipped(model, 'ALL', "time budget exhausted")], ignore_index=True)
+                left -= 1
+                continue
+            if model == "multivariateTS" and model in families and everywhere:
+                P = pd.concat([P, skipped(model, 'ALL', "baseline reached R2 threshold")], ignore_index=True)
+                left -= 1
+                continue
             if alg is not None:
-                _, Q = timeseries(pdf.copy(deep=True), date_attr, column, target_measure, alg, figtitle=model, test_size=test_pivot_size, accuracy_size=test_accuracy_size)
-                end_time = round((time.time() - start) * 1000)  # time is in ms
+                with tracing.span(model, rows=len(pdf)) as s:
+                    _, Q = timeseries(pdf, date_attr, column, target_measure, alg, figtitle=model, test_size=test_pivot_size, accuracy_size=test_accuracy_size, deadline=share(deadline, left), done=done, key=key)
+                left -= 1
                 P = pd.concat([P, Q], ignore_index=True)
-                stats.append([execution_id, model, end_time])
+                stats.append([execution_id, model, round(s.wall)])  # time is in ms
             if model == "multivariateTS" and column is not None and df[column].nunique() > 1: # : #
-                _, Q = multi_timeseries(pdf.copy(deep=True), date_attr, column, target_measure, varmax, figtitle=model, test_size=test_pivot_size, accuracy_size=test_accuracy_size)
-                end_time = round((time.time() - start) * 1000)  # time is in ms
+                with tracing.span(model, rows=len(pdf)) as s:
+                    _, Q = multi_timeseries(pdf, date_attr, column, target_measure, varmax, figtitle=model, test_size=test_pivot_size, accuracy_size=test_accuracy_size, deadline=share(deadline, left), key=key)
+                left -= 1
                 P = pd.concat([P, Q], ignore_index=True)
-                stats.append([execution_id, model, end_time])
+                stats.append([execution_id, model, round(s.wall)])  # time is in ms
 
     # Time agnostic
-    df.to_csv(my_path + file + "_" + session_step + "_df.csv", index=False)
+    with tracing.span("write", rows=len(df)):
+        df.to_csv(my_path + file + "_" + session_step + "_df.csv", index=False)
     test_size = round(len(df) * test_size / 100.0)
     test_accuracy_size = int(min(test_size, accuracy_size))
 
@@ -438,16 +734,23 @@ def predict(df, by, target_measure, using=models, nullify_last=None, execution_i
     for model in using:
         print(f"Executing: {model}")
         alg = None
-        start = time.time()
         if model == "decisionTree": alg=dtree
         elif model == "randomForest": alg=forest
-        if alg is not None:
-            _, _, _, _, _, _, _, missing_values_df, value, success, success_time, accuracy = alg(df.copy(deep=True), target_measure, test_size=test_size, accuracy_size=test_accuracy_size)
-            end_time = round((time.time() - start) * 1000)  # time is in ms
+        if alg is not None and not fits(deadline):
+            P = pd.concat([P, skipped(model, 'ALL', "time budget exhausted")], ignore_index=True)
+            left -= 1
+        elif alg is not None and everywhere:
+            P = pd.concat([P, skipped(model, 'ALL', "baseline reached R2 threshold")], ignore_index=True)
+            left -= 1
+        elif alg is not None:
+            with tracing.span(model, rows=len(df)) as s:
+                _, _, _, _, _, _, _, missing_values_df, value, success, success_time, accuracy = alg(df, target_measure, test_size=test_size, accuracy_size=test_accuracy_size, deadline=share(deadline, left))
+            left -= 1
+            end_time = round(s.wall)  # time is in ms
             P = pd.concat([P,
                         pd.DataFrame(
                             [[model, 'ALL', value, -1 if missing_values_df is None else (len(missing_values_df) / len(df)), -1, -1, end_time, success, success_time, accuracy]],
-                            columns=["model", "component", "interest", "sparsity", "endog", "exog", "component_time", "success", "success_time", "accuracy"]
+                            columns=properties
                         )
                 ], ignore_index=True)
             stats.append([execution_id, model, end_time])
@@ -463,11 +766,19 @@ if __name__ == '__main__':
     parser.add_argument("--file", help="the file name", type=str)
     parser.add_argument("--session_step", help="the session step", type=int)
     parser.add_argument("--cube", help="cube", type=str)
+    parser.add_argument("--cube_name", help="name of the cube", type=str)
     parser.add_argument("--measure", help="target measure to predict", type=str)
     parser.add_argument("--execution_id", help="execution id", type=str)
     parser.add_argument("--using", help="models for prediction", nargs='?', const='', default='', type=str)
     parser.add_argument("--nullify", help="Percentage of values to nullify", type=float)
     parser.add_argument("--accuracy_size", help="Size of the accuracy set", type=float)
+    parser.add_argument("--time_budget", help="seconds available to the models (default: no limit)", type=float)
+    parser.add_argument("--baseline_r2", help="R2 of a baseline above which the other models skip a slice (default: never skip)", type=float)
+    parser.add_argument("--state_path", help="folder of the fitted models, updated when the series are extended (default: always refit)", type=str)
+    parser.add_argument("--drift", help="drop of the R2 on the new observations above which a model is refitted", type=float)
+    parser.add_argument("--trace", help="write the spans of the stages to this file (.json: Chrome trace, otherwise JSON lines)", type=str)
+    parser.add_argument("--profile", help="profile the operator (cProfile), the reports are written next to the outputs", action="store_true")
+    parser.add_argument("--profile_memory", help="with --profile, also report the allocations of the main stages (tracemalloc)", action="store_true")
 
     args = parser.parse_args()
     my_path = args.path.replace("\"", "")
@@ -477,15 +788,23 @@ if __name__ == '__main__':
     execution_id = args.execution_id
     cube = args.cube.replace("__", " ")
     cube = json.loads(cube)
+    cube_name = "" if args.cube_name is None else args.cube_name.replace("__", " ")
     using = "" if args.using == "" else args.using.split(",")
     nullify = 0 if args.nullify is None else args.nullify
     accuracy_size = accuracy_size if args.accuracy_size is None else args.accuracy_size
+    state_path = args.state_path
+    drift = drift if args.drift is None else args.drift
 
+    tracing.enabled = args.trace is not None  # otherwise the spans are not kept
+    if args.profile:
+        profiling.start(args.profile_memory)
     # Load the data
-    try:
-        X = pd.read_csv(my_path + file + "_" + session_step + ".csv", encoding='cp1252')
-    except Error:
-        X = pd.read_csv(my_path + file + "_" + session_step + ".csv", encoding="utf-8")
+    with tracing.span("read") as s:
+        try:
+            X = pd.read_csv(my_path + file + "_" + session_step + ".csv", encoding='cp1252')
+        except Error:
+            X = pd.read_csv(my_path + file + "_" + session_step + ".csv", encoding="utf-8")
+        s.rows = len(X)
     # Ensure that we have enough data
     if len(X) == 0:
         raise ValueError('Empty data')
@@ -516,17 +835,22 @@ if __name__ == '__main__':
         columns=["execution_id", "nullify", "cardinality", "missing_values", "not_missing_values", "test_size", "cardinality_acc"]
     ).to_csv(file_path, index=False, mode='a', header=not path.exists(file_path))
     # execute the operator
-    P, stats = predict(X, by, measure, nullify_last=None, using=using, execution_id=execution_id, test_size=test_size, accuracy_size=accuracy_size)
-    # write the statistics on the components
-    P.to_csv(my_path + file + "_" + session_step + "_property.csv", index=False)
-    # write the statistics on the execution times
-    file_path = my_path + "../predict_models.csv"
-    R = pd.DataFrame(stats, columns=["execution_id", "model", "time"])
-    if path.exists(file_path):
-        R = pd.concat([R, pd.read_csv(file_path)])
-    R.to_csv(file_path, index=False, header=True)
-    file_path = my_path + "../predict_components.csv"
-    P["execution_id"] = execution_id
-    if path.exists(file_path):
-        P = pd.concat([P, pd.read_csv(file_path)])
-    P.to_csv(file_path, index=False, header=True)
+    P, stats = predict(X, by, measure, nullify_last=None, using=using, execution_id=execution_id, test_size=test_size, accuracy_size=accuracy_size, time_budget=args.time_budget, baseline_r2=args.baseline_r2)
+    with tracing.span("write", rows=len(P)):
+        # write the statistics on the components
+        P.to_csv(my_path + file + "_" + session_step + "_property.csv", index=False)
+        # write the statistics on the execution times
+        file_path = my_path + "../predict_models.csv"
+        R = pd.DataFrame(stats, columns=["execution_id", "model", "time"])
+        if path.exists(file_path):
+            R = pd.concat([R, pd.read_csv(file_path)])
+        R.to_csv(file_path, index=False, header=True)
+        file_path = my_path + "../predict_components.csv"
+        P["execution_id"] = execution_id
+        if path.exists(file_path):
+            P = pd.concat([P, pd.read_csv(file_path)])
+        P.to_csv(file_path, index=False, header=True)
+    if args.profile:
+        profiling.stop(profiling.prefix(my_path, file, session_step, execution_id))
+    if args.trace is not None:
+        tracing.write(args.trace)
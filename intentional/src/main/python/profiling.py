@@ -0,0 +1,81 @@
+import cProfile
+import pstats
+import tracemalloc
+import tracing
+
+###############################################################################
+# Opt-in profiling of the operators (--profile). The operator runs under
+# cProfile, whose statistics are dumped as <prefix>.prof (for snakeviz,
+# gprof2dot, pstats) and summarized in <prefix>_prof.txt. With --profile_memory
+# tracemalloc also takes a snapshot whenever a main stage (a span of depth at
+# most max_depth, see tracing) ends, and <prefix>_alloc.txt reports the
+# allocations of each stage. When profiling is off nothing is installed.
+###############################################################################
+top = 50  # functions (and allocation sites) in the text reports
+frames = 1  # frames stored by tracemalloc for each allocation
+max_depth = 1  # deepest spans whose end is a stage boundary
+profiler = None
+snapshots = []  # (stage, snapshot)
+
+
+def prefix(folder, file, session_step, execution_id=None):
+    """ Prefix of the reports, next to the outputs of the operator """
+    return folder + file + "_" + str(session_step) + ("" if execution_id is None else "_" + str(execution_id))
+
+
+def snapshot(s):
+    """ Tracing listener, take a snapshot at the end of the main stages """
+    if s.depth <= max_depth:
+        snapshots.append((s.name, tracemalloc.take_snapshot()))
+
+
+def allocations(before, after):
+    """ Allocation sites of the memory allocated between the snapshots, the ones of the profiler are ignored """
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    return after.filter_traces(ignored).compare_to(before.filter_traces(ignored), "lineno")
+
+
+def start(memory=False):
+    """
+        Start profiling
+        memory: whether to trace the allocations of the stages as well
+    """
+    global profiler
+    if memory:
+        tracemalloc.start(frames)
+        tracing.listeners.append(snapshot)
+        snapshots.append(("start", tracemalloc.take_snapshot()))
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+
+def stop(prefix):
+    """
+        Stop profiling and write the reports
+        prefix: prefix of the reports (see prefix)
+        return the files written
+    """
+    global profiler
+    profiler.disable()
+    files = [prefix + ".prof", prefix + "_prof.txt"]
+    profiler.dump_stats(files[0])
+    with open(files[1], "w") as f:
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(top)
+    profiler = None
+    if tracemalloc.is_tracing() and len(snapshots) > 0:
+        tracing.listeners.remove(snapshot)
+        snapshots.append(("end", tracemalloc.take_snapshot()))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        files.append(prefix + "_alloc.txt")
+        with open(files[2], "w") as f:
+            f.write("peak traced memory: {:.1f} MB\n".format(peak / 2 ** 20))
+            for (_, before), (stage, after) in zip(snapshots[:-1], snapshots[1:]):
+                stats = allocations(before, after)
+                f.write("\n### {} (allocated: {:+.1f} MB, held: {:.1f} MB)\n".format(
+                    stage, sum(x.size_diff for x in stats) / 2 ** 20, sum(x.size for x in stats) / 2 ** 20))
+                for x in stats[:top]:
+                    f.write(str(x) + "\n")
+        snapshots.clear()
+    return files
+
@@ -13,3 +13,5 @@ python3 gen_cube.py
 python3 -m unittest -f TestAssess.py
 python3 -m unittest -f TestAssessExt.py
 python3 -m unittest -f TestExplain.py
+python3 -m unittest -f TestDescribe.py
+python3 -m unittest -f TestBenchmark.py
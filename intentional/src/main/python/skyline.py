@@ -0,0 +1,126 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+###############################################################################
+# Skyline operator. A point is in the skyline if no other point is strictly
+# greater on every measure. With one or two measures the skyline is computed by
+# a single sort and sweep; with more measures, points are presorted by the sum
+# of their measures (a dominator always precedes the points it dominates) and
+# each block of skyline points filters out the remaining candidates at once
+# (sort-filter-skyline).
+###############################################################################
+block_size = 1024  # largest block of candidates checked at once
+max_comparisons = 1 << 22  # point pairs compared at once, bounds the memory of the filter
+
+
+# #########################################################################
+# https://stackoverflow.com/questions/32791911/fast-calculation-of-pareto-front-in-python
+# #########################################################################
+def is_pareto_efficient_simple(costs):
+    """
+    Find the pareto-efficient points
+    :param costs: An (n_points, n_costs) array
+    :return: A (n_points, ) boolean array, indicating whether each point is Pareto efficient
+    """
+    is_efficient = np.ones(costs.shape[0], dtype=bool)
+    for i, c in enumerate(costs):
+        if is_efficient[i]:
+            is_efficient[is_efficient] = np.any(costs[is_efficient] >= c, axis=1)  # Keep any point with a lower cost
+            is_efficient[i] = True  # And keep self
+    return is_efficient
+
+
+def sweep(X):
+    """ Skyline of two measures: sort by the first one and compare the second one with the best of the previous points """
+    n = len(X)
+    order = np.lexsort((-X[:, 1], -X[:, 0]))
+    x, y = X[order, 0], X[order, 1]
+    # points with the same first measure do not dominate each other, compare with the points before their group
+    first = np.maximum.accumulate(np.where(np.r_[True, x[1:] != x[:-1]], np.arange(n), 0))
+    best = np.maximum.accumulate(y)
+    before = np.where(first > 0, best[first - 1], -np.inf)
+    is_efficient = np.empty(n, dtype=bool)
+    is_efficient[order] = y >= before
+    return is_efficient
+
+
+def dominated(B, S):
+    """ Whether each point of B is strictly dominated by some point of S """
+    res = np.zeros(len(B), dtype=bool)
+    step = max(1, max_comparisons // max(1, len(B)))
+    for start in range(0, len(S), step):
+        res |= (S[start:start + step][None, :, :] > B[:, None, :]).all(axis=2).any(axis=1)
+    return res
+
+
+def sort_filter(X, block=block_size):
+    """ Skyline of any number of measures (sort-filter-skyline with growing blocks of points) """
+    rest = np.argsort(-X.sum(axis=1), kind="stable")  # candidates, by decreasing sum
+    is_efficient = np.zeros(len(X), dtype=bool)
+    size = 1
+    while len(rest) > 0:
+        ids, rest = rest[:size], rest[size:]
+        # the dominators of a candidate are in the skyline found so far (which already filtered it) or in its block
+        ids = ids[~dominated(X[ids], X[ids])]
+        is_efficient[ids] = True
+        if len(rest) > 0:
+            rest = rest[~dominated(X[rest], X[ids])]
+        size = min(2 * size, block)
+    return is_efficient
+
+
+def skyline(X):
+    """
+        X: (n_points, n_measures) array, larger values are better
+        return a (n_points, ) boolean array marking the skyline points, as is_pareto_efficient_simple(X)
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if len(X) == 0:
+        return np.ones(0, dtype=bool)
+    if np.isnan(X).any():  # comparisons with missing values are not transitive
+        return is_pareto_efficient_simple(X)
+    if X.shape[1] == 1:
+        return X[:, 0] == X[:, 0].max()
+    if X.shape[1] == 2:
+        return sweep(X)
+    return sort_filter(X)
+
+
+def generate(distribution, n, d, seed=0):
+    """ Synthetic points with independent, correlated or anti-correlated measures """
+    rng = np.random.default_rng(seed)
+    if distribution == "independent":
+        return rng.random((n, d))
+    base = rng.random((n, 1))
+    noise = rng.normal(scale=0.05, size=(n, d))
+    if distribution == "correlated":
+        return base + noise
+    # anti-correlated: points close to a hyperplane orthogonal to the diagonal
+    X = rng.random((n, d))
+    return X - X.mean(axis=1, keepdims=True) + base * 0.1 + noise * 0.1
+
+
+if __name__ == '__main__':
+    ###############################################################################
+    # MICRO-BENCHMARK: simple pareto front vs skyline
+    ###############################################################################
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cells", nargs='*', help="number of cells", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--measures", nargs='*', help="number of measures", type=int, default=[2, 3, 4])
+    parser.add_argument("--max_simple", help="largest number of cells for the simple pareto front", type=int, default=100000)
+    args = parser.parse_args()
+    stats = []
+    for distribution in ["independent", "correlated", "anticorrelated"]:
+        for d in args.measures:
+            for n in args.cells:
+                X = generate(distribution, n, d)
+                start = time.time()
+                res = skyline(X)
+                stats.append([distribution, d, n, "skyline", int(res.sum()), round((time.time() - start) * 1000)])  # time is in ms
+                if n <= args.max_simple:
+                    start = time.time()
+                    assert (is_pareto_efficient_simple(X) == res).all()
+                    stats.append([distribution, d, n, "simple", int(res.sum()), round((time.time() - start) * 1000)])
+    print(pd.DataFrame(stats, columns=["distribution", "measures", "cells", "impl", "skyline", "time"]).to_string(index=False))
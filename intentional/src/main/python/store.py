@@ -0,0 +1,125 @@
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+
+###############################################################################
+# Session-level result store. Cubes are kept as Arrow IPC files: writing them
+# is a columnar dump and reading them memory-maps the file, so the numeric
+# columns are loaded without copies. Pipeline stages are memoised in the same
+# format, keyed by their inputs, their settings and the version of the code.
+###############################################################################
+extension = ".arrow"
+max_stages = 64  # memoised stages (and session cubes) kept in a folder, the least recently used ones are evicted
+
+
+def key(curid, sql):
+    """ Key of the result of sql within the session curid """
+    return hashlib.sha1((str(curid) + "\n" + sql).encode("utf-8")).hexdigest()
+
+
+def path(folder, curid, sql):
+    """ File holding the result of sql within the session curid """
+    return os.path.join(folder, "cube_" + key(curid, sql) + extension)
+
+
+def write(df, file):
+    """
+        df: DataFrame to store
+        file: destination file, written atomically
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp = file + ".tmp"
+    with pa.OSFile(tmp, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, file)
+
+
+def read(file):
+    """
+        file: file written by write
+        return the stored DataFrame, backed by the memory-mapped file
+    """
+    table = pa.ipc.open_file(pa.memory_map(file, "r")).read_all()
+    return table.to_pandas(split_blocks=True)
+
+
+def get(file):
+    """ Stored DataFrame in file, None if it has not been stored yet """
+    if not os.path.isfile(file):
+        return None
+    os.utime(file)  # most recently used
+    return read(file)
+
+
+def fingerprint(df):
+    """ Hash of the content of df (column names, types and values) """
+    h = hashlib.sha1(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def code_version(sources):
+    """ Hash of the source files """
+    h = hashlib.sha1()
+    for file in sources:
+        with open(file, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def evict(folder, keep=None):
+    """ Remove the memoised stages and the session cubes in folder but the keep (default: max_stages) most recently used ones of each """
+    keep = max_stages if keep is None else keep
+    cubes = sorted(glob.glob(os.path.join(folder, "cube_*" + extension)), key=os.path.getmtime, reverse=True)
+    for file in cubes[keep:]:
+        os.remove(file)
+    stages = sorted(glob.glob(os.path.join(folder, "stage_*.json")), key=os.path.getmtime, reverse=True)
+    for file in stages[keep:]:
+        prefix = file[:-len(".json")]
+        os.remove(file)  # removed first, the stage is no longer marked as completed
+        for data in glob.glob(glob.escape(prefix) + "*" + extension):
+            os.remove(data)
+
+
+def memoize(folder, fun, df, *params, settings=None, sources=None):
+    """
+        Memoise the pipeline stage fun(df, *params) on disk. The stage is recomputed only if its input cube, its
+        parameters, its settings or the code change, so a change in a later stage reuses the results of the previous ones.
+        folder: folder of the memoised results
+        fun: stage, returning either a DataFrame or a list of (DataFrame, name)
+        df: input cube
+        params: other parameters of the stage (functions are identified by their name)
+        settings: module settings the stage depends on, as a dict
+        sources: source files of the modules the stage depends on (default: the file of fun)
+        return the result of fun(df, *params)
+    """
+    default = lambda x: getattr(x, "__name__", str(x))
+    version = code_version(tuple(sorted(os.path.abspath(x) for x in (sources or [inspect.getsourcefile(fun)]))))
+    h = hashlib.sha1("\n".join([fun.__name__, version, fingerprint(df), json.dumps(params, default=default), json.dumps(settings, sort_keys=True, default=default)]).encode("utf-8"))
+    prefix = os.path.join(folder, "stage_" + fun.__name__ + "_" + h.hexdigest())
+    if os.path.isfile(prefix + ".json"):
+        os.utime(prefix + ".json")  # most recently used
+        with open(prefix + ".json") as f:
+            names = json.load(f)
+        if names is None:
+            return read(prefix + extension)
+        return [(read(prefix + "_" + str(i) + extension), name) for i, name in enumerate(names)]
+    res = fun(df, *params)
+    if isinstance(res, pd.DataFrame):
+        write(res, prefix + extension)
+        names = None
+    else:
+        for i, (Z, name) in enumerate(res):
+            write(Z, prefix + "_" + str(i) + extension)
+        names = [name for _, name in res]
+    with open(prefix + ".json", "w") as f:  # written last, it marks the stage as completed
+        json.dump(names, f)
+    evict(folder)
+    return res
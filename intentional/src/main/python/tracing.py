@@ -0,0 +1,134 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:  # not available on Windows, the peak RSS is not reported
+    resource = None
+
+###############################################################################
+# Tracing. Stages of the operators (read, pivot, encode, fit, predict, label,
+# write, ...) are wrapped in nested spans, which record their wall time, CPU
+# time, number of rows and peak memory: the peak RSS of the process and, if
+# tracemalloc is tracing, the peak of the memory allocated within the span.
+# The finished spans of a process are kept only if tracing is enabled, and
+# exported as JSON lines or in the Chrome trace format (chrome://tracing,
+# Perfetto, speedscope) for flame-graph inspection.
+###############################################################################
+enabled = False  # keep the finished spans (the measures of the open ones and the listeners are available anyway)
+spans = []  # finished spans, in order of completion
+stack = threading.local()  # open spans of each thread
+listeners = []  # functions called with each span when it is closed
+
+
+class Span:
+    """ A stage of an operator, its measures are available once it is closed """
+
+    def __init__(self, name, rows, parent, depth):
+        self.name = name
+        self.rows = rows  # can be set while the span is open
+        self.parent = parent
+        self.depth = depth
+        self.tid = threading.get_ident()
+        self.start = time.time()
+        self.wall = None  # ms
+        self.cpu = None  # ms
+        self.memory = None  # peak of the memory allocated within the span (bytes), if tracemalloc is tracing
+        self.rss = None  # peak RSS of the process at the end of the span (MB)
+        self.base = None  # traced memory when the span is opened
+        self.peak = 0  # peak of the traced memory within the closed children
+
+    def record(self):
+        return {"name": self.name, "parent": None if self.parent is None else self.parent.name, "depth": self.depth,
+                "start": self.start, "wall": self.wall, "cpu": self.cpu, "rows": self.rows, "memory": self.memory,
+                "rss": self.rss, "pid": os.getpid(), "tid": self.tid}
+
+
+def peak_rss():
+    """ Peak RSS of the process in MB, None if it is not available """
+    return None if resource is None else round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)  # KB on Linux
+
+
+class span:
+    """
+        Context manager (and decorator) tracing a stage:
+            with tracing.span("fit", rows=len(X)) as s:
+                ...
+            s.wall  # ms
+        name: name of the stage
+        rows: number of rows processed by the stage
+    """
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        opened = getattr(stack, "open", None)
+        if opened is None:
+            opened = stack.open = []
+        s = Span(self.name, self.rows, opened[-1] if len(opened) > 0 else None, len(opened))
+        if tracemalloc.is_tracing():
+            if s.parent is not None and s.parent.base is not None:  # the peak of the parent before this span
+                s.parent.peak = max(s.parent.peak, tracemalloc.get_traced_memory()[1] - s.parent.base)
+            s.base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        opened.append(s)
+        s.counter, s.process = time.perf_counter(), time.process_time()
+        self.s = s
+        return s
+
+    def __exit__(self, *exc):
+        s = self.s
+        s.wall = (time.perf_counter() - s.counter) * 1000
+        s.cpu = (time.process_time() - s.process) * 1000
+        if tracemalloc.is_tracing() and s.base is not None:
+            s.memory = max(s.peak, tracemalloc.get_traced_memory()[1] - s.base)
+            if s.parent is not None and s.parent.base is not None:  # the peak of this span is also a peak of the parent
+                s.parent.peak = max(s.parent.peak, s.memory + s.base - s.parent.base)
+            tracemalloc.reset_peak()
+        s.rss = peak_rss()
+        stack.open.pop()
+        if enabled:
+            spans.append(s.record())
+        for listener in listeners:
+            listener(s)
+        return False
+
+    def __call__(self, fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            with span(self.name, self.rows):
+                return fun(*args, **kwargs)
+        return wrapper
+
+
+def reset():
+    """ Forget the finished spans """
+    spans.clear()
+
+
+def chrome(records):
+    """ Spans as the events of a Chrome trace (complete events, times in microseconds) """
+    return {"traceEvents": [{"name": r["name"], "ph": "X", "ts": round(r["start"] * 1e6), "dur": round(r["wall"] * 1000),
+                             "pid": r["pid"], "tid": r["tid"],
+                             "args": {x: r[x] for x in ["cpu", "rows", "memory", "rss"] if r[x] is not None}} for r in records],
+            "displayTimeUnit": "ms"}
+
+
+def write(file, records=None):
+    """
+        file: destination, in the Chrome trace format if it ends with .json, as JSON lines otherwise (appended)
+        records: spans to write (default: all the finished spans)
+    """
+    records = spans if records is None else records
+    if file.endswith(".json"):
+        with open(file, "w") as f:
+            json.dump(chrome(records), f)
+    else:
+        with open(file, "a") as f:
+            for r in records:
+                f.write(json.dumps(r) + "\n")